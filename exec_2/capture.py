@@ -0,0 +1,293 @@
+import argparse
+import mmap
+import os
+import select
+import signal
+import socket
+import struct
+import sys
+import time
+
+from arp_scan import attach_filter, check_lab_network
+
+ETH_P_ALL = 0x0003
+ETH_P_IP = 0x0800
+SOL_PACKET = 263
+PACKET_RX_RING = 5
+PACKET_STATISTICS = 6
+PACKET_VERSION = 10
+TPACKET_V2 = 1
+TP_STATUS_KERNEL = 0
+TP_STATUS_USER = 1
+# status, len, snaplen, mac, net, sec, nsec, vlan tci, vlan tpid
+_TPACKET2_HDR = struct.Struct("=IIIHHIIHH")
+# block size, block count, frame size, frame count
+_TPACKET_REQ = struct.Struct("=IIII")
+# packets, drops
+_TPACKET_STATS = struct.Struct("=II")
+
+# rx ring: 64 blocks of 1MB, 2048 byte frames(a 1514 byte frame and the header)
+RING_BLOCK_SIZE = 1 << 20
+RING_BLOCKS = 64
+RING_FRAME_SIZE = 2048
+
+PCAP_MAGIC_NSEC = 0xa1b23c4d
+LINKTYPE_ETHERNET = 1
+_PCAP_HEADER = struct.Struct("=IHHiIII")
+# ts sec, ts nsec, captured length, original length
+_PCAP_RECORD = struct.Struct("=IIII")
+ROTATE_SIZE = 64 * 1024 * 1024
+# jt/jf of classic BPF are 8 bit, the first jump of host_filter is 2n + 3.
+MAX_FILTER_HOSTS = 126
+
+def host_filter(ips):
+    """
+    classic BPF program taking IPv4 packets from or to any of ips.
+    """
+    if len(ips) > MAX_FILTER_HOSTS:
+        raise ValueError("at most %d hosts, %d given(use --bpf for more)"
+                         % (MAX_FILTER_HOSTS, len(ips)))
+    for ip in ips:
+        check_lab_network(ip)
+    addrs = [struct.unpack("!I", socket.inet_aton(ip))[0] for ip in ips]
+    n = len(addrs)
+    # accept is at 4 + 2n, reject at 5 + 2n
+    program = [(0x28, 0, 0, 12),                    # ldh [12]      ethertype
+               (0x15, 0, 2 * n + 3, ETH_P_IP)]      # jeq #0x800
+    for offset in (26, 30):                         # ld [26] src, ld [30] dst
+        program.append((0x20, 0, 0, offset))
+        for i, addr in enumerate(addrs):
+            rest = n - 1 - i
+            if offset == 26:
+                # matched: skip the rest and the dst part. else try the next
+                program.append((0x15, rest + n + 1, 0, addr))
+            else:
+                program.append((0x15, rest, 0 if rest else 1, addr))
+    program.append((0x06, 0, 0, 0x40000))           # ret whole packet
+    program.append((0x06, 0, 0, 0))                 # ret 0
+    return program
+
+def parse_bpf(text):
+    """
+    program printed by "tcpdump -ddd expression", lines or commas.
+    """
+    values = text.replace(",", "\n").split("\n")
+    values = [v.split() for v in values if v.strip()]
+    count = int(values[0][0])
+    program = [tuple(int(x) for x in v) for v in values[1:]]
+    if len(program) != count:
+        raise ValueError("%d instructions expected, %d given" % (count, len(program)))
+    return program
+
+def capture_socket(iface, program=None):
+    # protocol 0 receives nothing until bind, an ETH_P_ALL socket would
+    # queue unfiltered packets before the filter is attached.
+    sock = socket.socket(socket.AF_PACKET, socket.SOCK_RAW, 0)
+    if program:
+        attach_filter(sock, program)
+    sock.bind((iface, ETH_P_ALL))
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 32 * 1024 * 1024)
+    return sock
+
+def capture_stats(sock):
+    """
+    return value: tuple of packets and drops since the last call.
+    """
+    return _TPACKET_STATS.unpack(sock.getsockopt(SOL_PACKET, PACKET_STATISTICS, _TPACKET_STATS.size))
+
+class capture(object):
+    """
+    packets of an interface. with ring the kernel writes them into a
+    PACKET_MMAP rx ring shared with us, without a copy or a syscall per
+    packet. else they are read with recv_into.
+
+    for ts, packet, length in capture("eth1", host_filter(["192.168.20.2"])):
+        ...
+
+    packet is a memoryview valid until the next packet is taken.
+    length is the length on the wire, packet may be shorter(snaplen).
+    """
+
+    def __init__(self, iface, program=None, ring=True, block_size=RING_BLOCK_SIZE,
+                 blocks=RING_BLOCKS, frame_size=RING_FRAME_SIZE, timeout=None):
+        """
+        program: classic BPF program, see host_filter and parse_bpf.
+        timeout: seconds without a packet before the iteration ends,
+            None waits forever.
+        """
+        self.sock = capture_socket(iface, program)
+        self.timeout = timeout
+        self.ring = None
+        if ring:
+            self.sock.setsockopt(SOL_PACKET, PACKET_VERSION, TPACKET_V2)
+            self.frame_size = frame_size
+            self.frames = block_size // frame_size * blocks
+            self.sock.setsockopt(SOL_PACKET, PACKET_RX_RING,
+                                 _TPACKET_REQ.pack(block_size, blocks, frame_size, self.frames))
+            self.ring = mmap.mmap(self.sock.fileno(), block_size * blocks,
+                                  mmap.MAP_SHARED, mmap.PROT_READ | mmap.PROT_WRITE)
+        self.packets = 0
+        self.drops = 0
+
+    def __iter__(self):
+        return self._ring_packets() if self.ring is not None else self._recv_packets()
+
+    def _wait(self, poller):
+        wait = None if self.timeout is None else int(self.timeout * 1000)
+        return bool(poller.poll(wait))
+
+    def _ring_packets(self):
+        ring = memoryview(self.ring)
+        poller = select.poll()
+        poller.register(self.sock, select.POLLIN | select.POLLERR)
+        index = 0
+        try:
+            while True:
+                offset = index * self.frame_size
+                (status, length, snaplen, mac, _, sec, nsec, _, _) = \
+                    _TPACKET2_HDR.unpack_from(ring, offset)
+                if not status & TP_STATUS_USER:
+                    if not self._wait(poller):
+                        return
+                    continue
+                start = offset + mac
+                try:
+                    yield sec * 1000000000 + nsec, ring[start:start + snaplen], length
+                finally:
+                    # give the frame back to the kernel
+                    struct.pack_into("=I", ring, offset, TP_STATUS_KERNEL)
+                index = (index + 1) % self.frames
+        finally:
+            ring.release()
+
+    def _recv_packets(self):
+        buf = bytearray(65536)
+        view = memoryview(buf)
+        poller = select.poll()
+        poller.register(self.sock, select.POLLIN)
+        while True:
+            if not self._wait(poller):
+                return
+            n = self.sock.recv_into(buf, 0, socket.MSG_TRUNC)
+            yield time.time_ns(), view[:min(n, len(buf))], n
+
+    def stats(self):
+        """
+        return value: tuple of packets and drops so far.
+        """
+        packets, drops = capture_stats(self.sock)
+        self.packets += packets
+        self.drops += drops
+        return self.packets, self.drops
+
+    def close(self):
+        self.stats()
+        if self.ring is not None:
+            try:
+                self.ring.close()
+            except BufferError:
+                # a packet view is still referenced, unmapped with it.
+                pass
+        self.sock.close()
+
+class pcap_writer(object):
+    """
+    pcap(nanosecond) files written through a preallocated memory map.
+    when a file is full it is cut to its length and the next one is
+    started: out.pcap, out.1.pcap, out.2.pcap ...
+    """
+
+    def __init__(self, path, rotate_size=ROTATE_SIZE, snaplen=65535):
+        self.path = path
+        self.rotate_size = rotate_size
+        self.snaplen = snaplen
+        self.index = 0
+        self.file = None
+        self.map = None
+        self.files = []
+        self._open()
+
+    def _name(self):
+        if self.index == 0:
+            return self.path
+        base, ext = os.path.splitext(self.path)
+        return "%s.%d%s" % (base, self.index, ext)
+
+    def _open(self):
+        name = self._name()
+        self.file = open(name, "w+b")
+        try:
+            os.posix_fallocate(self.file.fileno(), 0, self.rotate_size)
+        except (AttributeError, OSError):
+            self.file.truncate(self.rotate_size)
+        self.map = mmap.mmap(self.file.fileno(), self.rotate_size)
+        _PCAP_HEADER.pack_into(self.map, 0, PCAP_MAGIC_NSEC, 2, 4, 0, 0,
+                               self.snaplen, LINKTYPE_ETHERNET)
+        self.offset = _PCAP_HEADER.size
+        self.files.append(name)
+
+    def _finish(self):
+        self.map.close()
+        self.file.truncate(self.offset)
+        self.file.close()
+
+    def write(self, timestamp, packet, length=None):
+        """
+        timestamp: nanoseconds since the epoch.
+        length: length on the wire, len(packet) if None.
+        """
+        size = min(len(packet), self.snaplen)
+        if self.offset + _PCAP_RECORD.size + size > self.rotate_size:
+            self._finish()
+            self.index += 1
+            self._open()
+        sec, nsec = divmod(timestamp, 1000000000)
+        _PCAP_RECORD.pack_into(self.map, self.offset, sec, nsec, size,
+                               len(packet) if length is None else length)
+        self.offset += _PCAP_RECORD.size
+        self.map[self.offset:self.offset + size] = packet[:size]
+        self.offset += size
+
+    def close(self):
+        if self.map is not None:
+            self._finish()
+            self.map = None
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("iface")
+    parser.add_argument("output", help="pcap file")
+    parser.add_argument("--host", action="append", default=[],
+                        help="capture IPv4 packets from or to this host")
+    parser.add_argument("--bpf", default=None, help='output of "tcpdump -ddd expression"')
+    parser.add_argument("--rotate", type=int, default=ROTATE_SIZE // (1024 * 1024), help="MB per file")
+    parser.add_argument("--count", type=int, default=None)
+    parser.add_argument("--no-ring", action="store_true", help="recv_into instead of PACKET_MMAP")
+    args = parser.parse_args()
+
+    program = None
+    if args.bpf:
+        program = parse_bpf(args.bpf)
+    elif args.host:
+        program = host_filter(args.host)
+    cap = capture(args.iface, program, ring=not args.no_ring)
+    writer = pcap_writer(args.output, args.rotate * 1024 * 1024)
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    n = 0
+    print("[*] Capturing on %s..." % args.iface)
+    try:
+        for ts, packet, length in cap:
+            writer.write(ts, packet, length)
+            n += 1
+            if n == args.count:
+                break
+    except KeyboardInterrupt:
+        pass
+    finally:
+        writer.close()
+        cap.close()
+        print("[*] %d packets written to %s, %d dropped by the kernel."
+              % (n, ", ".join(writer.files), cap.drops))
+
+if __name__ == "__main__":
+    main()
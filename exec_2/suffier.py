@@ -1,5 +1,218 @@
-from scapy.all import *
+import argparse
+import array
+import multiprocessing
+import os
+import select
+import socket
+import struct
+import threading
+import time
+
+from arp_scan import check_lab_network
+
 src_ip="192.168.20.2"
 dst_ip="192.168.30.2"
-for _ in range(10):
-    send(IP(src=src_ip,dst=dst_ip)/ICMP())
+
+ICMP_ECHO_REPLY = 0
+ICMP_ECHO_REQUEST = 8
+# version/ihl, tos, total length, id, flags/fragment, ttl, protocol, checksum, src, dst
+_IP_HEADER = struct.Struct("!BBHHHBBH4s4s")
+# type, code, checksum, id, sequence
+_ICMP_HEADER = struct.Struct("!BBHHH")
+_ICMP_OFFSET = _IP_HEADER.size
+_ICMP_CHECKSUM = _ICMP_OFFSET + 2
+_ICMP_SEQ = _ICMP_OFFSET + 6
+# packets a worker sends before it looks at the clock again.
+SEND_BATCH = 32
+
+def checksum(data):
+    if len(data) % 2:
+        data = bytes(data) + b"\x00"
+    s = sum(array.array("H", bytes(data)))
+    s = (s >> 16) + (s & 0xffff)
+    s += s >> 16
+    # array("H") is host order, swap back to network order.
+    return socket.ntohs(~s & 0xffff)
+
+def checksum_update(csum, old, new):
+    """
+    RFC 1624: checksum after a 16bit field changed from old to new.
+    """
+    s = (~csum & 0xffff) + (~old & 0xffff) + new
+    s = (s >> 16) + (s & 0xffff)
+    s += s >> 16
+    return ~s & 0xffff
+
+def echo_template(src, dst, ident, payload_size=56):
+    """
+    IP/ICMP echo request serialized once, sequence 0.
+    the IP checksum and id are left 0, the kernel fills them in.
+    return value: tuple of bytearray and ICMP checksum of sequence 0.
+    """
+    check_lab_network(src)
+    check_lab_network(dst)
+    payload = bytes(i & 0xff for i in range(payload_size))
+    icmp = _ICMP_HEADER.pack(ICMP_ECHO_REQUEST, 0, 0, ident, 0) + payload
+    csum = checksum(icmp)
+    ip = _IP_HEADER.pack(0x45, 0, _IP_HEADER.size + len(icmp), 0, 0, 64,
+                         socket.IPPROTO_ICMP, 0, socket.inet_aton(src), socket.inet_aton(dst))
+    packet = bytearray(ip + icmp)
+    struct.pack_into("!H", packet, _ICMP_CHECKSUM, csum)
+    return packet, csum
+
+class _receiver(threading.Thread):
+    """
+    take the echo replies of one ident and keep their RTT.
+    """
+
+    def __init__(self, icmp_id, sent_at):
+        super().__init__(daemon=True)
+        self.icmp_id = icmp_id
+        self.sent_at = sent_at
+        self.rtts = []
+        self.running = True
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_RAW, socket.IPPROTO_ICMP)
+
+    def run(self):
+        buf = bytearray(2048)
+        while self.running:
+            r, _, _ = select.select([self.sock], [], [], 0.1)
+            if not r:
+                continue
+            n = self.sock.recv_into(buf)
+            now = time.perf_counter()
+            offset = (buf[0] & 0x0f) * 4
+            if n < offset + _ICMP_HEADER.size:
+                continue
+            kind, _, _, ident, seq = _ICMP_HEADER.unpack_from(buf, offset)
+            if kind == ICMP_ECHO_REPLY and ident == self.icmp_id and self.sent_at[seq]:
+                self.rtts.append(now - self.sent_at[seq])
+                self.sent_at[seq] = 0.0
+
+    def stop(self, wait):
+        time.sleep(wait)
+        self.running = False
+        self.join()
+        self.sock.close()
+
+def _worker(pairs, ident, rate, count, duration, payload_size, wait, results):
+    try:
+        results.put(_send_loop(pairs, ident, rate, count, duration, payload_size, wait))
+    except Exception as e:
+        # the parent waits for one result per worker
+        results.put(e)
+
+def _send_loop(pairs, ident, rate, count, duration, payload_size, wait):
+    templates = [echo_template(src, dst, ident, payload_size) + ((dst, 0),) for src, dst in pairs]
+    # send time of each sequence, for the RTT of its reply
+    sent_at = array.array("d", bytes(8 * 65536))
+    receiver = _receiver(ident, sent_at)
+    receiver.start()
+    sock = socket.socket(socket.AF_INET, socket.SOCK_RAW, socket.IPPROTO_RAW)
+
+    sent = 0
+    start = time.perf_counter()
+    deadline = None if duration is None else start + duration
+    try:
+        while count is None or sent < count:
+            now = time.perf_counter()
+            if deadline is not None and now >= deadline:
+                break
+            if rate:
+                ahead = sent / rate - (now - start)
+                if ahead > 0:
+                    time.sleep(ahead)
+            batch = SEND_BATCH if count is None else min(SEND_BATCH, count - sent)
+            for _ in range(batch):
+                seq = sent & 0xffff
+                packet, base, addr = templates[sent % len(templates)]
+                struct.pack_into("!H", packet, _ICMP_CHECKSUM, checksum_update(base, 0, seq))
+                struct.pack_into("!H", packet, _ICMP_SEQ, seq)
+                sent_at[seq] = time.perf_counter()
+                sock.sendto(packet, addr)
+                sent += 1
+        elapsed = time.perf_counter() - start
+    finally:
+        sock.close()
+        receiver.stop(wait)
+    return sent, elapsed, receiver.rtts
+
+def generate(pairs, rate=None, count=None, duration=None, workers=1, payload_size=56, wait=1.0):
+    """
+    send echo requests for every (src, dst) pair in turn from worker
+    processes, each with one raw socket and its own ICMP id.
+    rate: packets per second of all workers, None is as fast as possible.
+    count, duration: stop after count packets or duration seconds.
+    wait: seconds to wait for the last replies.
+    return value: dict of sent, elapsed, rate, replies and rtts(seconds).
+    """
+    if count is None and duration is None:
+        raise ValueError("count or duration is needed")
+    results = multiprocessing.Queue()
+    base_ident = os.getpid() & 0xff00
+    procs = []
+    for i in range(workers):
+        n = None if count is None else count // workers + (i < count % workers)
+        p = multiprocessing.Process(
+            target=_worker,
+            args=(pairs, (base_ident + i) & 0xffff, rate and rate / workers, n, duration,
+                  payload_size, wait, results))
+        p.start()
+        procs.append(p)
+    sent = 0
+    elapsed = 0.0
+    rtts = []
+    error = None
+    for _ in procs:
+        result = results.get()
+        if isinstance(result, Exception):
+            error = result
+            continue
+        s, e, r = result
+        sent += s
+        elapsed = max(elapsed, e)
+        rtts += r
+    for p in procs:
+        p.join()
+    if error is not None:
+        raise error
+    return {"sent": sent, "elapsed": elapsed, "rate": sent / elapsed if elapsed else 0.0,
+            "replies": len(rtts), "rtts": rtts}
+
+def report(result):
+    print("[*] sent %d packets in %.3f s: %.0f pps" % (result["sent"], result["elapsed"], result["rate"]))
+    rtts = sorted(result["rtts"])
+    loss = 100.0 * (1 - len(rtts) / result["sent"]) if result["sent"] else 0.0
+    print("[*] %d replies, %.1f%% loss" % (len(rtts), loss))
+    if rtts:
+        print("[*] rtt min/avg/p50/p99/max = %.3f/%.3f/%.3f/%.3f/%.3f ms" % (
+            rtts[0] * 1000, sum(rtts) / len(rtts) * 1000, rtts[len(rtts) // 2] * 1000,
+            rtts[min(len(rtts) - 1, int(len(rtts) * 0.99))] * 1000, rtts[-1] * 1000))
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--fast", action="store_true",
+                        help="pre-serialized packets on raw sockets")
+    parser.add_argument("--pair", action="append", default=[], metavar="SRC,DST")
+    parser.add_argument("--rate", type=float, default=None, help="packets per second")
+    parser.add_argument("--count", type=int, default=None)
+    parser.add_argument("--duration", type=float, default=None, help="seconds")
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--size", type=int, default=56, help="ICMP payload bytes")
+    args = parser.parse_args()
+
+    if not args.fast:
+        # the layers used only, not scapy.all
+        from scapy.layers.inet import IP, ICMP
+        from scapy.sendrecv import send
+        for _ in range(10):
+            send(IP(src=src_ip,dst=dst_ip)/ICMP())
+        return
+    pairs = [tuple(p.split(",")) for p in args.pair] or [(src_ip, dst_ip)]
+    count = args.count
+    if count is None and args.duration is None:
+        count = 10
+    report(generate(pairs, args.rate, count, args.duration, args.workers, args.size))
+
+if __name__ == "__main__":
+    main()
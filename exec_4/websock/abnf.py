@@ -1,7 +1,8 @@
-import numpy
 import threading
 import struct
-from util_http import *
+import time
+import masking
+from masking import mask_inplace
 
 
 # closing frame status codes.
@@ -20,12 +21,48 @@ STATUS_BAD_GATEWAY = 1014
 STATUS_TLS_HANDSHAKE_ERROR = 1015
 
 
+class WebSocketProtocolException(Exception):
+    """
+    the peer broke the protocol.
+    status: close status code to send before closing the connection.
+    """
+    def __init__(self, message, status=STATUS_PROTOCOL_ERROR):
+        super().__init__(message)
+        self.status = status
+
+
+class _mask_field(object):
+    """
+    ABNF.mask is both the mask bit of a frame(frame.mask) and the static
+    function ABNF.mask(mask_key, data). the bit lives in the _mask slot.
+    """
+
+    def __init__(self, function):
+        self.function = function
+
+    def __get__(self, frame, cls=None):
+        if frame is None:
+            return self.function
+        return frame._mask
+
+    def __set__(self, frame, value):
+        frame._mask = value
+
+
+_HEADER_7 = struct.Struct("!BB")
+_HEADER_16 = struct.Struct("!BBH")
+_HEADER_63 = struct.Struct("!BBQ")
+
+
 class ABNF(object):
     """
     ABNF frame class.
     see http://tools.ietf.org/html/rfc5234
     and http://tools.ietf.org/html/rfc6455#section-5.2
     """
+    # no per frame __dict__, frames are made for every message.
+    __slots__ = ("fin", "rsv1", "rsv2", "rsv3", "opcode", "_mask", "data",
+                 "get_mask_key", "text")
 
     # operation code values.
     OPCODE_CONT = 0x0
@@ -65,67 +102,129 @@ class ABNF(object):
         self.rsv2 = rsv2
         self.rsv3 = rsv3
         self.opcode = opcode
-        self.mask = mask
+        self._mask = mask
         if data is None:
             data = ""
         self.data = data
-        self.get_mask_key = os.urandom
-    
+        # function(n) returning the mask key, None is the shared
+        # masking.mask_key(urandom in blocks).
+        self.get_mask_key = None
+        # decoded str of a received text message, see websocket_core.
+        self.text = None
+
+    def _mask_key(self):
+        if self.get_mask_key is None:
+            return masking.mask_key(4)
+        return self.get_mask_key(4)
+
     def formating(self):
-        if any(x not in (0, 1) for x in [self.fin, self.rsv1, self.rsv2, self.rsv3]):
+        frame_header = self._frame_header()
+        length = len(self.data)
+
+        if not self._mask:
+            return frame_header + self.data
+        else:
+            # one buffer for header + mask key + payload, masked in place.
+            mask_key = self._mask_key()
+            header_len = len(frame_header) + 4
+            frame = bytearray(header_len + length)
+            frame[:header_len - 4] = frame_header
+            frame[header_len - 4:header_len] = mask_key
+            frame[header_len:] = self.data
+            mask_inplace(mask_key, memoryview(frame)[header_len:])
+
+            return frame
+
+    def formating_buffers(self, stats=None):
+        """
+        format the frame as separate buffers for scatter-gather send.
+        stats: ws_stats to add the masking time to.
+        return value: list of [header(+ mask key), payload].
+        the payload is never joined with the header. unmasked payload is
+        sent as is, masked payload is one masked copy.
+        """
+        frame_header = self._frame_header()
+
+        if not self._mask:
+            return [frame_header, self.data]
+        else:
+            mask_key = self._mask_key()
+            if stats is None:
+                payload = mask_inplace(mask_key, bytearray(self.data))
+            else:
+                start = time.perf_counter()
+                payload = mask_inplace(mask_key, bytearray(self.data))
+                stats.mask_seconds += time.perf_counter() - start
+            return [frame_header + mask_key, payload]
+
+    def _frame_header(self):
+        if self.fin not in (0, 1) or self.rsv1 not in (0, 1) or \
+                self.rsv2 not in (0, 1) or self.rsv3 not in (0, 1):
             raise ValueError("not 0 or 1")
         if self.opcode not in ABNF.OPCODES:
             raise ValueError("Invalid OPCODE")   
+        if isinstance(self.data, str):
+            self.data = self.data.encode("utf-8")
         length = len(self.data)
         if length >= ABNF.LENGTH_63:
             raise ValueError("data is too long")
-        frame_header = (self.fin << 7| self.rsv1 << 6 | self.rsv2 << 5 | self.rsv3 << 4| self.opcode).to_bytes(1, byteorder='big')
+        b1 = self.fin << 7 | self.rsv1 << 6 | self.rsv2 << 5 | self.rsv3 << 4 | self.opcode
         if length < ABNF.LENGTH_7:
-            frame_header += (self.mask << 7 | length).to_bytes(1, byteorder='big')
+            frame_header = _HEADER_7.pack(b1, self._mask << 7 | length)
         elif length < ABNF.LENGTH_16:
             # 0x7e == 126
             # ペイロードの長さが16bitよりも長いのでそのときはpayload lenを126にして
             # extend payloadを利用すること示さなくてはいけない。
             #  If 126, the following 2 bytes interpreted as a 16-bit unsigned integer are the payload length.
-            frame_header += (self.mask << 7| 0x7e).to_bytes(1, byteorder='big')
-            frame_header += struct.pack("!H", length)
+            frame_header = _HEADER_16.pack(b1, self._mask << 7 | 0x7e, length)
         else:
             # 0x7f == 127
             # ペイロードの長さが16bitよりも長いのでそのときはpayload lenを127にして
             # extend payloadと extend payload length conttinuedを利用すること示さなくてはいけない。
             # If 127, the following 8 bytes interpreted as a 64-bit unsigned integer (the most significant bit MUST be 0)
-            frame_header += (self.mask << 7 | 0x7f).to_bytes(1, byteorder='big')
-            frame_header += struct.pack("!Q", length)
-    
-        if not self.mask:
-            return frame_header + self.data
-        else:
-            mask_key = self.get_mask_key(4)
-            ms = self._get_masked(mask_key)
+            frame_header = _HEADER_63.pack(b1, self._mask << 7 | 0x7f, length)
 
-            return frame_header + ms
-    
-    def _get_masked(self, mask_key):
-        s = ABNF.mask(mask_key, self.data)
-        # mask_key = mask_key.hex()
-        return mask_key + s
+        return frame_header
+
+    def validate(self, allow_rsv1=False):
+        """
+        validate received frame.
+        allow_rsv1: rsv1 is in use by permessage-deflate.
+        """
+        ABNF.validate_header(self.fin, self.rsv1, self.rsv2, self.rsv3,
+                             self.opcode, len(self.data), allow_rsv1)
 
     @staticmethod
+    def validate_header(fin, rsv1, rsv2, rsv3, opcode, length, allow_rsv1=False):
+        """
+        validate frame header fields before the payload is read.
+        """
+        if rsv2 or rsv3:
+            raise WebSocketProtocolException("rsv2/rsv3 is not 0")
+        if rsv1 and not (allow_rsv1 and opcode in (ABNF.OPCODE_TEXT, ABNF.OPCODE_BINARY)):
+            raise WebSocketProtocolException("rsv1 is not 0")
+        if opcode not in ABNF.OPCODES:
+            raise WebSocketProtocolException("Invalid opcode %r" % opcode)
+        if opcode >= ABNF.OPCODE_CLOSE:
+            if not fin:
+                raise WebSocketProtocolException("Invalid fragmented control frame")
+            if length >= ABNF.LENGTH_7:
+                raise WebSocketProtocolException("Invalid control frame length")
+
+    @_mask_field
     def mask(mask_key, data):
+        """
+        mask data with mask_key.
+        writable buffers (bytearray) are masked in place and returned,
+        others are copied into a new bytearray first.
+        """
         if data is None:
-            data=""
-        
-        origlen = len(data)
-        _mask_key = mask_key[3] << 24 | mask_key[2] << 16 | mask_key[1] << 8 | mask_key[0]
-    
-        # We need data to be a multiple of four...
-        data += bytes(" " * (4 - (len(data) % 4)), "us-ascii")
-        a = numpy.frombuffer(data, dtype="uint32")
-        masked = numpy.bitwise_xor(a, [_mask_key]).astype("uint32")
-        if len(data) > origlen:
-            return masked.tobytes()[:origlen]
-        
-        return masked.tobytes()
+            data = bytearray()
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        if not isinstance(data, bytearray):
+            data = bytearray(data)
+        return mask_inplace(mask_key, data)
 
     @staticmethod
     def create_frame(data, opcode, fin=1):
@@ -142,14 +241,48 @@ class ABNF(object):
         # mask must be set if send data from client
         return ABNF(fin, 0, 0, 0, opcode, 1, data)
 
-# send data buffer ¥
+class _NeedData(Exception):
+    """
+    sans-IO frame_buffer has no more bytes to parse.
+    """
+    pass
+
+
+# recv data buffer
 class frame_buffer():
     _HEADER_MASK_INDEX = 5
     _HEADER_LENGTH_INDEX = 6
+    # initial size of the receive ring. it grows when a frame does not fit.
+    _INITIAL_BUFSIZE = 65536
+    # payloads at least this long are received straight into their own buffer.
+    _DIRECT_PAYLOAD_SIZE = 16384
 
-    def __init__(self, recv_fn):
-        self.recv = recv_fn
-        self.recv_buffer = []
+    def __init__(self, recv_into_fn=None, bufsize=_INITIAL_BUFSIZE):
+        """
+        recv_into_fn: function(buf) filling buf from the socket and
+            returning the count. if None, the buffer works sans-IO: bytes
+            are pushed with get_buffer/buffer_updated(or feed) and frames
+            are taken with next_frame.
+        """
+        if recv_into_fn is None:
+            recv_into_fn = frame_buffer._need_data
+        self.recv_into = recv_into_fn
+        # set when an extension(permessage-deflate) uses rsv1.
+        self.allow_rsv1 = False
+        # ws_stats, None when disabled.
+        self.stats = None
+        # free space made in the ring before a read. TLS connections set
+        # it to one record so that a record is not read in pieces.
+        self.read_size = 0
+        # frame_recorder getting every received frame, None when disabled.
+        self.recorder = None
+        self.buffer = bytearray(bufsize)
+        self.view = memoryview(self.buffer)
+        # unread bytes are self.buffer[self.start:self.end]
+        self.start = 0
+        self.end = 0
+        # get_buffer lent the payload instead of the ring.
+        self._lent_payload = False
         self.clear()
         self.lock = threading.Lock()
 
@@ -157,45 +290,143 @@ class frame_buffer():
         self.header = None
         self.length = None
         self.mask = None
-        
-    
-    def recv_frame(self):
-        with self.lock:
-            # header read
-            if self.has_header():
-                self.recv_header()
-            (fin, rsv1, rsv2, rsv3, opcode, has_mask, _) = self.header
+        self.payload = None
+        self.filled = 0
 
-            # frame len read
-            if self.has_length():
-                self.recv_length()
-            length = self.length
+    def recv_frame(self, max_length=None):
+        """
+        receive one whole frame.
+        max_length: payload length limit of data frames, a longer frame
+            is refused before its payload is read.
+        return value: ABNF frame object.
+        """
+        with self.lock:
+            stats = self.stats
+            if stats is not None:
+                start = time.perf_counter()
+                recv_seconds = stats.recv_seconds
 
-            if has_mask:
-                # mask read
-                if self.has_mask():
-                    self.recv_mask()
-                mask = self.mask
+            self.recv_frame_header(max_length)
+            (fin, rsv1, rsv2, rsv3, opcode, has_mask, _) = self.header
 
             # payload
-            payload = self.recv_reader(length)[0]
+            payload = self.recv_payload(self.length)
             if has_mask:
-                payload = ABNF.mask(mask, payload)
+                # payload is our own bytearray, unmask it in place.
+                if stats is None:
+                    mask_inplace(self.mask, payload)
+                else:
+                    mask_start = time.perf_counter()
+                    mask_inplace(self.mask, payload)
+                    stats.mask_seconds += time.perf_counter() - mask_start
 
             # reset for next frame
             self.clear()
 
             frame = ABNF(fin, rsv1, rsv2, rsv3, opcode, has_mask, payload)
+            if self.recorder is not None:
+                self.recorder.received(frame)
+
+            if stats is not None:
+                # time waiting in recv is not parse time.
+                stats.parse_seconds += time.perf_counter() - start - \
+                    (stats.recv_seconds - recv_seconds)
+                stats.frame_in(opcode, len(payload))
 
         return frame
 
+    def recv_frame_header(self, max_length=None):
+        """
+        read header, length and mask of the next frame and validate them.
+        like the other readers this can be resumed after a timeout.
+        """
+        # header read
+        if self.has_header():
+            self.recv_header()
+
+        # frame len read
+        if self.has_length():
+            self.recv_length()
+            (fin, rsv1, rsv2, rsv3, opcode, _, _) = self.header
+            ABNF.validate_header(fin, rsv1, rsv2, rsv3, opcode, self.length, self.allow_rsv1)
+            if max_length is not None and opcode < ABNF.OPCODE_CLOSE and self.length > max_length:
+                raise WebSocketProtocolException(
+                    "frame is too big: %d" % self.length, STATUS_MESSAGE_TOO_BIG)
+
+        # mask read
+        if self.header[frame_buffer._HEADER_MASK_INDEX] and self.has_mask():
+            self.recv_mask()
+
+    def recv_payload_chunk(self, size):
+        """
+        read the next part of the current frame payload, at most size bytes.
+        the frame header must be read by recv_frame_header first.
+        return value: unmasked memoryview, valid until the next read.
+        """
+        with self.lock:
+            n = min(size, self.length - self.filled)
+            chunk = self.recv_reader(n)
+            if self.mask:
+                mask_inplace(self.mask, chunk, self.filled)
+            self.filled += n
+            if self.filled == self.length:
+                self.clear()
+        return chunk
+
+    @staticmethod
+    def _need_data(buf):
+        raise _NeedData()
+
+    def next_frame(self, max_length=None):
+        """
+        sans-IO: parse the next frame from the pushed bytes.
+        return value: ABNF frame object, None if more bytes are needed.
+        """
+        try:
+            return self.recv_frame(max_length)
+        except _NeedData:
+            return None
+
+    def get_buffer(self):
+        """
+        sans-IO: writable memoryview to receive the next bytes into.
+        call buffer_updated with the count written.
+        (same contract as asyncio.BufferedProtocol.get_buffer)
+        """
+        if self.payload is not None and self.start == self.end and \
+                self.filled < len(self.payload):
+            # a big payload is waiting, receive straight into it.
+            self._lent_payload = True
+            return memoryview(self.payload)[self.filled:]
+        self._lent_payload = False
+        self._reserve(self.end - self.start + 1024)
+        return self.view[self.end:]
+
+    def buffer_updated(self, nbytes):
+        if self._lent_payload:
+            self.filled += nbytes
+        else:
+            self.end += nbytes
+
+    def feed(self, data):
+        """
+        sans-IO: push received bytes.
+        """
+        data = memoryview(data).cast("B")
+        while data:
+            buf = self.get_buffer()
+            n = min(len(buf), len(data))
+            buf[:n] = data[:n]
+            self.buffer_updated(n)
+            data = data[n:]
+
     def has_header(self):
         return self.header is None
-    
+
     def recv_header(self):
         header = self.recv_reader(2)
 
-        b1 = header[0][0]
+        b1 = header[0]
 
         fin = b1 >> 7 & 1
         rsv1 = b1 >> 6 & 1
@@ -203,50 +434,171 @@ class frame_buffer():
         rsv3 = b1 >> 4 & 1
         opcode = b1 & 0xf
 
-        b2 = header[0][1]
+        b2 = header[1]
         has_mask = (b2 >> 7) & 1
         length_bits = b2 & 0x7f
 
         self.header = (fin, rsv1, rsv2, rsv3, opcode, has_mask, length_bits)
-    
+
     def has_length(self):
         return self.length is None
-    
+
     def recv_length(self):
         bits = self.header[frame_buffer._HEADER_LENGTH_INDEX]
         length_bits = bits & 0x7f
         if length_bits == 0x7e:
             r = self.recv_reader(2)
-            self.length = struct.unpack("!H", r)[0]
+            self.length = struct.unpack_from("!H", r)[0]
         elif length_bits == 0x7f:
             v = self.recv_reader(8)
-            self.length = struct.unpack("!Q", v)[0]
+            self.length = struct.unpack_from("!Q", v)[0]
         else:
             self.length = length_bits
 
     def has_mask(self):
         return self.mask is None
-    
+
     def recv_mask(self):
         if not self.header:
             self.mask = ""
         else:
-            self.mask = self.recv_reader(4) 
+            # keep a copy, the ring may be compacted while reading the payload.
+            self.mask = bytes(self.recv_reader(4))
 
+    def recv_payload(self, length):
+        """
+        receive payload of the frame.
+        return value: bytearray owned by the caller.
+        """
+        if self.payload is None:
+            if length < frame_buffer._DIRECT_PAYLOAD_SIZE:
+                return bytearray(self.recv_reader(length))
+            # big payload: copy what is already buffered once,
+            # then let the kernel write the rest directly into it.
+            self.payload = bytearray(length)
+
+        view = memoryview(self.payload)
+        while self.filled < length:
+            buffered = min(self.end - self.start, length - self.filled)
+            if buffered:
+                view[self.filled:self.filled + buffered] = self.view[self.start:self.start + buffered]
+                self._consume(buffered)
+                self.filled += buffered
+            else:
+                self.filled += self.recv_into(view[self.filled:])
+        return self.payload
 
     def recv_reader(self, bufsize):
-        shortage = bufsize - sum(len(x) for x in self.recv_buffer)
-        while shortage > 0:
-            bytedatas = self.recv(min(16384, shortage))
-            self.recv_buffer.append(bytedatas)
-            shortage -=len(bytedatas)
-        
-        unified = self.recv_buffer
-
-        if shortage == 0:
-            self.recv_buffer = []
-            return unified
+        """
+        read bufsize bytes from the ring.
+        return value: memoryview, valid until the next read.
+        surplus bytes of the next frame are kept in the ring.
+        """
+        if self.end - self.start < bufsize:
+            self._reserve(max(bufsize, self.read_size))
+            while self.end - self.start < bufsize:
+                self.end += self.recv_into(self.view[self.end:])
+
+        view = self.view[self.start:self.start + bufsize]
+        self._consume(bufsize)
+        return view
+
+    def _consume(self, bufsize):
+        self.start += bufsize
+        if self.start == self.end:
+            self.start = self.end = 0
+
+    def _reserve(self, bufsize):
+        # make self.buffer[self.start:self.start + bufsize] writable space.
+        if self.start + bufsize <= len(self.buffer):
+            return
+        pending = self.end - self.start
+        if bufsize > len(self.buffer):
+            size = len(self.buffer)
+            while size < bufsize:
+                size *= 2
+            buffer = bytearray(size)
+            buffer[:pending] = self.view[self.start:self.end]
+            self.buffer = buffer
+            self.view = memoryview(buffer)
         else:
-            self.recv_buffer = [unified[bufsize:]]
-            return unified[:bufsize]
+            # move unread bytes to the head. memoryview copy handles overlap.
+            self.view[:pending] = self.view[self.start:self.end]
+        self.start = 0
+        self.end = pending
 
+
+class continuous_frame():
+    """
+    assemble fragmented message into one buffer.
+    see http://tools.ietf.org/html/rfc6455#section-5.4
+    """
+    _INITIAL_BUFSIZE = 4096
+
+    def __init__(self, max_size=None):
+        # message size limit, None is unlimited.
+        self.max_size = max_size
+        self.reset()
+
+    def reset(self):
+        self.opcode = None
+        self.buffer = None
+        self.length = 0
+
+    def validate(self, frame):
+        if self.opcode is None and frame.opcode == ABNF.OPCODE_CONT:
+            raise WebSocketProtocolException("Illegal frame: no message to continue")
+        if self.opcode is not None and frame.opcode != ABNF.OPCODE_CONT:
+            raise WebSocketProtocolException("Illegal frame: previous message is not finished")
+
+    def remaining(self):
+        """
+        bytes the current message may still grow, None is unlimited.
+        """
+        if self.max_size is None:
+            return None
+        return self.max_size - self.length
+
+    def add(self, frame):
+        size = self.length + len(frame.data)
+        if self.max_size is not None and size > self.max_size:
+            raise WebSocketProtocolException(
+                "message is too big: %d" % size, STATUS_MESSAGE_TOO_BIG)
+        if self.opcode is None:
+            if frame.fin:
+                # not fragmented, frame.data is returned as is.
+                return
+            self.opcode = frame.opcode
+            capacity = max(continuous_frame._INITIAL_BUFSIZE, 2 * size)
+            if self.max_size is not None:
+                capacity = min(capacity, self.max_size)
+            self.buffer = bytearray(capacity)
+
+        if size > len(self.buffer):
+            # grow x2, but never over the limit
+            capacity = max(size, 2 * len(self.buffer))
+            if self.max_size is not None:
+                capacity = min(capacity, self.max_size)
+            buffer = bytearray(capacity)
+            buffer[:self.length] = memoryview(self.buffer)[:self.length]
+            self.buffer = buffer
+        self.buffer[self.length:size] = frame.data
+        self.length = size
+
+    def is_fire(self, frame):
+        return frame.fin
+
+    def extract(self, frame):
+        """
+        return value: tuple of operation code and the assembled frame.
+        """
+        if self.opcode is None:
+            return frame.opcode, frame
+        opcode = self.opcode
+        data = self.buffer
+        # trim unused capacity in place, no copy.
+        del data[self.length:]
+        self.reset()
+        frame.opcode = opcode
+        frame.data = data
+        return opcode, frame
@@ -0,0 +1,300 @@
+import asyncio
+import time
+from collections import deque
+
+from util_http import parse_url, parse_headers, default_ssl_context, MAX_HEADER_SIZE
+from handshark import handshake_request, handshake_result
+from abnf import ABNF, WebSocketProtocolException, STATUS_NORMAL
+from protocol import websocket_core
+
+# receive buffer of one connection. small so that 10k connections fit,
+# it grows when a bigger frame comes.
+ASYNC_BUFSIZE = 4096
+
+
+class _client_protocol(asyncio.BufferedProtocol):
+    """
+    asyncio side of AsyncWebSocket. received bytes go straight into the
+    frame_buffer of the connection(no intermediate bytes objects).
+    """
+
+    def __init__(self, websock):
+        self.websock = websock
+        self.transport = None
+        loop = asyncio.get_event_loop()
+        # upgrade response, until the empty line is found.
+        self.header_buffer = bytearray(1024)
+        self.header_length = 0
+        self.handshake_done = loop.create_future()
+        self.closed = loop.create_future()
+        self.write_paused = False
+        self.drain_waiter = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def get_buffer(self, sizehint):
+        if self.header_buffer is not None:
+            if self.header_length == len(self.header_buffer):
+                if len(self.header_buffer) >= MAX_HEADER_SIZE:
+                    raise Exception("Handshake header is too long")
+                self.header_buffer += bytes(len(self.header_buffer))
+            return memoryview(self.header_buffer)[self.header_length:]
+        return self.websock.frame_buffer.get_buffer()
+
+    def buffer_updated(self, nbytes):
+        stats = self.websock.stats
+        if stats is not None:
+            # one buffer_updated is one recv on the socket
+            stats.recv_calls += 1
+            stats.recv_bytes += nbytes
+        if self.header_buffer is None:
+            self.websock.frame_buffer.buffer_updated(nbytes)
+            self.websock._on_data()
+            return
+
+        start = max(0, self.header_length - 3)
+        self.header_length += nbytes
+        end = self.header_buffer.find(b"\r\n\r\n", start, self.header_length)
+        if end < 0:
+            return
+        header = bytes(self.header_buffer[:end + 4])
+        # frames sent right after the upgrade response.
+        self.websock.frame_buffer.feed(memoryview(self.header_buffer)[end + 4:self.header_length])
+        self.header_buffer = None
+        try:
+            self.handshake_done.set_result(parse_headers(header))
+        except Exception as e:
+            self.handshake_done.set_exception(e)
+
+    def pause_writing(self):
+        self.write_paused = True
+
+    def resume_writing(self):
+        self.write_paused = False
+        if self.drain_waiter and not self.drain_waiter.done():
+            self.drain_waiter.set_result(None)
+
+    def connection_lost(self, exc):
+        error = exc or Exception("Connection is already closed.")
+        if not self.handshake_done.done():
+            self.handshake_done.set_exception(error)
+        if self.drain_waiter and not self.drain_waiter.done():
+            self.drain_waiter.set_exception(error)
+        if not self.closed.done():
+            self.closed.set_result(None)
+        self.websock._on_lost()
+
+
+class AsyncWebSocket(websocket_core):
+    """
+    asyncio WebSocket client. it shares frame parsing, message assembly
+    and permessage-deflate with WebSocket through websocket_core, only
+    the IO is asyncio.
+
+    ws = await connect("ws://localhost:5001/")
+    await ws.send("Hello")
+    async for message in ws:
+        print(message)
+    """
+
+    def __init__(self, max_message_size=None, max_queue=64, stats=False):
+        """
+        max_queue: received messages kept until recv, reading from
+            the socket pauses while the queue is full.
+        stats: collect ws_stats from the start(see enable_stats).
+        """
+        super().__init__(None, max_message_size, ASYNC_BUFSIZE)
+        self.transport = None
+        self.protocol = None
+        self.max_queue = max_queue
+        self.messages = deque()
+        self._recv_waiter = None
+        self._read_paused = False
+        if stats:
+            self.enable_stats()
+
+    def enable_stats(self):
+        if self.stats is None:
+            stats = super().enable_stats()
+            stats.gauges["recv_queue_messages"] = lambda: len(self.messages)
+            stats.gauges["send_buffer_bytes"] = lambda: \
+                self.transport.get_write_buffer_size() if self.transport else 0
+        return self.stats
+
+    async def connect(self, url, **options):
+        """
+        options: handshake options and ssl_context(SSLContext for wss,
+            util_http.default_ssl_context() if not given).
+        """
+        hostname, port, resource, is_secure = parse_url(url)
+        loop = asyncio.get_event_loop()
+        tls = {}
+        if is_secure:
+            tls = {"ssl": options.get("ssl_context") or default_ssl_context(),
+                   "server_hostname": hostname}
+        self.transport, self.protocol = await loop.create_connection(
+            lambda: _client_protocol(self), hostname, port, **tls)
+        try:
+            start = time.perf_counter()
+            request, _ = handshake_request(hostname, port, resource, **options)
+            self.transport.write(request)
+            status, resp, status_message = await self.protocol.handshake_done
+            self._set_handshake(handshake_result(status, resp, status_message, **options))
+            if self.stats is not None:
+                self.stats.handshake_seconds = time.perf_counter() - start
+            self.connected = True
+        except BaseException:
+            self.transport.close()
+            raise
+        # frames which came with the upgrade response
+        self._on_data()
+
+    def _on_data(self):
+        """
+        parse everything received so far.
+        """
+        while self.connected:
+            try:
+                frame = self.frame_buffer.next_frame(self._frame_limit())
+                if frame is None:
+                    break
+                result = self.process_frame(frame)
+            except WebSocketProtocolException as e:
+                self._fail(e)
+                return
+            if result is None:
+                continue
+
+            opcode, frame = result
+            if opcode == ABNF.OPCODE_PING:
+                self._write_frame(ABNF.create_frame(frame.data, ABNF.OPCODE_PONG))
+            elif opcode == ABNF.OPCODE_CLOSE:
+                self._write_frame(ABNF.create_frame(self.close_payload(), ABNF.OPCODE_CLOSE))
+                self.connected = False
+                self.transport.close()
+            elif opcode in (ABNF.OPCODE_TEXT, ABNF.OPCODE_BINARY):
+                # text is already decoded by process_frame
+                self.messages.append(frame.text if opcode == ABNF.OPCODE_TEXT else frame.data)
+                if len(self.messages) >= self.max_queue and not self._read_paused:
+                    self._read_paused = True
+                    self.transport.pause_reading()
+        self._wakeup()
+
+    def _on_lost(self):
+        self.connected = False
+        self._wakeup()
+
+    def _wakeup(self):
+        if self._recv_waiter and not self._recv_waiter.done():
+            self._recv_waiter.set_result(None)
+
+    def _fail(self, e):
+        """
+        close the connection with the status of a protocol error.
+        """
+        try:
+            self._write_frame(ABNF.create_frame(
+                self.close_payload(e.status, str(e)[:120]), ABNF.OPCODE_CLOSE))
+        finally:
+            self.connected = False
+            self.transport.close()
+
+    def _send_ping(self, payload):
+        self._write_frame(ABNF.create_frame(payload, ABNF.OPCODE_PING))
+
+    def _abort(self, status, reason=""):
+        self.close_status = status
+        self.connected = False
+        self.transport.abort()
+
+    async def recv(self):
+        """
+        Receive string data(byte array) from the server.
+        return value: str for text, bytearray for binary.
+        """
+        while not self.messages:
+            if not self.connected:
+                raise Exception("Connection is already closed.")
+            self._recv_waiter = asyncio.get_event_loop().create_future()
+            await self._recv_waiter
+
+        message = self.messages.popleft()
+        if self._read_paused and len(self.messages) <= self.max_queue // 2:
+            self._read_paused = False
+            self.transport.resume_reading()
+        return message
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        try:
+            return await self.recv()
+        except Exception:
+            if self.connected or self.messages:
+                raise
+            raise StopAsyncIteration
+
+    async def send(self, payload, opcode=ABNF.OPCODE_TEXT):
+        frame = ABNF.create_frame(payload, opcode)
+        return await self.send_frame(frame)
+
+    async def send_frame(self, frame):
+        length = self._write_frame(frame)
+        await self._drain()
+        return length
+
+    def _write_frame(self, frame):
+        if self.transport.is_closing():
+            raise Exception("socket is already closed.")
+        # no await between encoding and writing, so the compression
+        # context keeps the wire order.
+        buffers = self.prepare_frame(frame)
+        self.transport.writelines(buffers)
+        length = sum(len(b) for b in buffers)
+        if self.stats is not None:
+            self.stats.send_calls += 1
+            self.stats.send_bytes += length
+        return length
+
+    async def _drain(self):
+        if self.protocol.write_paused:
+            self.protocol.drain_waiter = asyncio.get_event_loop().create_future()
+            await self.protocol.drain_waiter
+
+    async def ping(self, payload=""):
+        if isinstance(payload, str):
+            payload = payload.encode("utf-8")
+        await self.send(payload, ABNF.OPCODE_PING)
+
+    async def pong(self, payload):
+        if isinstance(payload, str):
+            payload = payload.encode("utf-8")
+        await self.send(payload, ABNF.OPCODE_PONG)
+
+    async def close(self, status=STATUS_NORMAL, reason="", timeout=3):
+        """
+        send close frame and wait the server to close the connection.
+        """
+        if self.connected:
+            self.connected = False
+            self._write_frame(ABNF.create_frame(
+                self.close_payload(status, reason), ABNF.OPCODE_CLOSE))
+            try:
+                await asyncio.wait_for(asyncio.shield(self.protocol.closed), timeout)
+            except asyncio.TimeoutError:
+                pass
+        self.transport.close()
+
+
+async def connect(url, max_message_size=None, stats=False, keepalive=None, **options):
+    """
+    connect to url and return AsyncWebSocket.
+    keepalive: keepalive started on the running loop(keepalive.start(loop)).
+    """
+    websock = AsyncWebSocket(max_message_size, stats=stats)
+    await websock.connect(url, **options)
+    if keepalive is not None:
+        keepalive.add(websock)
+    return websock
@@ -0,0 +1,375 @@
+import argparse
+import asyncio
+import json
+import os
+import platform
+import socket
+import subprocess
+import sys
+import time
+
+from abnf import ABNF, frame_buffer
+from masking import load_numpy
+from async_websock import connect
+
+KB = 1024
+MB = 1024 * 1024
+DEFAULT_SIZES = [0, 16, 125, KB, 64 * KB, MB, 16 * MB, 64 * MB]
+DEFAULT_CONNECTIONS = [1, 10, 100]
+# payload bytes in flight of one net case. every connection holds its own
+# masked copy and echo of a message, so big sizes run with fewer connections
+# (64MB x 100 would be 6.4GB each way).
+NET_MAX_INFLIGHT = 256 * MB
+DEFAULT_IMPORT_MODULES = ["websock", "async_websock", "multiplex", "pool"]
+
+
+def _parse_sizes(value):
+    sizes = []
+    for s in value.split(","):
+        s = s.strip().lower()
+        unit = 1
+        if s.endswith("k"):
+            unit, s = KB, s[:-1]
+        elif s.endswith("m"):
+            unit, s = MB, s[:-1]
+        sizes.append(int(s) * unit)
+    return sizes
+
+
+def _percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def _timeit(fn, min_time):
+    """
+    seconds per call of fn, repeated until min_time passed.
+    """
+    n = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(n):
+            fn()
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_time:
+            return elapsed / n, n
+        n = max(n * 2, int(n * min_time / max(elapsed, 1e-9)))
+
+
+class _memory_source(object):
+    """
+    recv_into over a fixed byte string repeated forever,
+    stands in for the socket in frame_buffer benchmarks.
+    """
+
+    def __init__(self, data):
+        self.view = memoryview(data)
+        self.pos = 0
+
+    def recv_into(self, buf):
+        n = min(len(buf), len(self.view) - self.pos)
+        buf[:n] = self.view[self.pos:self.pos + n]
+        self.pos = (self.pos + n) % len(self.view)
+        return n
+
+
+def _codec_result(name, size, mask, seconds, n):
+    return {
+        "bench": name,
+        "size": size,
+        "masked": mask,
+        "iterations": n,
+        "us_per_op": seconds * 1e6,
+        "mb_per_sec": size / seconds / MB if size else None,
+    }
+
+
+def bench_codec(sizes, min_time=0.2):
+    """
+    codec only microbenchmarks of ABNF.formating, ABNF.mask and
+    frame_buffer.recv_frame.
+    """
+    results = []
+    key = os.urandom(4)
+    for size in sizes:
+        payload = os.urandom(size)
+        for mask in (0, 1):
+            frame = ABNF(1, 0, 0, 0, ABNF.OPCODE_BINARY, mask, payload)
+            results.append(_codec_result(
+                "ABNF.formating", size, mask, *_timeit(frame.formating, min_time)))
+            results.append(_codec_result(
+                "ABNF.formating_buffers", size, mask, *_timeit(frame.formating_buffers, min_time)))
+
+            source = _memory_source(bytes(frame.formating()))
+            buffer = frame_buffer(source.recv_into)
+            results.append(_codec_result(
+                "frame_buffer.recv_frame", size, mask, *_timeit(buffer.recv_frame, min_time)))
+
+        data = bytearray(payload)
+        results.append(_codec_result(
+            "ABNF.mask", size, 1, *_timeit(lambda: ABNF.mask(key, data), min_time)))
+    return results
+
+
+async def _net_case(url, size, opcode, connections, duration):
+    if opcode == ABNF.OPCODE_TEXT:
+        payload = "x" * size
+    else:
+        payload = os.urandom(size)
+    clients = await asyncio.gather(*[connect(url) for _ in range(connections)])
+    latencies = []
+    deadline = time.perf_counter() + duration
+
+    async def run(ws):
+        n = 0
+        while True:
+            start = time.perf_counter()
+            await ws.send(payload, opcode)
+            await ws.recv()
+            end = time.perf_counter()
+            latencies.append(end - start)
+            n += 1
+            if end >= deadline:
+                return n
+
+    start = time.perf_counter()
+    counts = await asyncio.gather(*[run(ws) for ws in clients])
+    elapsed = time.perf_counter() - start
+    await asyncio.gather(*[ws.close() for ws in clients])
+
+    messages = sum(counts)
+    p50 = _percentile(latencies, 50)
+    p99 = _percentile(latencies, 99)
+    return {
+        "bench": "echo",
+        "size": size,
+        "type": ABNF.OPCODE_MAP[opcode],
+        "connections": connections,
+        "messages": messages,
+        "seconds": elapsed,
+        "messages_per_sec": messages / elapsed,
+        # one direction
+        "mb_per_sec": messages * size / elapsed / MB,
+        "p50_ms": p50 * 1000,
+        "p99_ms": p99 * 1000,
+    }
+
+
+async def _handshake_case(url, connections, total):
+    done = 0
+
+    async def run():
+        nonlocal done
+        while done < total:
+            done += 1
+            ws = await connect(url)
+            await ws.close()
+
+    start = time.perf_counter()
+    await asyncio.gather(*[run() for _ in range(connections)])
+    elapsed = time.perf_counter() - start
+    return {
+        "bench": "handshake",
+        "connections": connections,
+        "handshakes": done,
+        "seconds": elapsed,
+        "handshakes_per_sec": done / elapsed,
+    }
+
+
+def bench_net(url, sizes, connections, duration, handshakes, baseline=None):
+    """
+    load against an echo server: messages/sec, MB/sec, round trip latency
+    and handshakes/sec. connections of a size are capped to
+    NET_MAX_INFLIGHT bytes in flight.
+    """
+    async def run():
+        results = []
+        done = set()
+        for conns in connections:
+            for size in sizes:
+                capped = max(1, min(conns, NET_MAX_INFLIGHT // max(size, 1)))
+                if (capped, size) in done:
+                    continue
+                done.add((capped, size))
+                for opcode in (ABNF.OPCODE_TEXT, ABNF.OPCODE_BINARY):
+                    results.append(await _net_case(url, size, opcode, capped, duration))
+                    _print_result(results[-1], baseline)
+            results.append(await _handshake_case(url, conns, handshakes))
+            _print_result(results[-1], baseline)
+        return results
+    return asyncio.run(run())
+
+
+def _import_us(module):
+    """
+    microseconds importing module takes in a new interpreter, from
+    python -X importtime(interpreter startup is not counted).
+    """
+    here = os.path.dirname(os.path.abspath(__file__))
+    proc = subprocess.run([sys.executable, "-X", "importtime", "-c", "import " + module],
+                          cwd=here, stderr=subprocess.PIPE, universal_newlines=True, check=True)
+    for line in reversed(proc.stderr.splitlines()):
+        fields = line.split("|")
+        if len(fields) == 3 and fields[2].strip() == module:
+            return int(fields[1])
+    raise Exception("no import time of %s" % module)
+
+
+def bench_import(modules, runs=7, baseline=None):
+    """
+    import time of the client modules, median of runs. heavy modules
+    (numpy, ssl) must not come back into the import path.
+    """
+    results = []
+    for module in modules:
+        times = sorted(_import_us(module) for _ in range(runs))
+        results.append({
+            "bench": "import",
+            "module": module,
+            "runs": runs,
+            "us_per_op": times[len(times) // 2],
+        })
+        _print_result(results[-1], baseline)
+    return results
+
+
+def _free_port():
+    s = socket.socket()
+    s.bind(("127.0.0.1", 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+
+def start_echo_server():
+    """
+    start server_ws.py --echo in another process(no GIL sharing with the clients).
+    return value: tuple of Popen and url.
+    """
+    port = _free_port()
+    here = os.path.dirname(os.path.abspath(__file__))
+    proc = subprocess.Popen([sys.executable, os.path.join(here, "server_ws.py"), "--echo", str(port)])
+    deadline = time.time() + 10
+    while True:
+        try:
+            socket.create_connection(("127.0.0.1", port), 1).close()
+            break
+        except OSError:
+            if time.time() > deadline or proc.poll() is not None:
+                proc.kill()
+                raise Exception("echo server did not start")
+            time.sleep(0.05)
+    return proc, "ws://127.0.0.1:%d/" % port
+
+
+def _result_key(r):
+    return tuple((k, r[k]) for k in ("bench", "module", "size", "masked", "type", "connections")
+                 if k in r)
+
+
+def _metric(r):
+    for k in ("mb_per_sec", "messages_per_sec", "handshakes_per_sec"):
+        if r.get(k):
+            return k, r[k]
+    return "us_per_op", -r["us_per_op"]
+
+
+def _change(r, baseline):
+    """
+    return value: tuple of metric name and change from baseline in
+        percent(positive is better), None if not in baseline.
+    """
+    old = baseline.get(_result_key(r)) if baseline else None
+    if not old:
+        return None
+    name, new_value = _metric(r)
+    _, old_value = _metric(old)
+    return name, (new_value - old_value) / abs(old_value) * 100
+
+
+def _print_result(r, baseline=None):
+    fields = " ".join("%s=%s" % (k, ("%.3f" % v) if isinstance(v, float) else v)
+                      for k, v in r.items())
+    change = _change(r, baseline)
+    if change:
+        fields += " change(%s)=%+.1f%%" % change
+    print(fields)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="websock benchmark")
+    parser.add_argument("mode", choices=("codec", "net", "import", "all"), nargs="?", default="all")
+    parser.add_argument("--sizes", type=_parse_sizes, default=DEFAULT_SIZES,
+                        help="payload sizes, e.g. 0,1k,64k,1m,64m")
+    parser.add_argument("--connections", default=",".join(map(str, DEFAULT_CONNECTIONS)),
+                        help="concurrent connections, e.g. 1,10,100")
+    parser.add_argument("--duration", type=float, default=2.0, help="seconds per net case")
+    parser.add_argument("--handshakes", type=int, default=200, help="handshakes per case")
+    parser.add_argument("--min-time", type=float, default=0.2, help="seconds per codec case")
+    parser.add_argument("--url", help="echo server to use instead of the bundled one")
+    parser.add_argument("--json", help="write results to this file")
+    parser.add_argument("--baseline", help="json of a previous run to compare with")
+    parser.add_argument("--modules", default=",".join(DEFAULT_IMPORT_MODULES),
+                        help="modules of the import benchmark")
+    parser.add_argument("--max-import-regression", type=float, default=None,
+                        help="exit 1 when an import got slower than baseline by this percent")
+    args = parser.parse_args()
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            old = json.load(f)
+        baseline = {_result_key(r): r
+                    for r in old.get("codec", []) + old.get("net", []) + old.get("import", [])}
+
+    results = {
+        "meta": {
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "numpy": getattr(load_numpy(), "__version__", None),
+        },
+        "codec": [],
+        "net": [],
+        "import": [],
+    }
+
+    if args.mode in ("import", "all"):
+        results["import"] = bench_import(args.modules.split(","), baseline=baseline)
+
+    if args.mode in ("codec", "all"):
+        results["codec"] = bench_codec(args.sizes, args.min_time)
+        for r in results["codec"]:
+            _print_result(r, baseline)
+
+    if args.mode in ("net", "all"):
+        connections = [int(c) for c in args.connections.split(",")]
+        proc = None
+        url = args.url
+        if not url:
+            proc, url = start_echo_server()
+        try:
+            results["net"] = bench_net(url, args.sizes, connections, args.duration,
+                                       args.handshakes, baseline)
+        finally:
+            if proc:
+                proc.terminate()
+                proc.wait()
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+    if args.max_import_regression is not None:
+        slower = [r["module"] for r in results["import"]
+                  if (_change(r, baseline) or ("", 0))[1] < -args.max_import_regression]
+        if slower:
+            print("import time regressed: %s" % ", ".join(slower))
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
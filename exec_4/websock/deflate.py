@@ -0,0 +1,114 @@
+import zlib
+from abnf import WebSocketProtocolException, STATUS_INVALID_EXTENSION, \
+    STATUS_INVALID_PAYLOAD, STATUS_MESSAGE_TOO_BIG
+
+# see https://tools.ietf.org/html/rfc7692
+EXTENSION_NAME = "permessage-deflate"
+# every flushed message ends with this empty stored block, it is not sent.
+_EMPTY_BLOCK = b"\x00\x00\xff\xff"
+
+
+class PerMessageDeflate(object):
+    """
+    permessage-deflate extension state of one connection.
+    compressor/decompressor keep their LZ77 window between messages
+    (context takeover) unless no_context_takeover is negotiated.
+    """
+
+    def __init__(self, client_max_window_bits=15, server_max_window_bits=15,
+                 client_no_context_takeover=False, server_no_context_takeover=False,
+                 level=zlib.Z_DEFAULT_COMPRESSION):
+        self.client_max_window_bits = client_max_window_bits
+        self.server_max_window_bits = server_max_window_bits
+        self.client_no_context_takeover = client_no_context_takeover
+        self.server_no_context_takeover = server_no_context_takeover
+        self.level = level
+        self.compressor = None
+        self.decompressor = None
+
+    @staticmethod
+    def offer():
+        """
+        Sec-WebSocket-Extensions value sent in the handshake request.
+        """
+        return "%s; client_max_window_bits" % EXTENSION_NAME
+
+    @classmethod
+    def from_params(cls, params, **options):
+        """
+        create from the parameters the server accepted.
+        params: dict of parameter name to value(True if no value).
+        """
+        kwargs = {}
+        for key, value in params.items():
+            if key in ("client_no_context_takeover", "server_no_context_takeover"):
+                if value is not True:
+                    raise WebSocketProtocolException(
+                        "%s must not have a value" % key, STATUS_INVALID_EXTENSION)
+                kwargs[key] = True
+            elif key in ("client_max_window_bits", "server_max_window_bits"):
+                try:
+                    bits = int(value)
+                except (TypeError, ValueError):
+                    raise WebSocketProtocolException(
+                        "invalid %s: %s" % (key, value), STATUS_INVALID_EXTENSION)
+                # zlib can not compress with a 256 byte window.
+                low = 9 if key == "client_max_window_bits" else 8
+                if not low <= bits <= 15:
+                    raise WebSocketProtocolException(
+                        "unsupported %s: %d" % (key, bits), STATUS_INVALID_EXTENSION)
+                kwargs[key] = bits
+            else:
+                raise WebSocketProtocolException(
+                    "unknown %s parameter: %s" % (EXTENSION_NAME, key), STATUS_INVALID_EXTENSION)
+        kwargs.update(options)
+        return cls(**kwargs)
+
+    def params(self):
+        """
+        negotiated parameters as keyword arguments of the constructor.
+        """
+        return {
+            "client_max_window_bits": self.client_max_window_bits,
+            "server_max_window_bits": self.server_max_window_bits,
+            "client_no_context_takeover": self.client_no_context_takeover,
+            "server_no_context_takeover": self.server_no_context_takeover,
+        }
+
+    def compress(self, data):
+        """
+        compress one whole message payload.
+        """
+        if self.compressor is None:
+            self.compressor = zlib.compressobj(
+                self.level, zlib.DEFLATED, -self.client_max_window_bits)
+        data = self.compressor.compress(data) + self.compressor.flush(zlib.Z_SYNC_FLUSH)
+        if data.endswith(_EMPTY_BLOCK):
+            data = data[:-4]
+        if self.client_no_context_takeover:
+            self.compressor = None
+        return data
+
+    def decompress(self, data, fin=True, max_length=None):
+        """
+        decompress one fragment of a compressed message.
+        fin: True for the last fragment of the message.
+        max_length: limit of the decompressed size, None is unlimited.
+        """
+        if self.decompressor is None:
+            self.decompressor = zlib.decompressobj(-max(9, self.server_max_window_bits))
+        # zlib max_length 0 is unlimited. stop one byte over the limit(zip bomb)
+        limit = 0 if max_length is None else max_length + 1
+        try:
+            data = self.decompressor.decompress(data, limit)
+            if fin and (not limit or len(data) < limit):
+                data += self.decompressor.decompress(_EMPTY_BLOCK, limit and limit - len(data))
+        except zlib.error as e:
+            raise WebSocketProtocolException(
+                "invalid compressed data: %s" % e, STATUS_INVALID_PAYLOAD)
+        if max_length is not None and len(data) > max_length:
+            raise WebSocketProtocolException(
+                "message is too big", STATUS_MESSAGE_TOO_BIG)
+        if fin and self.server_no_context_takeover:
+            self.decompressor = None
+        return data
@@ -1,16 +1,23 @@
 import os
+import hashlib
 from base64 import encodebytes
-from util_http import * 
+from util_http import send, read_headers
+from abnf import WebSocketProtocolException, STATUS_INVALID_EXTENSION
+from deflate import PerMessageDeflate, EXTENSION_NAME
 from http import HTTPStatus
 # websocket supported version.
 VERSION = 13
 SUPPORTED_REDIRECT_STATUSES = [HTTPStatus.MOVED_PERMANENTLY, HTTPStatus.FOUND, HTTPStatus.SEE_OTHER]
+# see http://tools.ietf.org/html/rfc6455#section-1.3
+ACCEPT_GUID = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
 
 class handshake_response(object):
-    def __init__(self, status, headers, subprotocol):
+    def __init__(self, status, headers, subprotocol, deflate=None):
         self.status = status
         self.headers = headers
         self.subprotocol = subprotocol
+        # PerMessageDeflate if the server accepted it
+        self.deflate = deflate
 
 def _get_handshake_header(resource, host, port, options):
     headers = [
@@ -23,7 +30,8 @@ def _get_handshake_header(resource, host, port, options):
     headers.append("Host: %s" % hostport)
     headers.append("Sec-WebSocket-Version: %s" % VERSION)
     headers.append("Sec-WebSocket-Key: %s" % key)
-    headers.append("Sec-WebSocket-Extensions: permessage-deflate; client_max_window_bits")
+    if options.get("compression", True):
+        headers.append("Sec-WebSocket-Extensions: %s" % PerMessageDeflate.offer())
     if "subprotocols" in options:
         headers.append("Sec-WebSocket-Protocol: %s" % ",".join(options["subprotocols"]))
 
@@ -36,12 +44,35 @@ def _pack_hostname(hostname):
 
     return hostname
 
-def handshake(sock, host, port, resource, **options):
-    headers, _ = _get_handshake_header(resource, host, port, options)
+def handshake(sock, host, port, resource, recv_buffer=None, **options):
+    """
+    recv_buffer: frame_buffer of the connection. frames the server sent
+        right after the response are pushed into it.
+    """
+    request, _ = handshake_request(host, port, resource, **options)
+    send(sock, request)
+    status, resp, status_message, surplus = read_headers(sock)
+    if surplus and recv_buffer is not None:
+        recv_buffer.feed(surplus)
+    return handshake_result(status, resp, status_message, **options)
+
+def handshake_request(host, port, resource, **options):
+    """
+    sans-IO: bytes of the upgrade request.
+    return value: tuple of request bytes and Sec-WebSocket-Key.
+    """
+    headers, key = _get_handshake_header(resource, host, port, options)
     header_str = "\r\n".join(headers)
     header_str += "\r\n\r\n"
-    send(sock, header_str.encode('utf-8'))
-    status, resp = _get_resp_headers(sock)
+    return header_str.encode('utf-8'), key
+
+def handshake_result(status, resp, status_message, success_statuses=(101, 301, 302, 303), **options):
+    """
+    sans-IO: check the upgrade response and negotiate extensions.
+    return value: handshake_response
+    """
+    if status not in success_statuses:
+        raise Exception("Handshake status %d %s" % (status, status_message), resp)
 
     if status in SUPPORTED_REDIRECT_STATUSES:
         return handshake_response(status, resp, None)
@@ -49,14 +80,75 @@ def handshake(sock, host, port, resource, **options):
     # TODO:: check status validate!
     
     subprotocols = options["subprotocols"] if "subprotocols" in options else None
-    return handshake_response(status, resp, subprotocols)
+    deflate = _negotiate_extensions(resp, options)
+    return handshake_response(status, resp, subprotocols, deflate)
+
+def server_handshake(method, resource, headers):
+    """
+    sans-IO server side: check the upgrade request of a client.
+    extensions are not accepted.
+    return value: bytes of the 101 response.
+    """
+    if method != "GET":
+        raise Exception("Invalid handshake method %s" % method)
+    if headers.get("upgrade", "").lower() != "websocket":
+        raise Exception("Invalid upgrade header")
+    if "upgrade" not in headers.get("connection", "").lower():
+        raise Exception("Invalid connection header")
+    if headers.get("sec-websocket-version") != str(VERSION):
+        raise Exception("Unsupported websocket version")
+    key = headers.get("sec-websocket-key")
+    if not key:
+        raise Exception("Sec-WebSocket-Key is missing")
+
+    response = [
+        "HTTP/1.1 101 Switching Protocols",
+        "Upgrade: websocket",
+        "Connection: Upgrade",
+        "Sec-WebSocket-Accept: %s" % _create_sec_websocket_accept(key)
+    ]
+    return ("\r\n".join(response) + "\r\n\r\n").encode("utf-8")
+
+def _create_sec_websocket_accept(key):
+    digest = hashlib.sha1((key + ACCEPT_GUID).encode("utf-8")).digest()
+    return encodebytes(digest).decode("utf-8").strip()
 
 def _create_sec_websocket_key():
     randomness = os.urandom(16)
     return encodebytes(randomness).decode('utf-8').strip()
 
-def _get_resp_headers(sock, success_statuses=(101, 301, 302, 303)):
-    status, resp_headers, status_message = read_headers(sock)
-    if status not in success_statuses:
-        raise Exception("Handshake status %d %s", status, status_message, resp_headers)
-    return status, resp_headers
+def _parse_extensions(value):
+    """
+    parse Sec-WebSocket-Extensions header value.
+    return value: list of (name, {param: value or True})
+    """
+    extensions = []
+    for extension in value.split(","):
+        parts = [p.strip() for p in extension.split(";")]
+        if not parts[0]:
+            continue
+        params = {}
+        for p in parts[1:]:
+            if "=" in p:
+                k, v = p.split("=", 1)
+                params[k.strip().lower()] = v.strip().strip('"')
+            else:
+                params[p.lower()] = True
+        extensions.append((parts[0].lower(), params))
+    return extensions
+
+def _negotiate_extensions(resp, options):
+    value = resp.get("sec-websocket-extensions")
+    if not value:
+        return None
+
+    deflate = None
+    for name, params in _parse_extensions(value):
+        if name != EXTENSION_NAME or not options.get("compression", True):
+            raise WebSocketProtocolException(
+                "server accepted not offered extension: %s" % name, STATUS_INVALID_EXTENSION)
+        if deflate:
+            raise WebSocketProtocolException(
+                "duplicated extension: %s" % name, STATUS_INVALID_EXTENSION)
+        deflate = PerMessageDeflate.from_params(params)
+    return deflate
@@ -0,0 +1,221 @@
+import struct
+import threading
+import time
+
+from abnf import STATUS_ABNORMAL_CLOSED
+
+
+class timer_wheel(object):
+    """
+    hashed timer wheel. schedule is O(1) and advance only looks at the
+    slots whose time has come, so 10k idle timers cost nothing per tick.
+    """
+
+    def __init__(self, tick=0.1, slots=1024):
+        """
+        tick: resolution in seconds.
+        slots: timers further than tick * slots ahead wait a round more.
+        """
+        self.tick = tick
+        self.slots = [[] for _ in range(slots)]
+        self.current = int(time.monotonic() / tick)
+
+    def schedule(self, deadline, item):
+        """
+        deadline: time.monotonic() based.
+        """
+        t = max(int(-(-deadline // self.tick)), self.current + 1)
+        self.slots[t % len(self.slots)].append((t, item))
+
+    def advance(self, now=None):
+        """
+        return value: list of items whose deadline passed.
+        """
+        if now is None:
+            now = time.monotonic()
+        target = int(now / self.tick)
+        if target <= self.current:
+            return []
+        steps = target - self.current
+        if steps >= len(self.slots):
+            indexes = range(len(self.slots))
+        else:
+            indexes = [t % len(self.slots) for t in range(self.current + 1, target + 1)]
+        self.current = target
+
+        expired = []
+        for i in indexes:
+            slot = self.slots[i]
+            if not slot:
+                continue
+            keep = []
+            for entry in slot:
+                if entry[0] <= target:
+                    expired.append(entry[1])
+                else:
+                    keep.append(entry)
+            self.slots[i] = keep
+        return expired
+
+
+class _peer(object):
+    __slots__ = ("conn", "payload", "sent", "missed", "seq", "removed")
+
+    def __init__(self, conn):
+        self.conn = conn
+        # outstanding ping, None after its pong came
+        self.payload = None
+        self.sent = None
+        self.missed = 0
+        self.seq = 0
+        self.removed = False
+
+
+class keepalive(object):
+    """
+    ping every connection at an interval, keep a smoothed RTT from the pongs
+    and close the connections missing max_missed pongs in a row with
+    STATUS_ABNORMAL_CLOSED(the socket is dropped, no close frame is sent).
+
+    one keepalive(one timer wheel) serves any number of connections of
+    WebSocket, AsyncWebSocket and connection_manager.
+
+    ka = keepalive(interval=20)
+    ka.start()                 # thread, or start(loop) for asyncio
+    ws = create_connection("ws://localhost:5001/", keepalive=ka)
+    print(ws.rtt)
+    """
+
+    def __init__(self, interval=20, max_missed=2, tick=0.1):
+        """
+        interval: seconds between pings of a connection.
+        max_missed: pongs missed in a row before the connection is closed,
+            so a dead peer is found after about interval * max_missed.
+        tick: timer resolution in seconds.
+        """
+        self.interval = interval
+        self.max_missed = max_missed
+        self.wheel = timer_wheel(tick)
+        self.peers = {}
+        # pongs come from reader threads, pings from the timer thread.
+        self.lock = threading.Lock()
+        self._thread = None
+        self._handle = None
+        self._running = False
+
+    def add(self, conn):
+        """
+        start pinging conn. the first ping goes after interval.
+        """
+        with self.lock:
+            if conn in self.peers:
+                return
+            peer = _peer(conn)
+            self.peers[conn] = peer
+            conn.keepalive = self
+            self.wheel.schedule(time.monotonic() + self.interval, peer)
+        if conn.stats is not None:
+            conn.stats.gauges["rtt_seconds"] = lambda: conn.rtt
+
+    def remove(self, conn):
+        with self.lock:
+            peer = self.peers.pop(conn, None)
+            if peer:
+                peer.removed = True
+                conn.keepalive = None
+
+    def on_pong(self, conn, payload):
+        """
+        called by websocket_core for every received pong.
+        """
+        now = time.monotonic()
+        with self.lock:
+            peer = self.peers.get(conn)
+            if peer is None or peer.payload is None or bytes(payload) != peer.payload:
+                # unsolicited pong(RFC 6455 5.5.3), ignore it
+                return
+            sample = now - peer.sent
+            peer.payload = None
+            peer.missed = 0
+            # RFC 6298 smoothing
+            if conn.rtt is None:
+                conn.rtt = sample
+                conn.rttvar = sample / 2
+            else:
+                conn.rttvar = 0.75 * conn.rttvar + 0.25 * abs(conn.rtt - sample)
+                conn.rtt = 0.875 * conn.rtt + 0.125 * sample
+
+    def advance(self, now=None):
+        """
+        send the pings and close the dead connections which are due.
+        called by the thread/loop of start, or by connection_manager.
+        """
+        if now is None:
+            now = time.monotonic()
+        pings = []
+        dead = []
+        with self.lock:
+            for peer in self.wheel.advance(now):
+                if peer.removed:
+                    continue
+                conn = peer.conn
+                if not conn.connected:
+                    self.peers.pop(conn, None)
+                    conn.keepalive = None
+                    continue
+                if peer.payload is not None:
+                    peer.missed += 1
+                    if peer.missed >= self.max_missed:
+                        self.peers.pop(conn, None)
+                        conn.keepalive = None
+                        dead.append((conn, "keepalive: %d pongs missed" % peer.missed))
+                        continue
+                peer.seq += 1
+                peer.payload = struct.pack("!Q", peer.seq)
+                peer.sent = now
+                pings.append((conn, peer.payload))
+                self.wheel.schedule(now + self.interval, peer)
+
+        # IO outside the lock, a pong may come while pinging.
+        for conn, payload in pings:
+            try:
+                conn._send_ping(payload)
+            except Exception as e:
+                dead.append((conn, "keepalive: ping failed: %s" % e))
+        for conn, reason in dead:
+            self.remove(conn)
+            conn._abort(STATUS_ABNORMAL_CLOSED, reason)
+
+    def start(self, loop=None):
+        """
+        drive the timer wheel from a daemon thread, or from loop(asyncio)
+        when it is given. AsyncWebSocket must use the loop form.
+        """
+        if self._running:
+            return
+        self._running = True
+        if loop is not None:
+            self._handle = loop.call_later(self.wheel.tick, self._loop_tick, loop)
+        else:
+            self._thread = threading.Thread(target=self._run, name="websock-keepalive")
+            self._thread.daemon = True
+            self._thread.start()
+
+    def _run(self):
+        while self._running:
+            self.advance()
+            time.sleep(self.wheel.tick)
+
+    def _loop_tick(self, loop):
+        self.advance()
+        if self._running:
+            self._handle = loop.call_later(self.wheel.tick, self._loop_tick, loop)
+
+    def stop(self):
+        self._running = False
+        if self._handle:
+            self._handle.cancel()
+            self._handle = None
+        if self._thread and self._thread is not threading.current_thread():
+            self._thread.join()
+        self._thread = None
@@ -0,0 +1,344 @@
+import argparse
+import heapq
+import json
+import multiprocessing
+import random
+import struct
+import time
+from multiprocessing.connection import wait
+
+from abnf import ABNF
+from multiplex import connection_manager
+from stats import latency_histogram
+
+PATTERN_CHATTER = "chatter"  # small text messages at random(exponential) intervals
+PATTERN_FANIN = "fanin"      # every connection sends on the same tick
+PATTERN_UPLOAD = "upload"    # big binary messages
+PATTERNS = (PATTERN_CHATTER, PATTERN_FANIN, PATTERN_UPLOAD)
+
+DEFAULT_SIZE = {PATTERN_CHATTER: 64, PATTERN_FANIN: 64, PATTERN_UPLOAD: 1024 * 1024}
+# new connections per second of all workers, a burst overflows the server backlog.
+RAMP_RATE = 2000
+# seconds between the reports of the workers.
+REPORT_INTERVAL = 1.0
+# stamp of a binary message: time.monotonic_ns() of the sender
+_STAMP = struct.Struct("!Q")
+
+
+def _stamp_of(message):
+    """
+    send time in ns of a received message, None if it has none.
+    monotonic is one clock for every process of the host, so a stamp of
+    another worker(broadcast) is as good as our own(echo).
+    """
+    try:
+        if isinstance(message, str):
+            return int(message[:20])
+        return _STAMP.unpack_from(message)[0]
+    except (ValueError, struct.error):
+        return None
+
+
+class _interval(object):
+    """
+    counters of one report interval of a worker.
+    """
+
+    def __init__(self):
+        self.latency = latency_histogram()
+        self.sent = 0
+        self.received = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        # sends skipped because the previous message was still queued
+        self.skipped = 0
+        self.errors = 0
+
+    def snapshot(self):
+        return {"latency": self.latency.snapshot(), "sent": self.sent,
+                "received": self.received, "bytes_sent": self.bytes_sent,
+                "bytes_received": self.bytes_received, "skipped": self.skipped,
+                "errors": self.errors}
+
+
+class load_worker(object):
+    """
+    one process of the load client: connections on one connection_manager
+    sending by the pattern, reporting an interval snapshot every
+    report_interval through pipe.
+    """
+
+    def __init__(self, index, url, connections, pattern, interval, size, duration,
+                 ramp=RAMP_RATE, report_interval=REPORT_INTERVAL, pipe=None):
+        self.index = index
+        self.url = url
+        self.connections = connections
+        self.pattern = pattern
+        self.interval = interval
+        self.size = size
+        self.duration = duration
+        self.ramp = ramp
+        self.report_interval = report_interval
+        self.pipe = pipe
+        self.manager = connection_manager(read_timeout=30, check_interval=0.05)
+        # (due, seq, conn) of the next send of every open connection
+        self.schedule = []
+        self._seq = 0
+        self.open = 0
+        self.current = _interval()
+        if pattern == PATTERN_UPLOAD:
+            self.opcode = ABNF.OPCODE_BINARY
+            self.filler = bytes(max(0, size - _STAMP.size))
+        else:
+            self.opcode = ABNF.OPCODE_TEXT
+            self.filler = "x" * max(0, size - 21)
+
+    def _next_send(self, now):
+        if self.pattern == PATTERN_CHATTER:
+            return now + random.expovariate(1.0 / self.interval)
+        if self.pattern == PATTERN_FANIN:
+            # the next tick of the shared clock, the same for every worker
+            return (int(now / self.interval) + 1) * self.interval
+        return now + self.interval * random.uniform(0.9, 1.1)
+
+    def _payload(self):
+        ns = time.monotonic_ns()
+        if self.opcode == ABNF.OPCODE_BINARY:
+            return _STAMP.pack(ns) + self.filler
+        return "%020d %s" % (ns, self.filler)
+
+    def on_open(self, conn):
+        self.open += 1
+        self._schedule(conn, self._next_send(time.monotonic()))
+
+    def _schedule(self, conn, due):
+        self._seq += 1
+        heapq.heappush(self.schedule, (due, self._seq, conn))
+
+    def on_message(self, conn, message):
+        now = time.monotonic_ns()
+        self.current.received += 1
+        self.current.bytes_received += len(message)
+        stamp = _stamp_of(message)
+        if stamp is not None and stamp <= now:
+            self.current.latency.add((now - stamp) / 1e9)
+
+    def on_close(self, conn, error):
+        if conn.handshake_response is not None:
+            self.open -= 1
+        if error is not None:
+            self.current.errors += 1
+
+    def _send_due(self, now):
+        while self.schedule and self.schedule[0][0] <= now:
+            _, _, conn = heapq.heappop(self.schedule)
+            if conn.state != conn.OPEN or conn.close_status is not None:
+                continue
+            if conn.out:
+                # the server does not keep up, do not pile up messages.
+                self.current.skipped += 1
+            else:
+                payload = self._payload()
+                conn.send(payload, self.opcode)
+                self.current.sent += 1
+                self.current.bytes_sent += len(payload)
+            self._schedule(conn, self._next_send(now))
+
+    def _report(self, number, done=False):
+        if self.pipe is not None:
+            self.pipe.send({"worker": self.index, "interval": number, "open": self.open,
+                            "done": done, "stats": self.current.snapshot()})
+        self.current = _interval()
+
+    def run(self):
+        start = time.monotonic()
+        end = start + self.duration
+        started = 0
+        number = 0
+        next_report = start + self.report_interval
+        while True:
+            now = time.monotonic()
+            if now >= end:
+                break
+            # ramp up
+            while started < self.connections and started < (now - start) * self.ramp + 1:
+                try:
+                    self.manager.connect(self.url, self.on_message, self.on_open, self.on_close)
+                except OSError:
+                    self.current.errors += 1
+                started += 1
+            self._send_due(now)
+            if now >= next_report:
+                self._report(number)
+                number += 1
+                next_report += self.report_interval
+            wait_until = min(end, next_report)
+            if self.schedule:
+                wait_until = min(wait_until, self.schedule[0][0])
+            self.manager.run_once(max(0.0, wait_until - time.monotonic()))
+        self.manager.close()
+        self._report(number, True)
+
+
+def _worker(index, url, connections, pattern, interval, size, duration, ramp,
+            report_interval, pipe):
+    try:
+        load_worker(index, url, connections, pattern, interval, size, duration,
+                    ramp, report_interval, pipe).run()
+    except Exception as e:
+        pipe.send({"worker": index, "error": repr(e)})
+    finally:
+        pipe.close()
+
+
+class load_report(object):
+    """
+    interval snapshots of the workers merged into one.
+    """
+
+    def __init__(self):
+        self.intervals = {}
+        self.open = {}
+
+    def add(self, message):
+        stats = message["stats"]
+        self.open[message["worker"]] = message["open"]
+        merged = self.intervals.setdefault(message["interval"], {"workers": 0})
+        for key, value in stats.items():
+            if key == "latency":
+                histogram = latency_histogram.from_snapshot(value)
+                if "latency" in merged:
+                    merged["latency"].merge(histogram)
+                else:
+                    merged["latency"] = histogram
+            else:
+                merged[key] = merged.get(key, 0) + value
+        merged["workers"] += 1
+        return merged
+
+    def summary(self):
+        total = {"latency": latency_histogram()}
+        for interval in self.intervals.values():
+            for key, value in interval.items():
+                if key == "latency":
+                    total["latency"].merge(value)
+                elif key != "workers":
+                    total[key] = total.get(key, 0) + value
+        return total
+
+
+def _latency_fields(histogram):
+    def ms(p):
+        v = histogram.percentile(p)
+        return "-" if v is None else "%.2f" % (v * 1000)
+    return "p50=%sms p90=%sms p99=%sms max=%s" % (
+        ms(50), ms(90), ms(99), "%.2fms" % (histogram.max * 1000) if histogram.count else "-")
+
+
+def run_load(url, connections, workers=None, pattern=PATTERN_CHATTER, interval=1.0,
+             size=None, duration=10.0, ramp=RAMP_RATE, report_interval=REPORT_INTERVAL,
+             verbose=True):
+    """
+    shard connections over worker processes(one per core by default)
+    and merge what they report.
+    return value: dict of the totals.
+    """
+    if pattern not in PATTERNS:
+        raise ValueError("unknown pattern %r" % pattern)
+    workers = workers or multiprocessing.cpu_count()
+    workers = min(workers, connections)
+    size = DEFAULT_SIZE[pattern] if size is None else size
+    pipes = []
+    procs = []
+    for i in range(workers):
+        n = connections // workers + (i < connections % workers)
+        parent, child = multiprocessing.Pipe(duplex=False)
+        p = multiprocessing.Process(
+            target=_worker,
+            args=(i, url, n, pattern, interval, size, duration, ramp / workers,
+                  report_interval, child))
+        p.start()
+        child.close()
+        pipes.append(parent)
+        procs.append(p)
+
+    report = load_report()
+    errors = []
+    start = time.monotonic()
+    while pipes:
+        for pipe in wait(pipes):
+            try:
+                message = pipe.recv()
+            except EOFError:
+                pipes.remove(pipe)
+                continue
+            if "error" in message:
+                errors.append(message["error"])
+                continue
+            merged = report.add(message)
+            if verbose and merged["workers"] == workers and not message["done"]:
+                print("%6.1fs open=%d sent=%d recv=%d skipped=%d errors=%d %s" % (
+                    time.monotonic() - start, sum(report.open.values()), merged["sent"],
+                    merged["received"], merged["skipped"], merged["errors"],
+                    _latency_fields(merged["latency"])))
+    for p in procs:
+        p.join()
+
+    total = report.summary()
+    elapsed = max(duration, 1e-9)
+    result = {
+        "url": url,
+        "pattern": pattern,
+        "connections": connections,
+        "workers": workers,
+        "size": size,
+        "interval": interval,
+        "duration": duration,
+        "sent": total.get("sent", 0),
+        "received": total.get("received", 0),
+        "skipped": total.get("skipped", 0),
+        "errors": total.get("errors", 0),
+        "messages_per_sec_out": total.get("sent", 0) / elapsed,
+        "messages_per_sec_in": total.get("received", 0) / elapsed,
+        "mb_per_sec_out": total.get("bytes_sent", 0) / elapsed / (1024 * 1024),
+        "mb_per_sec_in": total.get("bytes_received", 0) / elapsed / (1024 * 1024),
+        "latency_ms": {str(p): (total["latency"].percentile(p) or 0) * 1000
+                       for p in (50, 90, 99, 99.9)},
+        "latency_max_ms": total["latency"].max * 1000,
+        "worker_errors": errors,
+    }
+    if verbose:
+        print("%s x%d(%d workers): sent %d(%.0f/s, %.2f MB/s) received %d(%.0f/s, %.2f MB/s)"
+              " skipped %d errors %d" % (
+                  pattern, connections, workers, result["sent"], result["messages_per_sec_out"],
+                  result["mb_per_sec_out"], result["received"], result["messages_per_sec_in"],
+                  result["mb_per_sec_in"], result["skipped"], result["errors"]))
+        print("latency %s" % _latency_fields(total["latency"]))
+        for e in errors:
+            print("worker failed: %s" % e)
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="websock load client")
+    parser.add_argument("url")
+    parser.add_argument("--connections", type=int, default=100)
+    parser.add_argument("--workers", type=int, default=None, help="processes, default one per core")
+    parser.add_argument("--pattern", choices=PATTERNS, default=PATTERN_CHATTER)
+    parser.add_argument("--interval", type=float, default=1.0,
+                        help="seconds between messages of a connection")
+    parser.add_argument("--size", type=int, default=None, help="message bytes")
+    parser.add_argument("--duration", type=float, default=10.0)
+    parser.add_argument("--ramp", type=float, default=RAMP_RATE, help="new connections per second")
+    parser.add_argument("--json", help="write the result to this file")
+    args = parser.parse_args()
+
+    result = run_load(args.url, args.connections, args.workers, args.pattern, args.interval,
+                      args.size, args.duration, args.ramp)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(result, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,107 @@
+import os
+
+# numpy is imported by the first payload long enough to use it, a
+# client sending small messages never pays its import time.
+numpy = None
+_numpy_loaded = False
+
+# payloads shorter than this are masked with the pure python path,
+# numpy call overhead is bigger than the work itself there.
+NUMPY_THRESHOLD = 2048
+# random bytes read at once by mask_key_source, 1024 keys.
+MASK_KEY_BLOCK = 4096
+
+
+class mask_key_source(object):
+    """
+    mask keys cut from os.urandom blocks, one getrandom call per
+    MASK_KEY_BLOCK // 4 frames instead of one per frame.
+    callable like os.urandom(n). a forked child starts a new block, so
+    parent and child never send the same keys.
+    """
+
+    def __init__(self, block=MASK_KEY_BLOCK):
+        self.block_size = block & ~3
+        self._keys = iter(())
+        if hasattr(os, "register_at_fork"):
+            os.register_at_fork(after_in_child=self._reset)
+
+    def _reset(self):
+        self._keys = iter(())
+
+    def __call__(self, n=4):
+        if n != 4:
+            return os.urandom(n)
+        # next() on a list iterator is atomic, so threads never get the
+        # same key and no lock is needed. two threads refilling at once
+        # only drop the rest of a block.
+        try:
+            return next(self._keys)
+        except StopIteration:
+            block = os.urandom(self.block_size)
+            keys = iter([block[i:i + 4] for i in range(0, len(block), 4)])
+            self._keys = keys
+            return next(keys)
+
+
+def load_numpy():
+    """
+    import numpy once.
+    return value: numpy module, None if it is not installed.
+    """
+    global numpy, _numpy_loaded
+    if not _numpy_loaded:
+        try:
+            import numpy as module
+        except ImportError:
+            module = None
+        numpy = module
+        _numpy_loaded = True
+    return numpy
+
+
+# shared by every frame that has no get_mask_key of its own.
+mask_key = mask_key_source()
+
+
+def mask_inplace(mask_key, buf, offset=0):
+    """
+    XOR buf with the 4 byte mask_key in place.
+    see http://tools.ietf.org/html/rfc6455#section-5.3
+    buf: writable buffer (bytearray, writable memoryview, ...).
+    offset: position of buf in the payload, for masking a payload in parts.
+    return value: buf
+    """
+    view = memoryview(buf).cast("B")
+    if view.readonly:
+        raise TypeError("mask target must be a writable buffer")
+    length = len(view)
+    if not length:
+        return buf
+    if offset & 3:
+        mask_key = bytes(mask_key[offset & 3:]) + bytes(mask_key[:offset & 3])
+
+    if length >= NUMPY_THRESHOLD and (numpy is not None or load_numpy() is not None):
+        _mask_numpy(mask_key, view, length)
+    else:
+        _mask_python(mask_key, view, length)
+    return buf
+
+
+def _mask_numpy(mask_key, view, length):
+    a = numpy.frombuffer(view, dtype=numpy.uint8)
+    aligned = length & ~7
+    # the key repeated twice is one uint64, xor the 8 byte aligned body with it.
+    key64 = numpy.frombuffer(bytes(mask_key) * 2, dtype=numpy.uint64)[0]
+    body = a[:aligned].view(numpy.uint64)
+    numpy.bitwise_xor(body, key64, out=body)
+    # aligned is a multiple of 4, so the tail(up to 7 bytes) starts at key offset 0.
+    for i in range(aligned, length):
+        view[i] ^= mask_key[(i - aligned) & 3]
+
+
+def _mask_python(mask_key, view, length):
+    key = bytes(mask_key)
+    repeated = key * (length >> 2) + key[:length & 3]
+    masked = int.from_bytes(view, "little") ^ int.from_bytes(repeated, "little")
+    view[:] = masked.to_bytes(length, "little")
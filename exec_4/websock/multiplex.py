@@ -0,0 +1,396 @@
+import errno
+import os
+import selectors
+import socket
+import time
+from collections import deque
+
+from util_http import parse_url, parse_headers, DEFAULT_SOCKET_OPTION, IOV_MAX, MAX_HEADER_SIZE
+from handshark import handshake_request, handshake_result
+from abnf import ABNF, WebSocketProtocolException, STATUS_NORMAL
+from protocol import websocket_core
+from pool import addrinfo_cache
+
+# receive buffer of one connection, grows when a bigger frame comes.
+MULTIPLEX_BUFSIZE = 4096
+
+_WOULD_BLOCK = (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINPROGRESS)
+
+
+class managed_connection(websocket_core):
+    """
+    one non-blocking WebSocket owned by connection_manager.
+    handshake and frame parsing advance as bytes arrive, nothing blocks.
+    """
+    CONNECTING = "connecting"
+    HANDSHAKE = "handshake"
+    OPEN = "open"
+    CLOSED = "closed"
+
+    def __init__(self, manager, url, on_message, on_open, on_close,
+                 max_message_size, read_timeout, write_timeout, idle_timeout, options):
+        super().__init__(None, max_message_size, MULTIPLEX_BUFSIZE)
+        self.manager = manager
+        self.url = url
+        self.on_message = on_message
+        self.on_open = on_open
+        self.on_close = on_close
+        self.read_timeout = read_timeout
+        self.write_timeout = write_timeout
+        self.idle_timeout = idle_timeout
+        self.options = options
+        self.state = managed_connection.CONNECTING
+        self.sock = None
+        self.addrs = None
+        # addresses not tried yet
+        self.addrinfos = None
+        # memoryviews waiting to be written
+        self.out = deque()
+        self.header_buffer = bytearray(1024)
+        self.header_length = 0
+        now = time.monotonic()
+        self.last_read = now
+        self.last_write = now
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def send(self, payload, opcode=ABNF.OPCODE_TEXT):
+        """
+        queue a message, it is written when the socket is writable.
+        """
+        return self.send_frame(ABNF.create_frame(payload, opcode))
+
+    def send_frame(self, frame):
+        if self.state != managed_connection.OPEN:
+            raise Exception("Connection is not open.")
+        buffers = self.prepare_frame(frame)
+        return self._queue(buffers)
+
+    def close(self, status=STATUS_NORMAL, reason=""):
+        """
+        send close frame, the socket is closed after it is written.
+        """
+        if self.state == managed_connection.OPEN:
+            # through prepare_frame like every frame, recorded and counted.
+            self._queue(self.prepare_frame(ABNF.create_frame(
+                self.close_payload(status, reason), ABNF.OPCODE_CLOSE)))
+            self.close_status = status
+            self.connected = False
+        elif self.state != managed_connection.CLOSED:
+            self.manager._close(self, None)
+
+    def _send_ping(self, payload):
+        if self.state == managed_connection.OPEN and self.close_status is None:
+            self.send(payload, ABNF.OPCODE_PING)
+
+    def _abort(self, status, reason=""):
+        self.close_status = status
+        self.manager._close(self, WebSocketProtocolException(reason, status))
+
+    def _queue(self, buffers):
+        length = 0
+        for b in buffers:
+            if len(b):
+                self.out.append(memoryview(b).cast("B"))
+                length += len(b)
+        if self.out:
+            self.manager._want_write(self, True)
+        return length
+
+    def _pending_read(self):
+        """
+        a handshake or a frame is half received.
+        """
+        fb = self.frame_buffer
+        return self.state in (managed_connection.CONNECTING, managed_connection.HANDSHAKE) or \
+            fb.header is not None or fb.end > fb.start
+
+    def _deadline(self):
+        """
+        the nearest timeout of this connection, None if there is none.
+        """
+        deadlines = []
+        if self.read_timeout is not None and self._pending_read():
+            deadlines.append(self.last_read + self.read_timeout)
+        if self.write_timeout is not None and self.out:
+            deadlines.append(self.last_write + self.write_timeout)
+        if self.idle_timeout is not None:
+            deadlines.append(max(self.last_read, self.last_write) + self.idle_timeout)
+        return min(deadlines) if deadlines else None
+
+    # IO events from connection_manager
+
+    def _on_writable(self):
+        if self.state == managed_connection.CONNECTING:
+            err = self.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+            if err and self.addrinfos:
+                # refused or unreachable, try the next address
+                self.manager._connect_next(self)
+                return
+            if err:
+                raise OSError(err, os.strerror(err))
+            self.state = managed_connection.HANDSHAKE
+            request, _ = handshake_request(*self.addrs, **self.options)
+            self.last_write = time.monotonic()
+            self._queue([request])
+
+        while self.out:
+            try:
+                sent = self.sock.sendmsg(list(self.out)[:IOV_MAX])
+            except (BlockingIOError, InterruptedError):
+                break
+            self.last_write = time.monotonic()
+            while sent:
+                if sent >= len(self.out[0]):
+                    sent -= len(self.out.popleft())
+                else:
+                    self.out[0] = self.out[0][sent:]
+                    sent = 0
+
+        if not self.out:
+            self.manager._want_write(self, False)
+            if self.close_status is not None and not self.connected and \
+                    self.state == managed_connection.CLOSED:
+                self.manager._close(self, None)
+
+    def _on_readable(self):
+        if self.state == managed_connection.HANDSHAKE:
+            self._read_handshake()
+            return
+        try:
+            n = self.sock.recv_into(self.frame_buffer.get_buffer())
+        except (BlockingIOError, InterruptedError):
+            return
+        if not n:
+            raise Exception("Connection is already closed.")
+        self.last_read = time.monotonic()
+        self.frame_buffer.buffer_updated(n)
+        self._parse()
+
+    def _read_handshake(self):
+        if self.header_length == len(self.header_buffer):
+            if self.header_length >= MAX_HEADER_SIZE:
+                raise Exception("Handshake header is too long")
+            self.header_buffer += bytes(self.header_length)
+        try:
+            with memoryview(self.header_buffer) as view:
+                n = self.sock.recv_into(view[self.header_length:])
+        except (BlockingIOError, InterruptedError):
+            return
+        if not n:
+            raise Exception("Connection is already closed.")
+        self.last_read = time.monotonic()
+
+        start = max(0, self.header_length - 3)
+        self.header_length += n
+        end = self.header_buffer.find(b"\r\n\r\n", start, self.header_length)
+        if end < 0:
+            return
+        status, resp, status_message = parse_headers(self.header_buffer[:end + 4])
+        self._set_handshake(handshake_result(status, resp, status_message, **self.options))
+        # frames which came with the upgrade response
+        self.frame_buffer.feed(memoryview(self.header_buffer)[end + 4:self.header_length])
+        self.header_buffer = None
+        self.state = managed_connection.OPEN
+        self.connected = True
+        if self.manager.keepalive is not None:
+            self.manager.keepalive.add(self)
+        if self.on_open:
+            self.on_open(self)
+        self._parse()
+
+    def _parse(self):
+        while self.state == managed_connection.OPEN:
+            frame = self.frame_buffer.next_frame(self._frame_limit())
+            if frame is None:
+                return
+            result = self.process_frame(frame)
+            if result is None:
+                continue
+
+            opcode, frame = result
+            if opcode == ABNF.OPCODE_PING:
+                self.send(frame.data, ABNF.OPCODE_PONG)
+            elif opcode == ABNF.OPCODE_CLOSE:
+                if self.close_status is None:
+                    # reply and close after it is written
+                    self.close()
+                self.state = managed_connection.CLOSED
+                if not self.out:
+                    self.manager._close(self, None)
+            elif opcode == ABNF.OPCODE_TEXT:
+                self.on_message(self, frame.text)
+            elif opcode == ABNF.OPCODE_BINARY:
+                self.on_message(self, frame.data)
+
+
+class connection_manager(object):
+    """
+    drive many WebSocket connections on one thread with selectors(epoll).
+
+    manager = connection_manager(idle_timeout=60)
+    manager.connect("ws://localhost:5001/", on_message=lambda conn, msg: print(msg))
+    manager.run()
+    """
+
+    def __init__(self, read_timeout=None, write_timeout=None, idle_timeout=None,
+                 check_interval=0.1, keepalive=None, resolver=None):
+        """
+        read_timeout: seconds a started handshake or frame may wait for more bytes.
+        write_timeout: seconds queued output may wait for the socket.
+        idle_timeout: seconds without any read or write.
+        check_interval: how often timeouts are checked.
+        each can be overridden per connection in connect.
+        keepalive: keepalive to ping the open connections with. it is
+            driven by this manager, do not start it.
+        resolver: pool.addrinfo_cache, a new one if None. a host is
+            resolved once per ttl, not on every connect.
+        """
+        self.selector = selectors.DefaultSelector()
+        self.read_timeout = read_timeout
+        self.write_timeout = write_timeout
+        self.idle_timeout = idle_timeout
+        self.check_interval = check_interval
+        self.keepalive = keepalive
+        self.resolver = addrinfo_cache() if resolver is None else resolver
+        self.connections = set()
+        self._last_check = time.monotonic()
+        self._running = False
+
+    def connect(self, url, on_message, on_open=None, on_close=None,
+                max_message_size=None, read_timeout=None, write_timeout=None,
+                idle_timeout=None, **options):
+        """
+        start connecting, returns at once.
+        on_message(conn, message): str for text, bytearray for binary.
+        on_open(conn): handshake finished.
+        on_close(conn, error): error is None on a normal close.
+        return value: managed_connection
+        """
+        conn = managed_connection(
+            self, url, on_message, on_open, on_close, max_message_size,
+            self.read_timeout if read_timeout is None else read_timeout,
+            self.write_timeout if write_timeout is None else write_timeout,
+            self.idle_timeout if idle_timeout is None else idle_timeout,
+            options)
+        hostname, port, resource, is_secure = parse_url(url)
+        if is_secure:
+            raise ValueError("wss is not supported by connection_manager")
+        conn.addrs = (hostname, port, resource)
+        conn.addrinfos = deque(self.resolver.get(hostname, port))
+        self._open(conn)
+        self.connections.add(conn)
+        return conn
+
+    def _open(self, conn):
+        """
+        start connecting conn to the first of its addresses which does
+        not fail at once, like util_http._open_socket.
+        """
+        error = None
+        while conn.addrinfos:
+            family, socktype, proto, _, addr = conn.addrinfos.popleft()
+            sock = socket.socket(family, socktype, proto)
+            sock.setblocking(False)
+            for opt in DEFAULT_SOCKET_OPTION:
+                sock.setsockopt(*opt)
+            err = sock.connect_ex(addr)
+            if err and err not in _WOULD_BLOCK:
+                sock.close()
+                error = OSError(err, os.strerror(err))
+                continue
+            conn.sock = sock
+            self.selector.register(sock, selectors.EVENT_WRITE, conn)
+            return
+        raise error
+
+    def _connect_next(self, conn):
+        # the failed socket stays registered(and is closed by _close)
+        # if no address is left.
+        old = conn.sock
+        self._open(conn)
+        self.selector.unregister(old)
+        old.close()
+
+    def _want_write(self, conn, want):
+        if conn.sock is None:
+            return
+        if conn.state == managed_connection.CONNECTING:
+            # writable means connected(or failed)
+            events = selectors.EVENT_WRITE
+        elif want:
+            events = selectors.EVENT_READ | selectors.EVENT_WRITE
+        else:
+            events = selectors.EVENT_READ
+        if self.selector.get_key(conn.sock).events != events:
+            self.selector.modify(conn.sock, events, conn)
+
+    def _close(self, conn, error):
+        if conn not in self.connections:
+            return
+        self.connections.discard(conn)
+        conn.state = managed_connection.CLOSED
+        conn.connected = False
+        if conn.keepalive is not None:
+            conn.keepalive.remove(conn)
+        self.selector.unregister(conn.sock)
+        conn.sock.close()
+        if conn.on_close:
+            conn.on_close(conn, error)
+
+    def run_once(self, timeout=None):
+        """
+        wait for IO once and handle it.
+        """
+        if timeout is None or timeout > self.check_interval:
+            timeout = self.check_interval
+        for key, events in self.selector.select(timeout):
+            conn = key.data
+            try:
+                if events & selectors.EVENT_WRITE:
+                    conn._on_writable()
+                if events & selectors.EVENT_READ and conn in self.connections:
+                    conn._on_readable()
+            except WebSocketProtocolException as e:
+                self._fail(conn, e)
+            except Exception as e:
+                self._close(conn, e)
+        if self.keepalive is not None:
+            self.keepalive.advance()
+        self._check_timeouts()
+
+    def _fail(self, conn, e):
+        # best effort close frame, the socket is closed right after.
+        try:
+            conn.sock.sendmsg(conn.prepare_frame(ABNF.create_frame(
+                conn.close_payload(e.status, str(e)[:120]), ABNF.OPCODE_CLOSE)))
+        except OSError:
+            pass
+        self._close(conn, e)
+
+    def _check_timeouts(self):
+        now = time.monotonic()
+        if now - self._last_check < self.check_interval:
+            return
+        self._last_check = now
+        for conn in list(self.connections):
+            deadline = conn._deadline()
+            if deadline is not None and deadline <= now:
+                self._close(conn, socket.timeout("%s timed out" % conn.state))
+
+    def run(self):
+        """
+        run until stop() or no connection is left.
+        """
+        self._running = True
+        while self._running and self.connections:
+            self.run_once()
+
+    def stop(self):
+        self._running = False
+
+    def close(self):
+        for conn in list(self.connections):
+            self._close(conn, None)
+        self.selector.close()
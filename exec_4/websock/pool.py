@@ -0,0 +1,312 @@
+import errno
+import os
+import random
+import select
+import selectors
+import socket
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+import util_http
+from util_http import parse_url, DEFAULT_SOCKET_OPTION
+from abnf import STATUS_GOING_AWAY
+from websock import WebSocket
+
+# RFC 8305 "Connection Attempt Delay"
+ATTEMPT_DELAY = 0.25
+
+
+class addrinfo_cache(object):
+    """
+    getaddrinfo results kept for ttl seconds.
+    """
+
+    def __init__(self, ttl=60):
+        self.ttl = ttl
+        self.entries = {}
+        self.lock = threading.Lock()
+
+    def get(self, hostname, port):
+        key = (hostname, port)
+        now = time.monotonic()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry and entry[0] > now:
+                return entry[1]
+        # resolve without the lock, other hosts need not wait.
+        addrinfo_list = socket.getaddrinfo(hostname, port, 0, socket.SOCK_STREAM, socket.SOL_TCP)
+        if not addrinfo_list:
+            raise ValueError("Host not found.: " + hostname + ":" + str(port))
+        with self.lock:
+            self.entries[key] = (now + self.ttl, addrinfo_list)
+        return addrinfo_list
+
+    def invalidate(self, hostname, port):
+        with self.lock:
+            self.entries.pop((hostname, port), None)
+
+
+def _interleave(addrinfo_list):
+    """
+    alternate the address families, starting with the first one(RFC 8305 4).
+    """
+    families = {}
+    for addrinfo in addrinfo_list:
+        families.setdefault(addrinfo[0], deque()).append(addrinfo)
+    queues = list(families.values())
+    result = []
+    while queues:
+        for q in queues:
+            result.append(q.popleft())
+        queues = [q for q in queues if q]
+    return result
+
+
+def connect_parallel(addrinfo_list, timeout=None, attempt_delay=ATTEMPT_DELAY):
+    """
+    happy eyeballs(RFC 8305): start a connection attempt every attempt_delay
+    seconds(at once after a failure) across IPv6/IPv4, the first one to
+    connect wins and the others are closed.
+    return value: connected blocking socket with util_http.TIMEOUT set.
+    """
+    pending = deque(_interleave(addrinfo_list))
+    selector = selectors.DefaultSelector()
+    attempts = []
+    error = None
+    winner = None
+    deadline = None if timeout is None else time.monotonic() + timeout
+    next_start = 0
+    try:
+        while winner is None and (pending or attempts):
+            now = time.monotonic()
+            if deadline is not None and now >= deadline:
+                raise socket.timeout("timed out")
+
+            if pending and now >= next_start:
+                family, socktype, proto, _, addr = pending.popleft()
+                sock = socket.socket(family, socktype, proto)
+                sock.setblocking(False)
+                err = sock.connect_ex(addr)
+                if err in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+                    attempts.append(sock)
+                    selector.register(sock, selectors.EVENT_WRITE, addr)
+                    next_start = now + attempt_delay
+                else:
+                    sock.close()
+                    error = OSError(err, os.strerror(err))
+                    error.remote_ip = str(addr[0])
+                continue
+
+            wait = None
+            if pending:
+                wait = next_start - now
+            if deadline is not None:
+                wait = deadline - now if wait is None else min(wait, deadline - now)
+            for key, _ in selector.select(wait):
+                sock = key.fileobj
+                err = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                selector.unregister(sock)
+                attempts.remove(sock)
+                if err:
+                    sock.close()
+                    error = OSError(err, os.strerror(err))
+                    error.remote_ip = str(key.data[0])
+                    next_start = 0
+                else:
+                    winner = sock
+                    break
+    finally:
+        for sock in attempts:
+            sock.close()
+        selector.close()
+
+    if winner is None:
+        raise error
+    winner.setblocking(True)
+    winner.settimeout(util_http.TIMEOUT)
+    for opt in DEFAULT_SOCKET_OPTION:
+        winner.setsockopt(*opt)
+    return winner
+
+
+class connection_factory(object):
+    """
+    opens WebSocket connections with an addrinfo cache, parallel connection
+    attempts and bounded retry with exponential backoff.
+
+    factory = connection_factory(ttl=60, retries=3)
+    ws = factory.create_connection("ws://localhost:5001/")
+    """
+
+    def __init__(self, ttl=60, attempt_delay=ATTEMPT_DELAY, retries=3, backoff=0.1,
+                 max_backoff=5.0, timeout=None):
+        """
+        ttl: seconds a getaddrinfo result is reused.
+        attempt_delay: seconds before the next address is tried in parallel.
+        retries: connection retries after the first failure.
+        backoff: first retry delay, doubled each time up to max_backoff.
+        timeout: seconds for one connect over all addresses.
+        """
+        self.cache = addrinfo_cache(ttl)
+        self.attempt_delay = attempt_delay
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.timeout = timeout
+
+    def open_socket(self, hostname, port):
+        for attempt in range(self.retries + 1):
+            try:
+                return connect_parallel(self.cache.get(hostname, port),
+                                        self.timeout, self.attempt_delay)
+            except OSError:
+                # the addresses may have moved.
+                self.cache.invalidate(hostname, port)
+                if attempt == self.retries:
+                    raise
+            delay = min(self.max_backoff, self.backoff * 2 ** attempt)
+            # jitter, so that many clients do not come back at once.
+            time.sleep(delay * random.uniform(0.5, 1.0))
+
+    def create_connection(self, url, max_message_size=None, stats=False, keepalive=None,
+                          **options):
+        """
+        same as websock.create_connection.
+        """
+        hostname, port, _, _ = parse_url(url)
+        sock = self.open_socket(hostname, port)
+        websock = WebSocket(max_message_size, stats)
+        websock.connect(url, sock=sock, **options)
+        if keepalive is not None:
+            keepalive.add(websock)
+        return websock
+
+
+def _reusable(websock):
+    """
+    an idle connection must have nothing to read, a readable socket
+    means a close frame or EOF from the server.
+    """
+    if not websock.connected or websock.sock is None:
+        return False
+    fb = websock.frame_buffer
+    if fb.header is not None or fb.end > fb.start:
+        return False
+    # poll, select fails for fds over FD_SETSIZE(1024)
+    poller = select.poll()
+    try:
+        poller.register(websock.sock, select.POLLIN)
+        return not poller.poll(0)
+    except (OSError, ValueError):
+        return False
+
+
+def _discard(websock):
+    try:
+        if websock.connected and websock.sock:
+            websock.send_close(STATUS_GOING_AWAY)
+    except Exception:
+        pass
+    if websock.sock:
+        websock.sock.close()
+        websock.sock = None
+    websock.connected = False
+
+
+class websocket_pool(object):
+    """
+    handshaken WebSocket connections kept per url to be checked out and
+    returned.
+
+    pool = websocket_pool(max_idle=4)
+    with pool.connection("ws://localhost:5001/") as ws:
+        ws.send("Hello")
+        print(ws.recv())
+    """
+
+    def __init__(self, factory=None, max_idle=8, idle_timeout=None):
+        """
+        factory: connection_factory to open new connections with.
+        max_idle: idle connections kept per url, more are closed.
+        idle_timeout: seconds an idle connection is kept.
+        """
+        self.factory = factory or connection_factory()
+        self.max_idle = max_idle
+        self.idle_timeout = idle_timeout
+        # key -> deque of (WebSocket, returned time)
+        self.idle = {}
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def _key(url, options):
+        return url, repr(sorted(options.items()))
+
+    def checkout(self, url, **options):
+        """
+        an idle connection to url, or a new one.
+        options are create_connection options, connections opened with
+        other options are not shared.
+        """
+        key = self._key(url, options)
+        now = time.monotonic()
+        while True:
+            with self.lock:
+                idle = self.idle.get(key)
+                if not idle:
+                    break
+                websock, returned = idle.pop()
+            if self.idle_timeout is not None and now - returned > self.idle_timeout:
+                _discard(websock)
+            elif _reusable(websock):
+                return websock
+            else:
+                _discard(websock)
+
+        websock = self.factory.create_connection(url, **options)
+        websock.pool_key = key
+        return websock
+
+    def checkin(self, websock):
+        """
+        return a connection taken by checkout.
+        """
+        if not _reusable(websock):
+            _discard(websock)
+            return
+        with self.lock:
+            idle = self.idle.setdefault(websock.pool_key, deque())
+            idle.append((websock, time.monotonic()))
+            surplus = idle.popleft()[0] if len(idle) > self.max_idle else None
+        if surplus is not None:
+            _discard(surplus)
+
+    @contextmanager
+    def connection(self, url, **options):
+        """
+        checkout and checkin. the connection is closed, not
+        returned, when the block raises.
+        """
+        websock = self.checkout(url, **options)
+        try:
+            yield websock
+        except BaseException:
+            _discard(websock)
+            raise
+        self.checkin(websock)
+
+    def prefill(self, url, count, **options):
+        """
+        open count connections to url ahead of time.
+        """
+        websocks = [self.checkout(url, **options) for _ in range(count)]
+        for websock in websocks:
+            self.checkin(websock)
+
+    def close(self):
+        with self.lock:
+            idle, self.idle = self.idle, {}
+        for connections in idle.values():
+            for websock, _ in connections:
+                _discard(websock)
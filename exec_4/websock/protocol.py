@@ -0,0 +1,191 @@
+import abc
+import codecs
+import struct
+
+from abnf import ABNF, WebSocketProtocolException, frame_buffer, continuous_frame, \
+    STATUS_NORMAL, STATUS_INVALID_PAYLOAD
+from stats import ws_stats
+
+
+utf8_decoder = codecs.getincrementaldecoder("utf-8")
+
+
+def decode_text(decoder, data, final=False):
+    """
+    feed one piece of a text message to an incremental UTF-8 decoder.
+    invalid UTF-8 fails with STATUS_INVALID_PAYLOAD(RFC 6455 8.1).
+    """
+    try:
+        return decoder.decode(data, final)
+    except UnicodeDecodeError as e:
+        raise WebSocketProtocolException(
+            "invalid UTF-8 in text message: %s" % e.reason, STATUS_INVALID_PAYLOAD)
+
+
+class websocket_core(abc.ABC):
+    """
+    sans-IO part of a client connection, shared by WebSocket(blocking)
+    and AsyncWebSocket(asyncio). it assembles received frames into
+    messages, keeps the permessage-deflate state and encodes frames to
+    send. it never touches a socket.
+    subclasses implement _send_ping and _abort.
+    """
+
+    def __init__(self, recv_into_fn=None, max_message_size=None,
+                 bufsize=frame_buffer._INITIAL_BUFSIZE):
+        """
+        recv_into_fn: see frame_buffer. None for push(sans-IO) mode.
+        max_message_size: limit of a received message in bytes, a bigger
+            message fails with STATUS_MESSAGE_TOO_BIG. None is unlimited.
+        bufsize: initial receive buffer size.
+        """
+        self.handshake_response = None
+        self.connected = False
+        self.get_mask_key = None
+        # PerMessageDeflate, set by the handshake if negotiated.
+        self.deflate = None
+        # the data message being received is compressed.
+        self._inflating = False
+        # incremental UTF-8 decoder and decoded parts of the text message
+        # being received, None while receiving binary.
+        self._text_decoder = None
+        self._text_parts = None
+        self.frame_buffer = frame_buffer(recv_into_fn, bufsize)
+        self.cont_frame = continuous_frame(max_message_size)
+        # ws_stats, None until enable_stats.
+        self.stats = None
+        # keepalive pinging this connection, and the smoothed RTT(seconds)
+        # and its variation measured from its pongs.
+        self.keepalive = None
+        self.rtt = None
+        self.rttvar = None
+        # status the connection was closed with locally, e.g.
+        # STATUS_ABNORMAL_CLOSED by keepalive.
+        self.close_status = None
+        # frame_recorder, None until enable_recorder.
+        self.recorder = None
+
+    def enable_recorder(self, recorder):
+        """
+        record every frame received and sent from now on(see recorder.py).
+        recorder: frame_recorder, None stops recording.
+        """
+        self.recorder = recorder
+        self.frame_buffer.recorder = recorder
+        if recorder is not None:
+            meta = {"deflate": self.deflate.params() if self.deflate else None}
+            recorder.record_meta(meta)
+
+    def enable_stats(self):
+        """
+        start collecting ws_stats(see stats.py).
+        return value: ws_stats
+        """
+        if self.stats is None:
+            self.stats = ws_stats()
+            self.frame_buffer.stats = self.stats
+        return self.stats
+
+    def _set_handshake(self, response):
+        self.handshake_response = response
+        self.deflate = response.deflate
+        self.frame_buffer.allow_rsv1 = self.deflate is not None
+
+    def _frame_limit(self):
+        """
+        payload limit of the next data frame.
+        """
+        limit = self.cont_frame.remaining()
+        if limit is not None and self.deflate:
+            # deflate may make incompressible data a little bigger.
+            limit += limit // 1000 + 64
+        return limit
+
+    def process_frame(self, frame):
+        """
+        process one received frame.
+        return value: tuple of opcode and frame for a whole data message
+            or a control frame, None if the message is not finished yet.
+        """
+        if not frame:
+            # handle error:
+            # 'NoneType' object has no attribute 'opcode'
+            raise Exception("Not a valid frame %s" % frame)
+        elif frame.opcode in (ABNF.OPCODE_TEXT, ABNF.OPCODE_BINARY, ABNF.OPCODE_CONT):
+            self.cont_frame.validate(frame)
+            self._inflate(frame, self.cont_frame.remaining())
+            self.cont_frame.add(frame)
+            self._decode_text(frame)
+
+            if self.cont_frame.is_fire(frame):
+                opcode, frame = self.cont_frame.extract(frame)
+                if opcode == ABNF.OPCODE_TEXT:
+                    frame.text = "".join(self._text_parts)
+                    self._text_decoder = self._text_parts = None
+                return opcode, frame
+            return None
+        if frame.opcode == ABNF.OPCODE_PONG and self.keepalive is not None:
+            self.keepalive.on_pong(self, frame.data)
+        return frame.opcode, frame
+
+    def _decode_text(self, frame):
+        """
+        validate text fragments as they come. the decoded str is kept, so
+        a text message is decoded once and never after it is complete.
+        """
+        if frame.opcode == ABNF.OPCODE_TEXT:
+            self._text_decoder = utf8_decoder()
+            self._text_parts = []
+        elif frame.opcode == ABNF.OPCODE_BINARY:
+            self._text_decoder = self._text_parts = None
+        if self._text_decoder is not None:
+            self._text_parts.append(decode_text(self._text_decoder, frame.data, frame.fin))
+
+    def _inflate(self, frame, max_length=None):
+        if not self.deflate:
+            return
+        # only the first frame of a message has rsv1.
+        if frame.opcode != ABNF.OPCODE_CONT:
+            self._inflating = bool(frame.rsv1)
+        if self._inflating:
+            frame.data = self.deflate.decompress(frame.data, frame.fin, max_length)
+
+    def prepare_frame(self, frame):
+        """
+        compress(if negotiated) and format frame to send.
+        must be called in the order frames go on the wire, the
+        compression context depends on it.
+        return value: list of buffers, see ABNF.formating_buffers
+        """
+        if self.get_mask_key:
+            frame.get_mask_key = self.get_mask_key
+        if self.deflate and frame.fin and not frame.rsv1 and \
+                frame.opcode in (ABNF.OPCODE_TEXT, ABNF.OPCODE_BINARY):
+            if isinstance(frame.data, str):
+                frame.data = frame.data.encode("utf-8")
+            frame.data = self.deflate.compress(frame.data)
+            frame.rsv1 = 1
+        if self.recorder is not None:
+            self.recorder.sent(frame)
+        buffers = frame.formating_buffers(self.stats)
+        if self.stats is not None:
+            self.stats.frame_out(frame.opcode, len(buffers[1]))
+        return buffers
+
+    @abc.abstractmethod
+    def _send_ping(self, payload):
+        """
+        send a ping without waiting, used by keepalive.
+        """
+
+    @abc.abstractmethod
+    def _abort(self, status, reason=""):
+        """
+        drop the connection without a close frame, used by keepalive.
+        """
+
+    @staticmethod
+    def close_payload(status=STATUS_NORMAL, reason=""):
+        if status < 0 or ABNF.LENGTH_16 <= status:
+            raise ValueError("status code is invalid range")
+        return struct.pack("!H", status) + reason.encode("utf-8")
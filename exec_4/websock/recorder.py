@@ -0,0 +1,348 @@
+import json
+import mmap
+import os
+import struct
+import threading
+import time
+from collections import namedtuple
+
+from abnf import ABNF
+from deflate import PerMessageDeflate
+from protocol import websocket_core
+
+# log file: MAGIC, then records of _RECORD followed by the payload.
+MAGIC = b"WSLOG\x001\n"
+# timestamp(time.time_ns), direction, first header byte(fin, rsv, opcode), payload length
+_RECORD = struct.Struct("<QBBQ")
+
+DIRECTION_IN = 0    # received from the peer
+DIRECTION_OUT = 1   # sent to the peer
+DIRECTION_META = 2  # json of the connection(deflate parameters), not a frame
+
+# buffered bytes written to the file at once.
+RECORD_BUFSIZE = 1024 * 1024
+
+log_record = namedtuple("log_record", "timestamp direction fin rsv1 opcode data")
+
+
+class frame_recorder(object):
+    """
+    append every frame of a connection to a binary log, with its time.
+    frames are recorded as on the wire(compressed if permessage-deflate
+    is used) without the mask, so a replay goes through the same
+    decompression as the original connection.
+
+    rec = frame_recorder("chat.wslog")
+    ws.enable_recorder(rec)
+    ...
+    rec.close()
+
+    recv_stream reads frames in chunks, those are not recorded.
+    a record cut by a crash is skipped by frame_log.
+    """
+
+    def __init__(self, path, bufsize=RECORD_BUFSIZE):
+        self.path = path
+        self.file = open(path, "ab", buffering=bufsize)
+        if self.file.tell() == 0:
+            self.file.write(MAGIC)
+        # frames come from the reader and the writer threads.
+        self.lock = threading.Lock()
+        # recorded frames
+        self.frames = 0
+
+    def record(self, direction, frame):
+        data = frame.data
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        b1 = frame.fin << 7 | frame.rsv1 << 6 | frame.rsv2 << 5 | frame.rsv3 << 4 | frame.opcode
+        header = _RECORD.pack(time.time_ns(), direction, b1, len(data))
+        with self.lock:
+            if self.file is None:
+                return
+            self.file.write(header)
+            self.file.write(data)
+            self.frames += 1
+
+    def received(self, frame):
+        self.record(DIRECTION_IN, frame)
+
+    def sent(self, frame):
+        self.record(DIRECTION_OUT, frame)
+
+    def record_meta(self, meta):
+        """
+        meta: dict written as json, see websocket_core.enable_recorder.
+        """
+        data = json.dumps(meta).encode("utf-8")
+        with self.lock:
+            if self.file is None:
+                return
+            self.file.write(_RECORD.pack(time.time_ns(), DIRECTION_META, 0, len(data)))
+            self.file.write(data)
+
+    def flush(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.flush()
+
+    def close(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+
+def inflater(meta, direction):
+    """
+    PerMessageDeflate decompressing the frames of direction, None if
+    the connection was not compressed. sent frames were compressed
+    with the client parameters.
+    """
+    params = (meta or {}).get("deflate")
+    if not params:
+        return None
+    if direction == DIRECTION_IN:
+        return PerMessageDeflate(**params)
+    return PerMessageDeflate(
+        server_max_window_bits=params["client_max_window_bits"],
+        server_no_context_takeover=params["client_no_context_takeover"])
+
+
+class frame_log(object):
+    """
+    read a log of frame_recorder. the file is memory-mapped, records are
+    read as they are iterated and their data is a memoryview of the map,
+    so a log bigger than the memory can be scanned.
+
+    with frame_log("chat.wslog") as log:
+        for record in log:
+            print(record.direction, record.opcode, len(record.data))
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, "rb")
+        size = os.fstat(self.file.fileno()).st_size
+        # mmap can not map an empty file.
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ) if size else b""
+        self.view = memoryview(self.map)
+        if self.view[:len(MAGIC)] != MAGIC:
+            self.close()
+            raise ValueError("not a frame log: %s" % path)
+        if size and hasattr(self.map, "madvise"):
+            self.map.madvise(mmap.MADV_SEQUENTIAL)
+
+    def __iter__(self):
+        return self.records()
+
+    def records(self, direction=None):
+        """
+        direction: DIRECTION_IN or DIRECTION_OUT to take only those
+            frames, None is all frames. meta records are not returned.
+        """
+        view = self.view
+        offset = len(MAGIC)
+        end = len(view)
+        while offset + _RECORD.size <= end:
+            timestamp, d, b1, length = _RECORD.unpack_from(view, offset)
+            offset += _RECORD.size
+            if offset + length > end:
+                # cut by a crash while recording
+                return
+            data = view[offset:offset + length]
+            offset += length
+            if d != DIRECTION_META and (direction is None or d == direction):
+                yield log_record(timestamp, d, b1 >> 7 & 1, b1 >> 6 & 1, b1 & 0xf, data)
+
+    def meta(self):
+        """
+        the first meta record, None if there is none.
+        """
+        view = self.view
+        offset = len(MAGIC)
+        while offset + _RECORD.size <= len(view):
+            _, d, _, length = _RECORD.unpack_from(view, offset)
+            offset += _RECORD.size
+            if d == DIRECTION_META and offset + length <= len(view):
+                return json.loads(bytes(view[offset:offset + length]))
+            offset += length
+        return None
+
+    def close(self):
+        try:
+            self.view.release()
+            if isinstance(self.map, mmap.mmap):
+                self.map.close()
+        except BufferError:
+            # data of a record is still referenced, the map is
+            # unmapped when the last of them is gone.
+            pass
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def paced(records, speed=None):
+    """
+    yield records at their recorded pace.
+    speed: 1.0 is the original pace, 2.0 twice as fast, None as fast as possible.
+    """
+    start = None
+    for record in records:
+        if speed is not None:
+            now = time.monotonic()
+            if start is None:
+                start = (now, record.timestamp)
+            else:
+                wait = (record.timestamp - start[1]) / 1e9 / speed - (now - start[0])
+                if wait > 0:
+                    time.sleep(wait)
+        yield record
+
+
+class _replay_core(websocket_core):
+    """
+    websocket_core fed from a log, there is no peer to ping or drop.
+    """
+
+    def _send_ping(self, payload):
+        pass
+
+    def _abort(self, status, reason=""):
+        self.close_status = status
+
+
+def replay_parser(path, on_message=None, direction=DIRECTION_IN, speed=None,
+                  max_message_size=None):
+    """
+    feed the recorded frames of direction to a sans-IO websocket_core,
+    as if they came from the socket again.
+    on_message: function(opcode, frame) called for every data message
+        and control frame.
+    return value: count of messages and control frames.
+    """
+    count = 0
+    with frame_log(path) as log:
+        core = _replay_core(None, max_message_size)
+        core.deflate = inflater(log.meta(), direction)
+        core.frame_buffer.allow_rsv1 = core.deflate is not None
+        for record in paced(log.records(direction), speed):
+            frame = ABNF(record.fin, record.rsv1, 0, 0, record.opcode, 0, record.data)
+            core.frame_buffer.feed(frame._frame_header())
+            core.frame_buffer.feed(record.data)
+            frame = core.frame_buffer.next_frame(core._frame_limit())
+            result = core.process_frame(frame)
+            if result is None:
+                continue
+            count += 1
+            if on_message:
+                on_message(*result)
+    return count
+
+
+def replay_server(path, url, on_message=None, speed=None, **options):
+    """
+    connect to url and send the recorded frames again, at their pace.
+    compressed frames are sent decompressed, the new connection
+    compresses with what it negotiates. received frames are read by a
+    thread and given to on_message(opcode, frame).
+    options: create_connection options.
+    return value: count of sent frames.
+    """
+    from websock import create_connection
+
+    sent = 0
+    ws = create_connection(url, **options)
+    reader = threading.Thread(target=_drain, args=(ws, on_message), name="websock-replay")
+    reader.daemon = True
+    reader.start()
+    try:
+        closed = False
+        with frame_log(path) as log:
+            deflate = inflater(log.meta(), DIRECTION_OUT)
+            inflating = False
+            for record in paced(log.records(DIRECTION_OUT), speed):
+                data = record.data
+                if deflate is not None and record.opcode < ABNF.OPCODE_CLOSE:
+                    if record.opcode != ABNF.OPCODE_CONT:
+                        inflating = bool(record.rsv1)
+                    if inflating:
+                        data = deflate.decompress(data, record.fin)
+                ws.send_frame(ABNF(record.fin, 0, 0, 0, record.opcode, 1, bytes(data)))
+                sent += 1
+                closed = record.opcode == ABNF.OPCODE_CLOSE
+                if closed:
+                    # nothing may follow a close frame
+                    break
+        if not closed and ws.sock:
+            ws.send_close()
+        # wait for the close frame of the server
+        reader.join(options.get("timeout") or 3)
+    finally:
+        if ws.sock:
+            ws.sock.close()
+            ws.sock = None
+    return sent
+
+
+def _drain(ws, on_message):
+    try:
+        while ws.connected:
+            opcode, frame = ws.recv_data_frame(True)
+            if on_message:
+                on_message(opcode, frame)
+            if opcode == ABNF.OPCODE_CLOSE:
+                return
+    except Exception:
+        pass
+
+
+def main():
+    """
+    python recorder.py info log.wslog
+    python recorder.py replay log.wslog [ws://localhost:5001/] [--speed 1.0]
+    """
+    import sys
+
+    args = sys.argv[1:]
+    speed = None
+    if "--speed" in args:
+        i = args.index("--speed")
+        speed = float(args[i + 1])
+        del args[i:i + 2]
+    if len(args) < 2 or args[0] not in ("info", "replay"):
+        print(main.__doc__)
+        return
+
+    if args[0] == "info":
+        counts = {}
+        first = last = None
+        with frame_log(args[1]) as log:
+            for record in log:
+                key = ("in" if record.direction == DIRECTION_IN else "out",
+                       ABNF.OPCODE_MAP.get(record.opcode, record.opcode))
+                frames, size = counts.get(key, (0, 0))
+                counts[key] = (frames + 1, size + len(record.data))
+                first = record.timestamp if first is None else first
+                last = record.timestamp
+            print("meta:", log.meta())
+        for (direction, opcode), (frames, size) in sorted(counts.items()):
+            print("%-3s %-6s %10d frames %14d bytes" % (direction, opcode, frames, size))
+        if first is not None:
+            print("duration: %.3f s" % ((last - first) / 1e9))
+    elif len(args) > 2:
+        sent = replay_server(args[1], args[2], speed=speed)
+        print("sent %d frames" % sent)
+    else:
+        def show(opcode, frame):
+            print(ABNF.OPCODE_MAP.get(opcode, opcode), frame.text if frame.text is not None else frame.data)
+        replay_parser(args[1], show, speed=speed)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,168 @@
+import threading
+from collections import deque
+
+from abnf import ABNF
+
+# what put does with a data frame while the queue is over the high watermark.
+POLICY_BLOCK = "block"              # wait until it is under the low watermark
+POLICY_DROP = "drop"                # drop the new message
+POLICY_DROP_OLDEST = "drop_oldest"  # drop queued messages, oldest first
+POLICY_COALESCE = "coalesce"        # the new message replaces all queued ones
+
+HIGH_WATER = 1024 * 1024
+
+
+class send_queue(object):
+    """
+    outbound queue of one WebSocket with a writer thread, so a slow peer
+    blocks the writer only, not every thread sending on the connection.
+
+    queued bytes are counted by payload. over high_water the queue is
+    paused(see the policies) until the writer brings it under low_water.
+    control frames(ping, pong, close) go before queued data.
+    frames are encoded by the writer in wire order, so dropping or
+    coalescing never breaks the permessage-deflate context.
+    """
+
+    def __init__(self, websock, high_water=HIGH_WATER, low_water=None, policy=POLICY_BLOCK):
+        if policy not in (POLICY_BLOCK, POLICY_DROP, POLICY_DROP_OLDEST, POLICY_COALESCE):
+            raise ValueError("unknown policy %r" % policy)
+        self.websock = websock
+        self.high_water = high_water
+        self.low_water = high_water // 4 if low_water is None else low_water
+        self.policy = policy
+        self.control = deque()
+        self.data = deque()
+        # payload bytes in data and being written
+        self.bytes = 0
+        self.paused = False
+        # messages dropped by the policy
+        self.dropped = 0
+        self.writing = False
+        self.closed = False
+        self.error = None
+        self.cond = threading.Condition()
+        self.thread = threading.Thread(target=self._run, name="websock-writer")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def put(self, frame, block=True, timeout=None):
+        """
+        queue frame.
+        block: wait while paused(POLICY_BLOCK). False never waits.
+        return value: True if queued, False if it was dropped or
+            not queued because the queue is paused.
+        """
+        with self.cond:
+            if self.error is not None:
+                raise self.error
+            if self.closed:
+                raise Exception("send queue is closed.")
+            if frame.opcode >= ABNF.OPCODE_CLOSE:
+                self.control.append(frame)
+                self.cond.notify_all()
+                return True
+
+            if self.paused:
+                if self.policy == POLICY_DROP_OLDEST:
+                    self._drop(False)
+                elif self.policy == POLICY_COALESCE:
+                    self._drop(True)
+                elif self.policy == POLICY_DROP:
+                    self.dropped += 1
+                    return False
+                elif not block:
+                    return False
+                elif not self.cond.wait_for(lambda: not self.paused or self.closed, timeout):
+                    return False
+                if self.closed:
+                    raise self.error or Exception("send queue is closed.")
+
+            self.data.append(frame)
+            self.bytes += len(frame.data)
+            if self.bytes >= self.high_water:
+                self.paused = True
+            self.cond.notify_all()
+            return True
+
+    def _drop(self, everything):
+        """
+        drop queued messages, oldest first, until the queue is under the
+        low watermark(or all of them). fragments are never dropped.
+        """
+        kept = deque()
+        while self.data and (everything or self.bytes > self.low_water):
+            frame = self.data.popleft()
+            if frame.fin and frame.opcode != ABNF.OPCODE_CONT:
+                self.bytes -= len(frame.data)
+                self.dropped += 1
+            else:
+                kept.append(frame)
+        kept.extend(self.data)
+        self.data = kept
+        if self.bytes <= self.low_water:
+            self.paused = False
+
+    def _run(self):
+        while True:
+            with self.cond:
+                self.cond.wait_for(lambda: self.control or self.data or self.closed)
+                if self.control:
+                    frame = self.control.popleft()
+                    size = 0
+                elif self.data:
+                    frame = self.data.popleft()
+                    size = len(frame.data)
+                else:
+                    return
+                self.writing = True
+
+            try:
+                self.websock._write_frame(frame)
+            except Exception as e:
+                with self.cond:
+                    self.error = e
+                    self._stop()
+                return
+
+            with self.cond:
+                self.writing = False
+                self.bytes -= size
+                if self.paused and self.bytes <= self.low_water:
+                    self.paused = False
+                if frame.opcode == ABNF.OPCODE_CLOSE:
+                    # nothing may follow a close frame
+                    self._stop()
+                    return
+                self.cond.notify_all()
+
+    def _stop(self):
+        self.closed = True
+        self.writing = False
+        self.control.clear()
+        self.data.clear()
+        self.bytes = 0
+        self.paused = False
+        self.cond.notify_all()
+
+    def flush(self, timeout=None):
+        """
+        wait until every queued frame is written.
+        return value: False on timeout.
+        """
+        with self.cond:
+            done = self.cond.wait_for(
+                lambda: not (self.control or self.data or self.writing), timeout)
+            if self.error is not None:
+                raise self.error
+            return done
+
+    def close(self, timeout=None):
+        """
+        write what is queued, then stop the writer.
+        """
+        self.flush(timeout)
+        with self.cond:
+            self._stop()
+        if self.thread is not threading.current_thread():
+            self.thread.join(timeout)
@@ -0,0 +1,219 @@
+import asyncio
+import struct
+import sys
+
+from util_http import parse_request, MAX_HEADER_SIZE
+from handshark import server_handshake
+from abnf import ABNF, WebSocketProtocolException, frame_buffer, continuous_frame, \
+    STATUS_NORMAL, STATUS_GOING_AWAY
+
+# bytes waiting in the transport of one client before it counts as slow.
+SEND_BUFFER_SIZE = 4 * 1024 * 1024
+# seconds a slow client has to drain its buffer(below a quarter of
+# SEND_BUFFER_SIZE) before it is dropped.
+SLOW_CLIENT_TIMEOUT = 10.0
+# hard limit of the buffered bytes of one client, it is dropped at once
+# instead of buffering more.
+SEND_BUFFER_LIMIT = 4 * SEND_BUFFER_SIZE
+
+
+class _client(object):
+    """
+    one connected client of broadcast_server.
+    """
+
+    def __init__(self, server, reader, writer):
+        self.server = server
+        self.reader = reader
+        self.writer = writer
+        self.frame_buffer = frame_buffer(None, 4096)
+        self.cont_frame = continuous_frame(server.max_message_size)
+        # drain() waits while more than SEND_BUFFER_SIZE bytes are buffered
+        writer.transport.set_write_buffer_limits(high=SEND_BUFFER_SIZE)
+        # task dropping the client if its buffer does not drain in time
+        self.watch = None
+        self.closed = False
+
+    def put(self, frame):
+        """
+        write an encoded frame(bytes shared with the other clients)
+        without waiting, the transport buffers what the socket does not take.
+        """
+        if self.closed or self.writer.transport.is_closing():
+            return
+        buffered = self.writer.transport.get_write_buffer_size()
+        if buffered and buffered + len(frame) > SEND_BUFFER_LIMIT:
+            # one frame bigger than the limit still goes to an empty buffer
+            self.abort()
+            return
+        self.writer.write(frame)
+        if self.watch is None and buffered + len(frame) > SEND_BUFFER_SIZE:
+            self.watch = asyncio.ensure_future(self._watch_slow())
+
+    async def _watch_slow(self):
+        # a burst is fine, a reader which stays behind is dropped so it
+        # does not hold the memory of the frames of the others.
+        try:
+            await asyncio.wait_for(self.writer.drain(), SLOW_CLIENT_TIMEOUT)
+        except (asyncio.TimeoutError, ConnectionError, OSError):
+            self.abort()
+        finally:
+            self.watch = None
+
+    def abort(self):
+        self.closed = True
+        self.writer.transport.abort()
+
+    async def reader_loop(self):
+        while not self.closed:
+            data = await self.reader.read(65536)
+            if not data:
+                return
+            self.frame_buffer.feed(data)
+            while not self.closed:
+                frame = self.frame_buffer.next_frame(self.cont_frame.remaining())
+                if frame is None:
+                    break
+                self.on_frame(frame)
+            if self.watch is not None:
+                # do not read more from a client which does not read its own frames.
+                await asyncio.shield(self.watch)
+
+    def on_frame(self, frame):
+        if not frame.mask:
+            raise WebSocketProtocolException("client frame is not masked")
+        if frame.opcode in (ABNF.OPCODE_TEXT, ABNF.OPCODE_BINARY, ABNF.OPCODE_CONT):
+            self.cont_frame.validate(frame)
+            self.cont_frame.add(frame)
+            if self.cont_frame.is_fire(frame):
+                opcode, frame = self.cont_frame.extract(frame)
+                self.server.on_message(self, opcode, frame.data)
+        elif frame.opcode == ABNF.OPCODE_PING:
+            self.put(encode_frame(frame.data, ABNF.OPCODE_PONG))
+        elif frame.opcode == ABNF.OPCODE_CLOSE:
+            self.close(STATUS_NORMAL)
+
+    def close(self, status, reason=""):
+        if self.closed:
+            return
+        self.closed = True
+        if self.writer.transport.is_closing():
+            return
+        payload = struct.pack("!H", status) + reason.encode("utf-8")
+        # close frame goes after the buffered frames.
+        self.writer.write(encode_frame(payload, ABNF.OPCODE_CLOSE))
+
+
+def encode_frame(data, opcode):
+    """
+    encode one server to client frame(unmasked).
+    the result is shared as is by every recipient.
+    """
+    return bytes(ABNF(1, 0, 0, 0, opcode, 0, data).formating())
+
+
+class broadcast_server(object):
+    """
+    relay server, same as multiserver_ws.js: every message from a client
+    is sent to all the other clients.
+    each broadcast frame is encoded once and shared by the recipients.
+    a client whose write buffer stays over SEND_BUFFER_SIZE for
+    SLOW_CLIENT_TIMEOUT, or reaches SEND_BUFFER_LIMIT, is dropped instead
+    of stalling the others.
+    """
+
+    def __init__(self, host="0.0.0.0", port=5001, max_message_size=None, verbose=False,
+                 echo=False, ssl_context=None):
+        """
+        echo: send messages back to the sender only(echo server, for benchmarks).
+        ssl_context: server SSLContext to serve wss.
+        """
+        self.host = host
+        self.port = port
+        self.max_message_size = max_message_size
+        self.verbose = verbose
+        self.echo = echo
+        self.ssl_context = ssl_context
+        self.clients = set()
+        self.server = None
+
+    async def start(self):
+        self.server = await asyncio.start_server(
+            self.handle, self.host, self.port, limit=MAX_HEADER_SIZE, ssl=self.ssl_context)
+        return self.server
+
+    async def serve_forever(self):
+        await self.start()
+        async with self.server:
+            await self.server.serve_forever()
+
+    def on_message(self, client, opcode, data):
+        if self.echo:
+            client.put(encode_frame(data, opcode))
+        else:
+            self.broadcast(opcode, data, client)
+
+    def broadcast(self, opcode, data, sender=None):
+        if self.verbose and opcode == ABNF.OPCODE_TEXT:
+            print("Received: " + data.decode("utf-8", "replace"))
+        frame = encode_frame(data, opcode)
+        for client in self.clients:
+            if client is not sender:
+                client.put(frame)
+
+    async def handle(self, reader, writer):
+        try:
+            header = await reader.readuntil(b"\r\n\r\n")
+            writer.write(server_handshake(*parse_request(header)))
+        except Exception:
+            writer.close()
+            return
+
+        client = _client(self, reader, writer)
+        self.clients.add(client)
+        try:
+            await client.reader_loop()
+        except WebSocketProtocolException as e:
+            client.close(e.status, str(e)[:120])
+        except (ConnectionError, OSError):
+            client.abort()
+        finally:
+            self.clients.discard(client)
+            if not client.closed:
+                client.close(STATUS_GOING_AWAY)
+            if not writer.transport.is_closing():
+                try:
+                    # the close frame and what is left before it
+                    await asyncio.wait_for(writer.drain(), 3)
+                except (asyncio.TimeoutError, ConnectionError, OSError):
+                    client.abort()
+            writer.close()
+
+
+def main():
+    """
+    python server_ws.py [--echo] [--cert cert.pem --key key.pem] [port]
+    """
+    args = sys.argv[1:]
+    echo = "--echo" in args
+    args = [a for a in args if a != "--echo"]
+    ssl_context = None
+    if "--cert" in args:
+        i = args.index("--cert")
+        cert = args[i + 1]
+        del args[i:i + 2]
+        key = None
+        if "--key" in args:
+            i = args.index("--key")
+            key = args[i + 1]
+            del args[i:i + 2]
+        import ssl
+        ssl_context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+        ssl_context.load_cert_chain(cert, key)
+    port = int(args[0]) if args else 5001
+    server = broadcast_server(port=port, verbose=not echo, echo=echo, ssl_context=ssl_context)
+    asyncio.run(server.serve_forever())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,199 @@
+import math
+import time
+
+from abnf import ABNF
+
+
+class ws_stats(object):
+    """
+    opt-in counters of one connection.
+    the hot paths only check `stats is not None` when it is disabled.
+    """
+
+    def __init__(self):
+        # opcode -> count / bytes(payload length on the wire)
+        self.frames_in = {}
+        self.bytes_in = {}
+        self.frames_out = {}
+        self.bytes_out = {}
+        # socket calls
+        self.recv_calls = 0
+        self.recv_bytes = 0
+        self.recv_seconds = 0.0
+        self.send_calls = 0
+        self.send_bytes = 0
+        # CPU time in the codec
+        self.mask_seconds = 0.0
+        self.parse_seconds = 0.0
+        # lock name -> seconds waited
+        self.lock_wait_seconds = {}
+        self.handshake_seconds = None
+        # name -> function returning the current value(queue depths, ...)
+        self.gauges = {}
+        # function(direction, opcode, length) called for every frame
+        self.callbacks = []
+
+    def add_callback(self, fn):
+        """
+        fn(direction, opcode, length): direction is "in" or "out".
+        """
+        self.callbacks.append(fn)
+
+    def frame_in(self, opcode, length):
+        self.frames_in[opcode] = self.frames_in.get(opcode, 0) + 1
+        self.bytes_in[opcode] = self.bytes_in.get(opcode, 0) + length
+        for fn in self.callbacks:
+            fn("in", opcode, length)
+
+    def frame_out(self, opcode, length):
+        self.frames_out[opcode] = self.frames_out.get(opcode, 0) + 1
+        self.bytes_out[opcode] = self.bytes_out.get(opcode, 0) + length
+        for fn in self.callbacks:
+            fn("out", opcode, length)
+
+    def lock_wait(self, name, seconds):
+        self.lock_wait_seconds[name] = self.lock_wait_seconds.get(name, 0.0) + seconds
+
+    def snapshot(self):
+        """
+        return value: dict of the current values.
+        """
+        def by_name(d):
+            return {ABNF.OPCODE_MAP.get(k, str(k)): v for k, v in d.items()}
+
+        return {
+            "frames_in": by_name(self.frames_in),
+            "bytes_in": by_name(self.bytes_in),
+            "frames_out": by_name(self.frames_out),
+            "bytes_out": by_name(self.bytes_out),
+            "recv_calls": self.recv_calls,
+            "recv_bytes": self.recv_bytes,
+            "recv_seconds": self.recv_seconds,
+            "send_calls": self.send_calls,
+            "send_bytes": self.send_bytes,
+            "mask_seconds": self.mask_seconds,
+            "parse_seconds": self.parse_seconds,
+            "lock_wait_seconds": dict(self.lock_wait_seconds),
+            "handshake_seconds": self.handshake_seconds,
+            "gauges": {name: fn() for name, fn in self.gauges.items()},
+        }
+
+
+class latency_histogram(object):
+    """
+    log scale histogram of latencies, 4 buckets per power of two of
+    microseconds(at most 19% error). counts of histograms of other
+    threads or processes are merged with merge.
+    """
+    SUB_BUCKETS = 4
+    # 2 ** 27 us, about 2 minutes
+    BUCKETS = 27 * SUB_BUCKETS
+
+    def __init__(self, counts=None):
+        self.counts = list(counts) if counts is not None else [0] * self.BUCKETS
+        self.count = sum(self.counts)
+        self.max = 0.0
+
+    def add(self, seconds):
+        us = seconds * 1e6
+        i = int(math.log2(us) * self.SUB_BUCKETS) if us > 1 else 0
+        self.counts[min(i, self.BUCKETS - 1)] += 1
+        self.count += 1
+        if seconds > self.max:
+            self.max = seconds
+
+    def merge(self, other):
+        for i, n in enumerate(other.counts):
+            self.counts[i] += n
+        self.count += other.count
+        self.max = max(self.max, other.max)
+
+    def percentile(self, p):
+        """
+        return value: seconds(upper bound of the bucket), None if empty.
+        """
+        if not self.count:
+            return None
+        rank = self.count * p / 100.0
+        seen = 0
+        for i, n in enumerate(self.counts):
+            seen += n
+            if n and seen >= rank:
+                return min(2 ** ((i + 1) / self.SUB_BUCKETS) / 1e6, self.max or float("inf"))
+        return self.max
+
+    def snapshot(self):
+        return {"counts": self.counts, "count": self.count, "max": self.max}
+
+    @classmethod
+    def from_snapshot(cls, snap):
+        histogram = cls(snap["counts"])
+        histogram.max = snap["max"]
+        return histogram
+
+
+class timed_lock(object):
+    """
+    lock wrapper adding the acquire wait time to ws_stats.
+    only used while stats are enabled.
+    """
+
+    def __init__(self, lock, stats, name):
+        self.lock = lock
+        self.stats = stats
+        self.name = name
+
+    def acquire(self, blocking=True, timeout=-1):
+        start = time.perf_counter()
+        result = self.lock.acquire(blocking, timeout)
+        self.stats.lock_wait(self.name, time.perf_counter() - start)
+        return result
+
+    def release(self):
+        self.lock.release()
+
+    def locked(self):
+        return self.lock.locked()
+
+    def __enter__(self):
+        return self.acquire()
+
+    def __exit__(self, *args):
+        self.release()
+
+
+def prometheus_text(stats, prefix="websock"):
+    """
+    dump stats in the Prometheus text exposition format.
+    stats: dict of connection label -> ws_stats.
+    """
+    samples = {}
+
+    def add(name, kind, labels, value):
+        if value is None:
+            return
+        samples.setdefault((name, kind), []).append((labels, value))
+
+    for conn, s in stats.items():
+        snap = s.snapshot()
+        for key in ("frames_in", "bytes_in", "frames_out", "bytes_out"):
+            for opcode, value in snap[key].items():
+                add("%s_%s_total" % (prefix, key), "counter",
+                    {"conn": conn, "opcode": opcode}, value)
+        for key in ("recv_calls", "recv_bytes", "recv_seconds", "send_calls",
+                    "send_bytes", "mask_seconds", "parse_seconds"):
+            add("%s_%s_total" % (prefix, key), "counter", {"conn": conn}, snap[key])
+        for lock, value in snap["lock_wait_seconds"].items():
+            add("%s_lock_wait_seconds_total" % prefix, "counter",
+                {"conn": conn, "lock": lock}, value)
+        add("%s_handshake_seconds" % prefix, "gauge", {"conn": conn}, snap["handshake_seconds"])
+        for name, value in snap["gauges"].items():
+            add("%s_%s" % (prefix, name), "gauge", {"conn": conn}, value)
+
+    lines = []
+    for (name, kind), values in samples.items():
+        lines.append("# TYPE %s %s" % (name, kind))
+        for labels, value in values:
+            label = ",".join('%s="%s"' % (k, str(v).replace('"', '\\"')) for k, v in labels.items())
+            lines.append("%s{%s} %s" % (name, label, value))
+    return "\n".join(lines) + "\n"
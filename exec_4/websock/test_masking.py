@@ -0,0 +1,38 @@
+import os
+import unittest
+
+import masking
+from masking import mask_inplace, NUMPY_THRESHOLD
+
+
+def naive_mask(mask_key, data, offset=0):
+    return bytes(b ^ mask_key[(offset + i) & 3] for i, b in enumerate(data))
+
+
+class mask_inplace_test(unittest.TestCase):
+
+    def check(self, length, offset=0):
+        key = os.urandom(4)
+        data = os.urandom(length)
+        buf = bytearray(data)
+        mask_inplace(key, buf, offset)
+        self.assertEqual(bytes(buf), naive_mask(key, data, offset), (length, offset))
+
+    def test_numpy_lengths(self):
+        for k in range(16):
+            for offset in range(4):
+                self.check(NUMPY_THRESHOLD + k, offset)
+
+    def test_python_lengths(self):
+        for length in (0, 1, 3, 4, 7, 125, NUMPY_THRESHOLD - 1):
+            for offset in range(4):
+                self.check(length, offset)
+
+    @unittest.skipIf(masking.load_numpy() is None, "numpy is not installed")
+    def test_numpy_path_is_used(self):
+        self.assertIsNotNone(masking.numpy)
+        self.check(65535, 5)
+
+
+if __name__ == "__main__":
+    unittest.main()
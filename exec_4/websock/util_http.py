@@ -2,10 +2,25 @@ import errno
 import os
 import socket
 import sys
+import threading
+from collections import OrderedDict
 from urllib.parse import urlparse
 
 TIMEOUT = None
 DEFAULT_SOCKET_OPTION = [(socket.SOL_TCP, socket.TCP_NODELAY, 1)]
+# max bytes of HTTP headers in the handshake.
+MAX_HEADER_SIZE = 65536
+# max buffers for one sendmsg call.
+try:
+    IOV_MAX = os.sysconf("SC_IOV_MAX")
+except (AttributeError, ValueError, OSError):
+    IOV_MAX = 1024
+# max plaintext of one TLS record.
+TLS_RECORD_SIZE = 16384
+# bytes given to one SSL write, a few whole records.
+TLS_WRITE_SIZE = 4 * TLS_RECORD_SIZE
+# TLS sessions kept for resumption.
+TLS_SESSION_CACHE_SIZE = 1024
 
 def parse_url(url):
     if ":" not in url:
@@ -22,9 +37,14 @@ def parse_url(url):
     port = 0
     if parsed.port:
         port = parsed.port
+    is_secure = False
     if scheme == "ws":
         if not port:
             port = 80
+    elif scheme == "wss":
+        is_secure = True
+        if not port:
+            port = 443
     else:
         raise ValueError("scheme %s is invalid" % scheme)
 
@@ -35,12 +55,18 @@ def parse_url(url):
 
     if parsed.query:
         resource += "?" + parsed.query
-    return hostname, port, resource
+    return hostname, port, resource, is_secure
 
-def connect(url, sock=None):
-    hostname, port, resource = parse_url(url)
+def connect(url, sock=None, ssl_context=None):
+    """
+    sock: already connected socket, it is wrapped with TLS for wss.
+    ssl_context: SSLContext for wss, default_ssl_context() if None.
+    """
+    hostname, port, resource, is_secure = parse_url(url)
 
     if sock:
+        if is_secure:
+            sock = wrap_tls(sock, hostname, port, ssl_context)
         return sock, (hostname, port, resource)
     
     # dig
@@ -54,6 +80,8 @@ def connect(url, sock=None):
 
     try:
         sock = _open_socket(addrinfo_list)
+        if is_secure:
+            sock = wrap_tls(sock, hostname, port, ssl_context)
         return sock, (hostname, port, resource)
     except Exception as e:
         if sock:
@@ -62,42 +90,92 @@ def connect(url, sock=None):
 
 
 def _open_socket(addrinfo_list):
-    sock = None
+    """
+    connect to the addresses in order, the next one is tried
+    when the connection is refused.
+    """
+    try:
+        # errno.WSAECONNREFUSED windows only
+        eConnRefused = (errno.ECONNREFUSED, errno.WSAECONNREFUSED)
+    except AttributeError:
+        eConnRefused = (errno.ECONNREFUSED, )
+
+    err = None
     for addrinfo in addrinfo_list:
         family, socktype, proto = addrinfo[:3]
         sock = socket.socket(family, socktype, proto)
         sock.settimeout(TIMEOUT)
-        sock.setsockopt(socket.SOL_TCP, socket.TCP_NODELAY, 1)
-        
+        for opt in DEFAULT_SOCKET_OPTION:
+            sock.setsockopt(*opt)
+
         addr = addrinfo[4]
-        err = None
-        while not err:
-            try:
-                sock.connect(addr)
-                err = None
-            except OSError as error:
-                # add err info
-                error.remote_ip = str(addr[0])
-                try:
-                    # errno.WSAECONNREFUSED windows only
-                    eConnRefused = (errno.ECONNREFUSED, errno.WSAECONNREFUSED)
-                except:
-                    eConnRefused = (errno.ECONNREFUSED, )
-                if error.errno == errno.EINTR:
-                    continue
-                elif error.errno in eConnRefused:
-                    err = error
-                    continue
-                else:
-                    raise error
-            else:
-                break
-        else:
-            continue
-    else:
-        if err:
-            raise err
-    return sock
+        try:
+            sock.connect(addr)
+            return sock
+        except OSError as error:
+            sock.close()
+            # add err info
+            error.remote_ip = str(addr[0])
+            if error.errno in eConnRefused:
+                err = error
+                continue
+            raise error
+    raise err
+
+_default_ssl_context = None
+# (context, hostname, port) -> SSLSession, oldest first
+_tls_sessions = OrderedDict()
+_tls_lock = threading.Lock()
+
+def default_ssl_context():
+    """
+    SSLContext shared by all wss connections without their own, loading
+    the CA certificates once instead of per connection.
+    """
+    global _default_ssl_context
+    # ssl is imported by the first wss connection, not by every client.
+    try:
+        import ssl
+    except ImportError:
+        raise ValueError("wss needs the ssl module")
+    with _tls_lock:
+        if _default_ssl_context is None:
+            _default_ssl_context = ssl.create_default_context()
+        return _default_ssl_context
+
+def wrap_tls(sock, hostname, port, ssl_context=None):
+    """
+    TLS handshake on a connected socket. the last session to the same
+    host with the same context is offered for resumption.
+    """
+    context = ssl_context or default_ssl_context()
+    with _tls_lock:
+        session = _tls_sessions.get((context, hostname, port))
+    try:
+        return context.wrap_socket(sock, server_hostname=hostname, session=session)
+    except BaseException:
+        sock.close()
+        raise
+
+def save_tls_session(sock):
+    """
+    keep the session of a TLS socket for the next wrap_tls. call it after
+    something was read, TLS 1.3 tickets come after the handshake.
+    """
+    session = sock.session
+    if session is None or not (session.has_ticket or session.id):
+        return
+    key = (sock.context, sock.server_hostname, sock.getpeername()[1])
+    with _tls_lock:
+        _tls_sessions[key] = session
+        _tls_sessions.move_to_end(key)
+        while len(_tls_sessions) > TLS_SESSION_CACHE_SIZE:
+            _tls_sessions.popitem(last=False)
+
+def is_tls(sock):
+    # no TLS socket exists before ssl is imported
+    ssl = sys.modules.get("ssl")
+    return ssl is not None and isinstance(sock, ssl.SSLSocket)
 
 def send(sock, data):
     # data = data.encode('utf-8')
@@ -110,6 +188,52 @@ def send(sock, data):
     except Exception as e:
             raise e
 
+def sendmsg(sock, buffers):
+    """
+    send buffers with one gather write.
+    return value: sent bytes, may be less than the sum of buffers.
+    """
+    if not sock:
+        raise Exception("socket is already closed.")
+    if not hasattr(sock, "sendmsg"):
+        # no gather write on this platform(windows)
+        return sock.send(buffers[0])
+    try:
+        return sock.sendmsg(buffers)
+    except socket.timeout as e:
+        raise e
+    except Exception as e:
+        raise e
+
+def send_buffers_tls(sock, buffers):
+    """
+    TLS sockets have no gather write. small buffers are joined so that a
+    frame header never becomes a record of its own, big payloads are
+    written in TLS_WRITE_SIZE slices without copying.
+    return value: sent bytes.
+    """
+    if not sock:
+        raise Exception("socket is already closed.")
+    pending = bytearray()
+    length = 0
+    for b in buffers:
+        view = memoryview(b).cast("B")
+        length += len(view)
+        if len(pending) + len(view) <= TLS_WRITE_SIZE:
+            pending += view
+            continue
+        fill = TLS_WRITE_SIZE - len(pending)
+        pending += view[:fill]
+        sock.sendall(pending)
+        view = view[fill:]
+        while len(view) > TLS_WRITE_SIZE:
+            sock.sendall(view[:TLS_WRITE_SIZE])
+            view = view[TLS_WRITE_SIZE:]
+        pending = bytearray(view)
+    if pending:
+        sock.sendall(pending)
+    return length
+
 def recv(sock, bufsize):
     if not sock:
         raise Exception("socket is already closed.")
@@ -126,42 +250,96 @@ def recv(sock, bufsize):
 
     return bytedatas
 
-def recv_line(sock):
-    line = ""
-    while True:
-        c = recv(sock, 1)
-        line += c.decode('utf-8')
-        if c.decode("utf-8") == "\n":
-            break
-    return line
+def recv_into(sock, buf, nbytes=0):
+    if not sock:
+        raise Exception("socket is already closed.")
+    try:
+        n = sock.recv_into(buf, nbytes)
+    except socket.timeout as e:
+        raise Exception(e)
+    except Exception as e:
+        raise Exception(e)
 
+    if not n:
+        raise Exception("Connection is already closed.")
 
-def read_headers(sock):
-    status = None
-    status_message = None
-    headers = {}
+    return n
+
+def read_headers(sock, max_size=MAX_HEADER_SIZE):
+    """
+    read HTTP status line and headers. the socket is read in blocks
+    until the empty line, not byte by byte.
+    max_size: limit of the header bytes.
+    return value: tuple of status, headers, status message and the bytes
+        received after the headers(early frames, must not be lost).
+    """
+    header, surplus = read_header_block(sock, max_size)
+    status, headers, status_message = parse_headers(header)
+    return status, headers, status_message, surplus
 
+def read_header_block(sock, max_size=MAX_HEADER_SIZE, bufsize=4096):
+    """
+    return value: tuple of header bytes(with the empty line) and the bytes after it.
+    """
+    buf = bytearray(min(bufsize, max_size))
+    length = 0
     while True:
-        line = recv_line(sock)
-        line = line.strip()
-        if not line:
-            break
-        if not status:
+        if length == len(buf):
+            if length >= max_size:
+                raise Exception("Header is too long")
+            buf += bytes(min(len(buf), max_size - length))
+        with memoryview(buf) as view:
+            n = recv_into(sock, view[length:])
+        # "\r\n\r\n" may start in the previous block
+        start = max(0, length - 3)
+        length += n
+        end = buf.find(b"\r\n\r\n", start, length)
+        if end >= 0:
+            return bytes(buf[:end + 4]), bytes(buf[end + 4:length])
 
-            status_info = line.split(" ", 2)
-            status = int(status_info[1])
-            if len(status_info) > 2:
-                status_message = status_info[2]
-        else:
-            kv = line.split(":", 1)
-            if len(kv) == 2:
-                key, value = kv
-                headers[key.lower()] = value.strip()
-            else:
-                raise Exception("Invalid header")
+def parse_headers(data):
+    """
+    parse HTTP status line and headers in one pass.
+    data: header bytes up to the empty line.
+    return value: tuple of status, headers(lower case keys) and status message.
+    """
+    lines = bytes(data).decode("utf-8").split("\r\n")
+    status_info = lines[0].split(" ", 2)
+    try:
+        status = int(status_info[1])
+    except (IndexError, ValueError):
+        raise Exception("Invalid status line %r" % lines[0])
+    status_message = status_info[2] if len(status_info) > 2 else None
 
+    return status, _parse_header_lines(lines[1:]), status_message
 
-    return status, headers, status_message
+def parse_request(data):
+    """
+    parse HTTP request line and headers(server side).
+    data: header bytes up to the empty line.
+    return value: tuple of method, resource and headers(lower case keys).
+    """
+    lines = bytes(data).decode("utf-8").split("\r\n")
+    request_info = lines[0].split(" ")
+    if len(request_info) != 3:
+        raise Exception("Invalid request line %r" % lines[0])
+    method, resource, _ = request_info
+
+    return method, resource, _parse_header_lines(lines[1:])
+
+def _parse_header_lines(lines):
+    headers = {}
+    for line in lines:
+        if not line:
+            break
+        kv = line.split(":", 1)
+        if len(kv) == 2:
+            key, value = kv
+            headers[key.strip().lower()] = value.strip()
+        else:
+            raise Exception("Invalid header")
+    return headers
 
 def set_timeout(time):
+    global TIMEOUT
     TIMEOUT = time
@@ -1,23 +1,77 @@
-from util_http import *
-from handshark import *
-from abnf import *
+from util_http import connect, send, sendmsg, send_buffers_tls, recv_into, set_timeout, \
+    is_tls, save_tls_session, IOV_MAX, TLS_RECORD_SIZE
+from handshark import handshake
+from abnf import ABNF, WebSocketProtocolException, STATUS_NORMAL
+from protocol import websocket_core, utf8_decoder, decode_text
+from stats import timed_lock
+from send_queue import send_queue, HIGH_WATER, POLICY_BLOCK
 
-import numpy
+import select
+import socket
 import threading
-import struct
-class WebSocket():
-    def __init__(self):
-        self.handshake_response = None
+import time
+
+# frames with a payload up to this are copied into the batch buffer,
+# bigger ones go to sendmsg as their own iovec.
+BATCH_COPY_SIZE = 4096
+# bytes of a batch flushed with one sendmsg.
+BATCH_MAX_BYTES = 65536
+
+
+class WebSocket(websocket_core):
+    def __init__(self, max_message_size=None, stats=False):
+        """
+        max_message_size: limit of a received message in bytes, a bigger
+            message closes the connection with STATUS_MESSAGE_TOO_BIG.
+            None is unlimited. recv_stream is not limited by this.
+        stats: collect ws_stats from the start(see enable_stats).
+        """
+        super().__init__(self._recv_into, max_message_size)
         self.sock = None
-        self.connected = False
-        self.get_mask_key = None
         self.lock = threading.Lock()
         self.readlock = threading.Lock()
-        self.frame_buffer = frame_buffer(self._recv)
-    def connect(self, url, **options):
-        self.sock, addrs = connect(url)
+        # batched frames not written yet(send_many / cork), guarded by lock.
+        self._batch = []
+        self._batch_tail = bytearray()
+        self._batch_bytes = 0
+        self.batch_max_bytes = BATCH_MAX_BYTES
+        # seconds a corked frame may wait, None when not corked.
+        self.batch_max_delay = None
+        # monotonic time the pending corked frames are due, guarded by lock.
+        self._flush_deadline = None
+        self._flush_error = None
+        # one flusher thread per corked connection, woken by _flush_cond.
+        self._flush_cond = threading.Condition()
+        self._flusher = None
+        # send_queue, None until enable_send_queue.
+        self.send_queue = None
+        # a close frame was sent, nothing may follow it.
+        self.close_sent = False
+        if stats:
+            self.enable_stats()
+
+    def enable_stats(self):
+        if self.stats is None:
+            stats = super().enable_stats()
+            self.lock = timed_lock(self.lock, stats, "lock")
+            self.readlock = timed_lock(self.readlock, stats, "readlock")
+        return self.stats
+
+    def connect(self, url, sock=None, **options):
+        """
+        sock: already connected socket to use(see pool.connection_factory).
+        options: handshake options and ssl_context(SSLContext for wss,
+            util_http.default_ssl_context() if not given).
+        """
+        self.sock, addrs = connect(url, sock, options.get("ssl_context"))
         try:
-            self.handshake_response = handshake(self.sock, *addrs, **options)
+            start = time.perf_counter()
+            self._set_handshake(handshake(self.sock, *addrs, recv_buffer=self.frame_buffer, **options))
+            if is_tls(self.sock):
+                save_tls_session(self.sock)
+                self.frame_buffer.read_size = TLS_RECORD_SIZE
+            if self.stats is not None:
+                self.stats.handshake_seconds = time.perf_counter() - start
             self.connected = True
         except Exception as e:
             if self.sock:
@@ -30,7 +84,8 @@ class WebSocket():
         send ping data.
         payload: data payload to send server.
         """
-        payload = payload.encode("utf-8")
+        if isinstance(payload, str):
+            payload = payload.encode("utf-8")
         self.send(payload, ABNF.OPCODE_PING)
 
     def pong(self, payload):
@@ -38,27 +93,72 @@ class WebSocket():
         send pong data.
         payload: data payload to send server.
         """
-        payload = payload.encode("utf-8")
+        if isinstance(payload, str):
+            payload = payload.encode("utf-8")
         self.send(payload, ABNF.OPCODE_PONG)
 
+    def _send_ping(self, payload):
+        """
+        keepalive ping, it never waits: the keepalive thread pings every
+        connection. while another thread holds the write lock or the socket
+        buffer is full the ping is skipped, it counts as missed.
+        """
+        frame = ABNF.create_frame(payload, ABNF.OPCODE_PING)
+        if self.send_queue is not None:
+            # control frames go before queued data and never wait
+            self.send_queue.put(frame, block=False)
+            return
+        if not self.lock.acquire(blocking=False):
+            return
+        try:
+            if self.sock is None:
+                return
+            poller = select.poll()
+            poller.register(self.sock, select.POLLOUT)
+            if poller.poll(0):
+                self._write_frame_locked(frame)
+        finally:
+            self.lock.release()
+
+    def _abort(self, status, reason=""):
+        """
+        a blocked recv in another thread returns with an exception.
+        """
+        self.close_status = status
+        self.connected = False
+        sock = self.sock
+        if sock:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
     def recv(self):
         """
         Receive string data(byte array) from the server.
         return value: string(byte array) value.
         """
         with self.readlock:
-            opcode, data = self.recv_data()
+            opcode, frame = self.recv_data_frame()
 
         if opcode == ABNF.OPCODE_TEXT:
-            return data.decode("utf-8")
+            # decoded(and validated) fragment by fragment while receiving
+            return frame.text
         elif opcode == ABNF.OPCODE_TEXT or opcode == ABNF.OPCODE_BINARY:
-            return data
+            return frame.data
         else:
             return ''
 
-    def _recv(self, bufsize):
+    def _recv_into(self, buf):
         try:
-            return recv(self.sock, bufsize)
+            if self.stats is None:
+                return recv_into(self.sock, buf)
+            start = time.perf_counter()
+            n = recv_into(self.sock, buf)
+            self.stats.recv_seconds += time.perf_counter() - start
+            self.stats.recv_calls += 1
+            self.stats.recv_bytes += n
+            return n
         except Exception as e:
             if self.sock:
                 self.sock.close()
@@ -84,41 +184,67 @@ class WebSocket():
         return  value: tuple of operation code and string(byte array) value.
         """
         while True:
-            frame = self.recv_frame()
-            if not frame:
-                # handle error:
-                # 'NoneType' object has no attribute 'opcode'
-                raise Exception("Not a valid frame %s" % frame)
-            elif frame.opcode in (ABNF.OPCODE_TEXT, ABNF.OPCODE_BINARY, ABNF.OPCODE_CONT):
-                
-                # TODO:: flagment data sum getert
-                # self.cont_frame.validate(frame)
-                # self.cont_frame.add(frame)
-
-                # if self.cont_frame.is_fire(frame):
-                #     return self.cont_frame.extract(frame)
-                return frame.opcode, frame
-
-            elif frame.opcode == ABNF.OPCODE_CLOSE:
+            try:
+                result = self.process_frame(self.recv_frame())
+            except WebSocketProtocolException as e:
+                self._fail(e)
+                raise e
+            if result is None:
+                continue
+
+            opcode, frame = result
+            if opcode in (ABNF.OPCODE_TEXT, ABNF.OPCODE_BINARY):
+                return result
+            self._handle_control(frame)
+            if opcode == ABNF.OPCODE_CLOSE or control_frame:
+                return result
+
+    def _handle_control(self, frame):
+        if frame.opcode == ABNF.OPCODE_CLOSE:
+            # the reply of our close needs no reply. a stopped send queue
+            # is closing already.
+            if not self.close_sent and \
+                    (self.send_queue is None or not self.send_queue.closed):
                 self.send_close()
-                return frame.opcode, frame
-            elif frame.opcode == ABNF.OPCODE_PING:
-                if len(frame.data) < 126:
-                    self.pong(frame.data)
-                else:
-                    raise Exception("Ping message is too long")
-                if control_frame:
-                    return frame.opcode, frame
-            elif frame.opcode == ABNF.OPCODE_PONG:
-                if control_frame:
-                    return frame.opcode, frame
-    
+        elif frame.opcode == ABNF.OPCODE_PING:
+            self.pong(frame.data)
+
+    def recv_stream(self, chunk_size=65536, decode=False):
+        """
+        receive the next data message as a stream of payload chunks.
+        the message is never held in memory as a whole, so multi hundred MB
+        binary messages can be written straight to a file.
+        chunk_size: max bytes of one chunk.
+        decode: chunks of a text message are str, validated as UTF-8 as
+            they come(invalid text closes with STATUS_INVALID_PAYLOAD).
+        return value: message_stream. iterate it for chunks, its opcode
+            attribute is the opcode of the message.
+        """
+        return message_stream(self, chunk_size, decode)
+
+    def _fail(self, e):
+        """
+        close the connection with the status of a protocol error.
+        """
+        try:
+            if self.sock and not self.close_sent:
+                self.send_close(e.status, str(e)[:120])
+                if self.send_queue is not None:
+                    # the close frame skips the queued data, the writer
+                    # stops right after it.
+                    self.send_queue.flush(1)
+        finally:
+            if self.sock:
+                self.sock.close()
+            self.sock = None
+            self.connected = False
+
     def recv_frame(self):
         """
         receive data as frame from server.
         return value: ABNF frame object.
         """
-        return self.frame_buffer.recv_frame()
+        return self.frame_buffer.recv_frame(self._frame_limit())
 
     def send(self, payload, opcode=ABNF.OPCODE_TEXT):
         frame = ABNF.create_frame(payload, opcode)
@@ -127,32 +253,311 @@ class WebSocket():
     def _send(self, data):
         return send(self.sock, data)
     
+    def enable_send_queue(self, high_water=HIGH_WATER, low_water=None, policy=POLICY_BLOCK):
+        """
+        send through a queue drained by a writer thread, see send_queue.
+        send/send_frame then return as soon as the frame is queued.
+        high_water, low_water: queued payload bytes where senders pause
+            and resume(low_water defaults to high_water / 4).
+        policy: POLICY_BLOCK, POLICY_DROP, POLICY_DROP_OLDEST or
+            POLICY_COALESCE, what happens to messages while paused.
+        """
+        if self.send_queue is None:
+            self.send_queue = send_queue(self, high_water, low_water, policy)
+            if self.stats is not None:
+                self.stats.gauges["send_queue_bytes"] = lambda: self.send_queue.bytes
+        return self.send_queue
+
+    def try_send(self, payload, opcode=ABNF.OPCODE_TEXT):
+        """
+        queue a message without waiting.
+        return value: False if the send queue is full(or the policy
+            dropped the message).
+        """
+        if self.send_queue is None:
+            raise Exception("send queue is not enabled.")
+        return self.send_queue.put(ABNF.create_frame(payload, opcode), block=False)
+
     def send_frame(self, frame):
-        if self.get_mask_key:
-            frame.get_mask_key = self.get_mask_key
-        data = frame.formating()
-        length = len(data)
+        if self.send_queue is not None:
+            # 0 when the policy dropped it
+            return len(frame.data) if self.send_queue.put(frame) else 0
+        return self._write_frame(frame)
 
+    def _write_frame(self, frame):
         with self.lock:
-            while data:
-                l = self._send(data)
-                data = data[l:]
+            return self._write_frame_locked(frame)
+
+    def _write_frame_locked(self, frame):
+        if self.batch_max_delay is not None:
+            return self._cork_frame(frame)
+        # compression context must follow the order on the wire.
+        buffers = self.prepare_frame(frame)
+        return self._send_buffers(buffers)
+
+    def send_many(self, messages, opcode=ABNF.OPCODE_TEXT):
+        """
+        send many messages with one lock acquisition and as few
+        sendmsg calls as possible(one per batch_max_bytes).
+        messages: iterable of payloads.
+        return value: bytes written.
+        """
+        length = 0
+        with self.lock:
+            for payload in messages:
+                length += self._batch_frame(ABNF.create_frame(payload, opcode))
+            self._flush_batch()
+        return length
+
+    def cork(self, max_delay=0.005, max_bytes=BATCH_MAX_BYTES):
+        """
+        hold frames given to send/send_frame and write them together when
+        max_bytes are pending or the oldest one waited max_delay seconds.
+        control frames flush at once.
+        """
+        with self.lock:
+            self.batch_max_bytes = max_bytes
+            self.batch_max_delay = max_delay
+        with self._flush_cond:
+            if self._flusher is None:
+                self._flusher = threading.Thread(target=self._flush_loop, name="websock-flusher")
+                self._flusher.daemon = True
+                self._flusher.start()
+
+    def uncork(self):
+        """
+        leave cork mode, pending frames are written.
+        """
+        with self.lock:
+            self.batch_max_delay = None
+            self._flush_batch()
+        with self._flush_cond:
+            self._flush_cond.notify()
+
+    def flush(self):
+        """
+        write the pending frames now.
+        """
+        with self.lock:
+            self._flush_batch()
+
+    def _cork_frame(self, frame):
+        if self._flush_error is not None:
+            e, self._flush_error = self._flush_error, None
+            raise e
+        was_empty = not self._batch_bytes
+        length = self._batch_frame(frame)
+        if frame.opcode >= ABNF.OPCODE_CLOSE:
+            self._flush_batch()
+        elif was_empty and self._batch_bytes:
+            with self._flush_cond:
+                self._flush_deadline = time.monotonic() + self.batch_max_delay
+                self._flush_cond.notify()
+        return length
+
+    def _flush_loop(self):
+        """
+        flush corked frames when they are due, until uncorked or closed.
+        """
+        while True:
+            with self._flush_cond:
+                while True:
+                    if self.batch_max_delay is None or self.sock is None:
+                        self._flusher = None
+                        return
+                    deadline = self._flush_deadline
+                    # wake up now and then to see the socket closed
+                    wait = 1.0 if deadline is None else deadline - time.monotonic()
+                    if wait <= 0:
+                        break
+                    self._flush_cond.wait(wait)
+            try:
+                self.flush()
+            except Exception as e:
+                # raised by the next send
+                self._flush_error = e
+
+    def _batch_frame(self, frame):
+        """
+        encode frame into the batch, lock must be held.
+        """
+        header, payload = self.prepare_frame(frame)
+        self._batch_tail += header
+        if len(payload) <= BATCH_COPY_SIZE:
+            self._batch_tail += payload
+        else:
+            self._batch.append(self._batch_tail)
+            self._batch.append(payload)
+            self._batch_tail = bytearray()
+        length = len(header) + len(payload)
+        self._batch_bytes += length
+        if self._batch_bytes >= self.batch_max_bytes:
+            self._flush_batch()
+        return length
+
+    def _flush_batch(self):
+        self._flush_deadline = None
+        if not self._batch_bytes:
+            return
+        buffers = self._batch
+        buffers.append(self._batch_tail)
+        self._batch = []
+        self._batch_tail = bytearray()
+        self._batch_bytes = 0
+        self._send_buffers(buffers)
+
+    def _send_buffers(self, buffers):
+        """
+        write all buffers, header and payload are never joined.
+        after a partial write only memoryview offsets move forward.
+        """
+        if is_tls(self.sock):
+            length = send_buffers_tls(self.sock, buffers)
+            if self.stats is not None:
+                self.stats.send_calls += 1
+                self.stats.send_bytes += length
+            return length
+
+        views = [memoryview(b).cast("B") for b in buffers if len(b)]
+        length = sum(len(v) for v in views)
+        i = 0
+        while i < len(views):
+            sent = sendmsg(self.sock, views[i:i + IOV_MAX])
+            if self.stats is not None:
+                self.stats.send_calls += 1
+                self.stats.send_bytes += sent
+            while sent:
+                if sent >= len(views[i]):
+                    sent -= len(views[i])
+                    i += 1
+                else:
+                    views[i] = views[i][sent:]
+                    sent = 0
 
         return length
 
     def send_close(self, status=STATUS_NORMAL, reason=""):
-        if status < 0 or  ABNF.LENGTH_16 <= status :
-            raise ValueError("status code is invalid range")
+        close_ms = self.close_payload(status, reason)
         self.connected = False
-
-        close_ms = status.pack("!H", status) + reason
+        self.close_sent = True
         self.send(close_ms, ABNF.OPCODE_CLOSE)
 
 
-def create_connection(url, timeout=None, **options):
+class message_stream(object):
+    """
+    iterator of payload chunks of one received data message.
+    chunks are memoryview(or bytes when compressed) valid until the next
+    chunk is taken, or str for text when decode is set. control frames
+    between fragments are handled inline.
+    the connection's readlock is held until the message ends.
+    """
+
+    def __init__(self, websock, chunk_size, decode=False):
+        self.websock = websock
+        self.frame_buffer = websock.frame_buffer
+        self.chunk_size = chunk_size
+        self.opcode = None
+        self.fin = False
+        self.inflating = False
+        self.done = False
+        self.decoder = None
+        websock.readlock.acquire()
+        try:
+            self._next_frame()
+            if decode and self.opcode == ABNF.OPCODE_TEXT:
+                self.decoder = utf8_decoder()
+        except WebSocketProtocolException as e:
+            self._finish()
+            websock._fail(e)
+            raise e
+        except Exception:
+            self._finish()
+            raise
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.done:
+            raise StopIteration
+        try:
+            while True:
+                if self.frame_buffer.header is None:
+                    # current frame is finished
+                    if self.fin:
+                        self._finish()
+                        raise StopIteration
+                    self._next_frame()
+
+                chunk = self.frame_buffer.recv_payload_chunk(self.chunk_size)
+                frame_done = self.frame_buffer.header is None
+                if self.inflating:
+                    chunk = self.websock.deflate.decompress(chunk, self.fin and frame_done)
+                if self.decoder is not None:
+                    chunk = decode_text(self.decoder, chunk, self.fin and frame_done)
+                if chunk or (frame_done and self.fin):
+                    return chunk
+        except WebSocketProtocolException as e:
+            self._finish()
+            self.websock._fail(e)
+            raise e
+        except StopIteration:
+            raise
+        except Exception:
+            self._finish()
+            raise
+
+    def _next_frame(self):
+        """
+        read headers until the next data frame of this message.
+        """
+        ws = self.websock
+        while True:
+            with self.frame_buffer.lock:
+                self.frame_buffer.recv_frame_header()
+            (fin, rsv1, _, _, opcode, _, _) = self.frame_buffer.header
+
+            if opcode >= ABNF.OPCODE_CLOSE:
+                frame = ws.recv_frame()
+                ws._handle_control(frame)
+                if frame.opcode == ABNF.OPCODE_CLOSE:
+                    raise Exception("Connection is already closed.")
+                continue
+
+            if self.opcode is None:
+                if opcode == ABNF.OPCODE_CONT:
+                    raise WebSocketProtocolException("Illegal frame: no message to continue")
+                self.opcode = opcode
+                self.inflating = bool(ws.deflate and rsv1)
+            elif opcode != ABNF.OPCODE_CONT:
+                raise WebSocketProtocolException("Illegal frame: previous message is not finished")
+            self.fin = fin
+            return
+
+    def _finish(self):
+        if not self.done:
+            self.done = True
+            self.websock.readlock.release()
+
+    def close(self):
+        """
+        stop reading. the rest of the message is read and discarded
+        so that the connection stays usable.
+        """
+        for _ in self:
+            pass
+
+
+def create_connection(url, timeout=None, max_message_size=None, stats=False,
+                      keepalive=None, **options):
+    """
+    keepalive: started keepalive to ping this connection with.
+    """
     set_timeout(timeout)
-    websock = WebSocket()
+    websock = WebSocket(max_message_size, stats)
     websock.connect(url, **options)
+    if keepalive is not None:
+        keepalive.add(websock)
 
     return websock
 